@@ -1,23 +1,26 @@
 import logging
 import azure.functions as func
 import json
-from azure.storage.table import TableService, Entity
 import os
+from ..shared_code import cache, clients
 
 # Configurar, no painel das Functions, General Settings > Configurations > Application Settings
 # Inclua as variáveis de ambiente baixo para a conta do Storage
 
-ACCOUNT_NAME = os.environ["STORAGE_ACCOUNT_NAME"]
-ACCOUNT_KEY = os.environ["STORAGE_ACCOUNT_KEY"]
 TABLE_NAME_TRACKING = os.environ["TABLE_NAME_TRACKING"]
 
 # Headers para lidar com CORS pois as configurações do Azure não tem efeito no engine Python, pelo menos por enquanto :(
 headers = {
     "Access-Control-Allow-Origin": "*",
-    "Access-Control-Allow-Methods": "GET,OPTIONS"
+    "Access-Control-Allow-Methods": "GET,OPTIONS",
+    "Access-Control-Allow-Headers": "If-None-Match",
+    "Access-Control-Expose-Headers": "ETag"
 }
 
+response_cache = cache.ResponseCache()
 
+
+@clients.track_connection_reuse
 def main(req: func.HttpRequest) -> func.HttpResponse:
 
     try:
@@ -37,21 +40,24 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
             logging.info("Processing "+str(code) + "...")
 
-            table_service = TableService(
-                account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY)
-            records = table_service.query_entities(
-                TABLE_NAME_TRACKING, filter="PartitionKey eq 'tracking-analysis' and RowKey eq '"+code+"'")
+            table_service = clients.table_service
+
+            version, body = response_cache.get_or_load(
+                code,
+                lambda: cache.entity_version(
+                    table_service, TABLE_NAME_TRACKING, "tracking-analysis", code) or None,
+                lambda: json.dumps({"message": "Code has been found", "status": True}))
 
-            if len(records.items) == 0:
+            if version is None:
                 ret["message"] = "Meeting coding not found"
                 ret["status"] = False
                 logging.info("Code not found.")
+
+                return func.HttpResponse(json.dumps(ret), headers=headers)
             else:
-                ret["message"] = "Code has been found"
-                ret["status"] = True
                 logging.info("Code has been found.")
 
-            return func.HttpResponse(json.dumps(ret), headers=headers)
+                return cache.http_response(req, version, body, headers)
 
     except Exception as error:
         logging.error(error)
@@ -1,25 +1,48 @@
 import logging
 import azure.functions as func
 import json
-from azure.storage.table import TableService, Entity
 import os
-import time
-import datetime
+from ..shared_code import cache, clients, facial, tracking
 
 # Configurar, no painel das Functions, General Settings > Configurations > Application Settings
 # Inclua as variáveis de ambiente baixo para a conta do Storage
 
-ACCOUNT_NAME = os.environ["STORAGE_ACCOUNT_NAME"]
-ACCOUNT_KEY = os.environ["STORAGE_ACCOUNT_KEY"]
 TABLE_NAME_TRACKING = os.environ["TABLE_NAME_TRACKING"]
 
 # Headers para lidar com CORS pois as configurações do Azure não tem efeito no engine Python, pelo menos por enquanto :(
 headers = {
     "Access-Control-Allow-Origin": "*",
-    "Access-Control-Allow-Methods": "GET,OPTIONS"
+    "Access-Control-Allow-Methods": "GET,OPTIONS",
+    "Access-Control-Allow-Headers": "If-None-Match",
+    "Access-Control-Expose-Headers": "ETag"
 }
 
+response_cache = cache.ResponseCache()
 
+
+def facial_analysis_version(table_service, code):
+    # Cada lote de imagens processado atualiza o resumo de emoções, então o ETag dele muda junto
+    # com a série de frames
+    tracking_version = cache.entity_version(
+        table_service, TABLE_NAME_TRACKING, tracking.TRACKING_PARTITION, code)
+
+    if not tracking_version:
+        return None
+
+    return tracking_version + "|" + cache.entity_version(
+        table_service, TABLE_NAME_TRACKING, code, tracking.EMOTION_SUMMARY_ROW)
+
+
+def is_empty(body):
+    time_analysis = json.loads(body)["facialTimeAnalysis"]
+
+    if isinstance(time_analysis, dict):
+        return len(time_analysis["timestamp"]) == 0
+
+    return len(time_analysis) == 0
+
+
+@clients.track_connection_reuse
 def main(req: func.HttpRequest) -> func.HttpResponse:
     try:
         logging.info("Trigger started")
@@ -38,45 +61,109 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
             logging.info("Processing "+str(code) + "...")
 
-            table_service = TableService(
-                account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY)
-            records = table_service.query_entities(
-                TABLE_NAME_TRACKING, filter="PartitionKey eq 'tracking-analysis' and RowKey eq '"+code+"'")
+            # "cursor" (devolvido em nextCursor) ou "since" (timestamp) limitam a resposta aos pontos novos
+            try:
+                after_row_key = None
+                if "cursor" in req.params:
+                    after_row_key = facial.decode_cursor(req.params.get('cursor'))
+                elif "since" in req.params:
+                    after_row_key = tracking.frames_after(
+                        max(int(req.params.get('since')), 0))
+            except ValueError:
+                logging.info("Invalid cursor")
+
+                ret["message"] = "The parameter cursor or since is invalid."
+                ret["status"] = False
 
-            if len(records.items) == 0:
-                ret["message"] = "Meeting coding not found"
+                return func.HttpResponse(json.dumps(ret), headers=headers)
+
+            # "resolution" (minutos) devolve os agregados por intervalo em vez de um ponto por imagem
+            resolution = req.params.get('resolution', 'frame')
+
+            if resolution == "frame":
+                resolution = None
+            elif resolution.isdigit() and int(resolution) in tracking.ROLLUP_RESOLUTIONS:
+                resolution = int(resolution)
+            else:
+                logging.info("Invalid resolution")
+
+                ret["message"] = "The parameter resolution must be frame or one of " + \
+                    ", ".join(str(minutes) for minutes in tracking.ROLLUP_RESOLUTIONS) + "."
                 ret["status"] = False
 
-                logging.info("Code not found.")
+                return func.HttpResponse(json.dumps(ret), headers=headers)
+
+            # "format=columns" devolve a série em colunas paralelas, sem repetir as chaves em cada ponto
+            response_format = req.params.get('format', 'points')
+
+            if response_format not in ("points", "columns"):
+                logging.info("Invalid format")
+
+                ret["message"] = "The parameter format must be points or columns."
+                ret["status"] = False
 
                 return func.HttpResponse(json.dumps(ret), headers=headers)
-            else:
-                record = records.items[0]
-                facial_time_analysis = json.loads(
-                    record["EmotionTimeAnalysis"])
 
-                time_analysis = []
+            columns = response_format == "columns"
 
-                for item in facial_time_analysis:
-                    entry = {}
-                    timestamp = time.mktime(datetime.datetime.strptime(
-                        item["time"], "%d/%m/%Y %H:%M").timetuple())
-                    timestamp = round(timestamp)
-                    entry["timestamp"] = timestamp
-                    entry["value"] = item["value"]
-                    entry["persons"] = item["persons"]
-                    entry["emotion"] = item["emotion"]
+            # "faces=true" acrescenta as emoções de cada face a cada ponto
+            faces = req.params.get('faces', 'false').lower()
 
-                    time_analysis.append(entry)
+            if faces not in ("true", "false") or (faces == "true" and resolution is not None):
+                logging.info("Invalid faces")
 
-                ret["message"] = "Code found at the database"
-                ret["status"] = True
-                ret["facialTimeAnalysis"] = time_analysis
+                ret["message"] = "The parameter faces must be true or false, and true only with resolution frame."
+                ret["status"] = False
 
-                logging.info("Code successfully processed.")
+                return func.HttpResponse(json.dumps(ret), headers=headers)
+
+            faces = faces == "true"
+
+            # "wait" (segundos) segura a requisição até chegarem pontos novos depois do cursor, ou
+            # até a resposta mudar quando o If-None-Match já é a versão atual
+            try:
+                wait = cache.parse_wait(req)
+            except ValueError:
+                logging.info("Invalid wait")
+
+                ret["message"] = "The parameter wait must be a number of seconds."
+                ret["status"] = False
 
                 return func.HttpResponse(json.dumps(ret), headers=headers)
 
+            table_service = clients.table_service
+
+            key = (code, after_row_key, resolution, columns, faces)
+
+            def get_version():
+                return facial_analysis_version(table_service, code)
+
+            def load():
+                return facial.load_facial_analysis(table_service, code, after_row_key, resolution, columns,
+                                            faces=faces)
+
+            def unchanged(version, body):
+                return cache.is_not_modified(req, cache.response_etag(req, version)) or \
+                    (after_row_key is not None and resolution is None and is_empty(body))
+
+            version, body = response_cache.get_or_load(key, get_version, load)
+
+            if version is not None and wait > 0:
+                version, body = response_cache.long_poll(
+                    key, code, get_version, load, version, body, wait, unchanged)
+
+            if version is None:
+                ret["message"] = "Meeting coding not found"
+                ret["status"] = False
+
+                logging.info("Code not found.")
+
+                return func.HttpResponse(json.dumps(ret), headers=headers)
+            else:
+                logging.info("Code successfully processed.")
+
+                return cache.http_response(req, version, body, headers)
+
     except Exception as error:
         logging.error(error)
         return func.HttpResponse(error, status_code=400, headers=headers)
@@ -0,0 +1,308 @@
+import logging
+import azure.functions as func
+import itertools
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from ..shared_code import clients, facial, tracking, wordcloud
+
+# Configurar, no painel das Functions, General Settings > Configurations > Application Settings
+# Inclua as variáveis de ambiente baixo para a conta do Storage
+
+TABLE_NAME_TRACKING = os.environ["TABLE_NAME_TRACKING"]
+
+# Reuniões por resposta: a memória usada fica limitada a uma página, e a última linha indica de onde
+# continuar
+BULK_PAGE_SIZE = int(os.environ.get("BULK_PAGE_SIZE", "100"))
+
+# O Table Storage aceita até 15 comparações em um filtro, contando a da PartitionKey e as de data
+MAX_FILTER_COMPARISONS = 15
+
+SECTIONS = ["code", "wordcloud", "facial"]
+
+# Formatos aceitos em "from" e "to"
+DATE_FORMATS = ["%Y-%m-%dT%H:%M:%S.%f%z", "%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%dT%H:%M%z",
+                "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"]
+
+# Headers para lidar com CORS pois as configurações do Azure não tem efeito no engine Python, pelo menos por enquanto :(
+headers = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET,POST,OPTIONS"
+}
+
+
+def parse_codes(req):
+    # Códigos separados por vírgula em "codes" e/ou no corpo de um POST (lista JSON ou um por linha)
+    codes = [code for code in req.params.get('codes', '').split(",")]
+
+    body = req.get_body().decode('utf-8').strip()
+    if body.startswith("["):
+        codes += json.loads(body)
+    elif body:
+        codes += body.splitlines()
+
+    return sorted(set(code.strip() for code in codes if code.strip()))
+
+
+def parse_date(value):
+    # ISO 8601 com "Z" ou deslocamento (+03:00 ou +0300); sem fuso, a data é em UTC. O %z do Python 3.6
+    # não aceita "Z" nem ":" no deslocamento, então eles são normalizados antes
+    value = value.strip()
+    if value[-1:] in ("Z", "z"):
+        value = value[:-1] + "+0000"
+    elif len(value) > 6 and value[-6] in "+-" and value[-3] == ":":
+        value = value[:-3] + value[-2:]
+
+    for date_format in DATE_FORMATS:
+        try:
+            date_time = datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+
+        if date_time.tzinfo is None:
+            date_time = date_time.replace(tzinfo=timezone.utc)
+
+        return date_time.astimezone(timezone.utc)
+
+    raise ValueError("Invalid date")
+
+
+def date_filters(end):
+    # A última atualização de uma reunião nunca é anterior à do registro principal, então só o fim do
+    # período pode ser aplicado na consulta; o início depende também do resumo de emoções
+    if end is None:
+        return []
+
+    # O filtro tem precisão de segundos; o limite exato é conferido depois, em in_range
+    if end.microsecond > 0:
+        end = end.replace(microsecond=0) + timedelta(seconds=1)
+
+    return ["Timestamp lt datetime'" + end.strftime("%Y-%m-%dT%H:%M:%SZ") + "'"]
+
+
+def summary_updates(table_service, codes):
+    # Última gravação do resumo de emoções de cada reunião, lida em consultas com vários códigos cada;
+    # as reuniões sem resumo ficam de fora
+    codes_per_query = MAX_FILTER_COMPARISONS - 1
+    updates = {}
+
+    for start in range(0, len(codes), codes_per_query):
+        chunk = codes[start:start + codes_per_query]
+
+        query_filter = "RowKey eq " + quote(tracking.EMOTION_SUMMARY_ROW) + " and (" + \
+            " or ".join("PartitionKey eq " + quote(code) for code in chunk) + ")"
+
+        for summary in table_service.query_entities(TABLE_NAME_TRACKING, filter=query_filter,
+                                                    select="PartitionKey,Timestamp"):
+            updates[summary["PartitionKey"]] = summary["Timestamp"]
+
+    return updates
+
+
+def last_update(record, summary_updated):
+    # O registro principal muda com as transcrições; as imagens atualizam somente o resumo de emoções
+    updated = record.get("Timestamp")
+
+    if summary_updated is not None and (updated is None or summary_updated > updated):
+        return summary_updated
+
+    return updated
+
+
+def in_range(updated, start, end):
+    return updated is not None and (start is None or updated >= start) and (end is None or updated < end)
+
+
+def quote(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def query_codes(table_service, codes, filters, select):
+    # Registros das reuniões da lista, buscados em consultas com vários códigos cada; sem filtro de
+    # data, os códigos inexistentes são devolvidos com registro None
+    codes_per_query = MAX_FILTER_COMPARISONS - 1 - len(filters)
+
+    for start in range(0, len(codes), codes_per_query):
+        chunk = codes[start:start + codes_per_query]
+
+        query_filter = " and ".join(["PartitionKey eq '" + tracking.TRACKING_PARTITION + "'",
+                                     "(" + " or ".join("RowKey eq " + quote(code) for code in chunk) + ")"] +
+                                    filters)
+
+        records = {record["RowKey"]: record for record in table_service.query_entities(
+            TABLE_NAME_TRACKING, filter=query_filter, select=select)}
+
+        for code in chunk:
+            if code in records or len(filters) == 0:
+                yield code, records.get(code)
+
+
+def query_range(table_service, after, filters, select):
+    # Todas as reuniões do período, em ordem de código
+    query_filter = " and ".join(["PartitionKey eq '" + tracking.TRACKING_PARTITION + "'"] +
+                                (["RowKey gt " + quote(after)] if after is not None else []) +
+                                filters)
+
+    for record in table_service.query_entities(TABLE_NAME_TRACKING, filter=query_filter, select=select):
+        yield record["RowKey"], record
+
+
+def meeting_line(table_service, code, record, sections, top, resolution, updated=None):
+    # Uma linha NDJSON por reunião; as seções são as mesmas respostas dos endpoints de uma reunião
+    line = {"code": code, "found": record is not None}
+
+    if record is None:
+        return json.dumps(line)
+
+    if "code" in sections and updated is not None:
+        line["updated"] = updated.isoformat()
+
+    parts = [json.dumps(line)[:-1]]
+
+    if "wordcloud" in sections:
+        parts.append(', "wordCloud": ' +
+                     wordcloud.load_word_cloud(table_service, code, top, record))
+
+    if "facial" in sections:
+        parts.append(', "facialAnalysis": ' + facial.load_facial_analysis(table_service, code, None, resolution,
+                                                                   record=record))
+
+    return "".join(parts) + "}"
+
+
+@clients.track_connection_reuse
+def main(req: func.HttpRequest) -> func.HttpResponse:
+
+    try:
+        logging.info("Trigger started")
+
+        ret = {}
+
+        try:
+            codes = parse_codes(req)
+
+            start = parse_date(req.params['from']
+                               ) if 'from' in req.params else None
+            end = parse_date(req.params['to']) if 'to' in req.params else None
+
+            sections = req.params.get('include', ",".join(SECTIONS)).split(",")
+            if any(section not in SECTIONS for section in sections):
+                raise ValueError("Invalid include")
+
+            top = wordcloud.parse_top(req)
+
+            resolution = None
+            if req.params.get('resolution', 'frame') != "frame":
+                resolution = int(req.params['resolution'])
+                if resolution not in tracking.ROLLUP_RESOLUTIONS:
+                    raise ValueError("Invalid resolution")
+        except ValueError as error:
+            logging.info(str(error))
+
+            ret["message"] = "Invalid parameters: codes, from, to, include, top or resolution."
+            ret["status"] = False
+
+            return func.HttpResponse(json.dumps(ret), headers=headers)
+
+        if len(codes) == 0 and start is None and end is None:
+            logging.info("No meetings requested")
+
+            ret["message"] = "The parameter codes or a date range (from, to) must be present in the request."
+            ret["status"] = False
+
+            return func.HttpResponse(json.dumps(ret), headers=headers)
+
+        # "after" é o último código da página anterior
+        after = req.params.get('after')
+
+        logging.info("Processing " + (str(len(codes)) + " meetings" if codes else "date range") +
+                     (" after " + after if after else "") + "...")
+
+        table_service = clients.table_service
+
+        select = "RowKey,Timestamp"
+        if "wordcloud" in sections:
+            select += ",FreqDist,WordCloud"
+        if "facial" in sections:
+            select += ",EmotionTimeAnalysis"
+
+        if codes:
+            codes = [code for code in codes if after is None or code > after]
+
+        if start is None and end is None:
+            # Uma reunião além da página indica que há mais
+            page = list(itertools.islice(query_codes(
+                table_service, codes, [], select), BULK_PAGE_SIZE + 1))
+
+            updates = {}
+            if "code" in sections:
+                updates = summary_updates(
+                    table_service, [code for code, record in page if record is not None])
+
+            meetings = ((code, record, last_update(record, updates.get(code)) if record is not None else None)
+                        for code, record in page)
+        else:
+            # Com período, as reuniões da página são escolhidas pela última atualização (a mais recente
+            # entre o registro principal e o resumo de emoções) e só então lidas por inteiro
+            filters = date_filters(end)
+
+            if codes:
+                candidates = query_codes(
+                    table_service, codes, filters, "RowKey,Timestamp")
+            else:
+                candidates = query_range(
+                    table_service, after, filters, "RowKey,Timestamp")
+
+            # Os resumos são lidos em lotes de candidatos, um por consulta de summary_updates
+            candidates = (record for _, record in candidates
+                          if record is not None)
+
+            page = []
+            while len(page) <= BULK_PAGE_SIZE:
+                chunk = list(itertools.islice(
+                    candidates, MAX_FILTER_COMPARISONS - 1))
+                if len(chunk) == 0:
+                    break
+
+                updates = summary_updates(
+                    table_service, [record["RowKey"] for record in chunk])
+
+                for record in chunk:
+                    updated = last_update(
+                        record, updates.get(record["RowKey"]))
+
+                    if in_range(updated, start, end):
+                        page.append((record["RowKey"], updated))
+
+                        if len(page) > BULK_PAGE_SIZE:
+                            break
+
+            records = dict((code, record) for code, record in query_codes(
+                table_service, [code for code, _ in page], [], select))
+
+            meetings = ((code, records.get(code), updated)
+                        for code, updated in page)
+
+        lines = []
+        last_code = None
+
+        for code, record, updated in meetings:
+            if len(lines) == BULK_PAGE_SIZE:
+                # Há mais reuniões: a próxima página começa depois do último código desta
+                lines.append(json.dumps({"next": {"after": last_code}}))
+                break
+
+            lines.append(meeting_line(table_service, code,
+                                      record, sections, top, resolution, updated))
+            last_code = code
+
+        logging.info("Meetings returned: " + str(len(lines)))
+
+        return func.HttpResponse("\n".join(lines) + "\n" if lines else "",
+                                 mimetype="application/x-ndjson", headers=headers)
+
+    except Exception as error:
+        logging.error(error)
+        return func.HttpResponse(
+            error, status_code=400, headers=headers
+        )
@@ -0,0 +1,103 @@
+import logging
+import azure.functions as func
+import json
+import os
+from azure.common import AzureMissingResourceHttpError
+from ..shared_code import clients, tracking
+
+# Configurar, no painel das Functions, General Settings > Configurations > Application Settings
+# Inclua as variáveis de ambiente baixo para a conta do Storage
+
+TABLE_NAME_TRACKING = os.environ["TABLE_NAME_TRACKING"]
+
+# Headers para lidar com CORS pois as configurações do Azure não tem efeito no engine Python, pelo menos por enquanto :(
+headers = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET,OPTIONS"
+}
+
+
+def meeting_exists(table_service, code):
+    try:
+        table_service.get_entity(
+            TABLE_NAME_TRACKING, tracking.TRACKING_PARTITION, code, select="RowKey")
+    except AzureMissingResourceHttpError:
+        return False
+
+    return True
+
+
+def load_transcript(table_service, code, since=None, until=None):
+    # Somente os registros dos áudios do intervalo são lidos, em ordem de horário
+    transcript = []
+
+    for record in table_service.query_entities(TABLE_NAME_TRACKING,
+                                               filter=tracking.transcript_range_filter(
+                                                   code, since, until),
+                                               select="RowKey,FileName,Text"):
+        transcript.append({"timestamp": int(record["RowKey"][len(tracking.TRANSCRIPT_ROW_PREFIX):
+                                                             len(tracking.TRANSCRIPT_ROW_PREFIX) + 12]),
+                           "file-name": record["FileName"],
+                           "text": record["Text"]})
+
+    ret = {}
+    ret["message"] = "Code found at the database"
+    ret["status"] = True
+    ret["transcript"] = transcript
+
+    return json.dumps(ret)
+
+
+@clients.track_connection_reuse
+def main(req: func.HttpRequest) -> func.HttpResponse:
+
+    try:
+        logging.info("Trigger started")
+
+        ret = {}
+
+        if "code" not in req.params:
+            logging.info("Invalid code")
+
+            ret["message"] = "The parameter code is no present in the request."
+            ret["status"] = False
+
+            return func.HttpResponse(json.dumps(ret), headers=headers)
+        else:
+            code = req.params.get('code')
+
+            logging.info("Processing "+str(code) + "...")
+
+            # "since" e "until" (timestamps) limitam a resposta aos áudios desse intervalo
+            try:
+                since = max(int(req.params['since']), 0) if 'since' in req.params else None
+                until = max(int(req.params['until']), 0) if 'until' in req.params else None
+            except ValueError:
+                logging.info("Invalid interval")
+
+                ret["message"] = "The parameters since and until must be timestamps."
+                ret["status"] = False
+
+                return func.HttpResponse(json.dumps(ret), headers=headers)
+
+            table_service = clients.table_service
+
+            if not meeting_exists(table_service, code):
+                ret["message"] = "Meeting coding not found"
+                ret["status"] = False
+
+                logging.info("Code not found.")
+
+                return func.HttpResponse(json.dumps(ret), headers=headers)
+
+            body = load_transcript(table_service, code, since, until)
+
+            logging.info("Transcript loaded.")
+
+            return func.HttpResponse(body, headers=headers)
+
+    except Exception as error:
+        logging.error(error)
+        return func.HttpResponse(
+            error, status_code=400, headers=headers
+        )
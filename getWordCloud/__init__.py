@@ -1,24 +1,39 @@
 import logging
 import azure.functions as func
 import json
-from azure.storage.table import TableService, Entity
 import os
+from ..shared_code import cache, clients, wordcloud
 
 # Configurar, no painel das Functions, General Settings > Configurations > Application Settings
 # Inclua as variáveis de ambiente baixo para a conta do Storage
 
-ACCOUNT_NAME = os.environ["STORAGE_ACCOUNT_NAME"]
-ACCOUNT_KEY = os.environ["STORAGE_ACCOUNT_KEY"]
 TABLE_NAME_TRACKING = os.environ["TABLE_NAME_TRACKING"]
-TABLE_NAME_PARAMETERS = os.environ["TABLE_NAME_PARAMETERS"]
 
 # Headers para lidar com CORS pois as configurações do Azure não tem efeito no engine Python, pelo menos por enquanto :(
 headers = {
     "Access-Control-Allow-Origin": "*",
-    "Access-Control-Allow-Methods": "GET,OPTIONS"
+    "Access-Control-Allow-Methods": "GET,OPTIONS",
+    "Access-Control-Allow-Headers": "If-None-Match",
+    "Access-Control-Expose-Headers": "ETag"
 }
 
+response_cache = cache.ResponseCache()
 
+
+def word_cloud_version(table_service, code):
+    # A nuvem muda quando o registro da reunião ou a lista de stopwords muda
+    tracking_version = cache.entity_version(
+        table_service, TABLE_NAME_TRACKING, "tracking-analysis", code)
+
+    if not tracking_version:
+        return None
+
+    stopwords_version, _ = wordcloud.get_stopwords(table_service)
+
+    return tracking_version + "|" + stopwords_version
+
+
+@clients.track_connection_reuse
 def main(req: func.HttpRequest) -> func.HttpResponse:
 
     try:
@@ -38,38 +53,55 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
             logging.info("Processing "+str(code) + "...")
 
-            table_service = TableService(
-                account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY)
-            records = table_service.query_entities(
-                TABLE_NAME_TRACKING, filter="PartitionKey eq 'tracking-analysis' and RowKey eq '"+code+"'")
+            try:
+                top = wordcloud.parse_top(req)
+            except ValueError:
+                logging.info("Invalid top")
 
-            if len(records.items) == 0:
-                ret["message"] = "Meeting coding not found"
+                ret["message"] = "The parameter top must be a positive number."
                 ret["status"] = False
 
-                logging.info("Code not found.")
+                return func.HttpResponse(json.dumps(ret), headers=headers)
+
+            # "wait" (segundos) com o If-None-Match da última resposta segura a requisição até a
+            # nuvem mudar
+            try:
+                wait = cache.parse_wait(req)
+            except ValueError:
+                logging.info("Invalid wait")
+
+                ret["message"] = "The parameter wait must be a number of seconds."
+                ret["status"] = False
 
                 return func.HttpResponse(json.dumps(ret), headers=headers)
-            else:
 
-                additional_stop_words = table_service.get_entity(
-                    TABLE_NAME_PARAMETERS, "stopwords", "general").Value
+            table_service = clients.table_service
 
-                record = records.items[0]
-                freq_dist = json.loads(record["FreqDist"])
+            def get_version():
+                return word_cloud_version(table_service, code)
 
-                words = []
-                for word in freq_dist:
-                    if freq_dist[word] > 1 and len(word) > 2 and word not in additional_stop_words:
-                        words.append({"name": word, "weight": freq_dist[word]})
+            def load():
+                return wordcloud.load_word_cloud(table_service, code, top)
 
-                ret["message"] = "Code found at the database"
-                ret["status"] = True
-                ret["words"] = words
+            version, body = response_cache.get_or_load(
+                (code, top), get_version, load)
 
-                logging.info("Code successfully processed.")
+            if version is not None and wait > 0:
+                version, body = response_cache.long_poll(
+                    (code, top), code, get_version, load, version, body, wait,
+                    lambda version, body: cache.is_not_modified(req, cache.response_etag(req, version)))
+
+            if version is None:
+                ret["message"] = "Meeting coding not found"
+                ret["status"] = False
+
+                logging.info("Code not found.")
 
                 return func.HttpResponse(json.dumps(ret), headers=headers)
+            else:
+                logging.info("Code successfully processed.")
+
+                return cache.http_response(req, version, body, headers)
 
     except Exception as error:
         logging.error(error)
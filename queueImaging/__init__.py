@@ -1,66 +1,284 @@
+import base64
+import binascii
 import json
 import logging
 import os
 import azure.functions as func
 from datetime import datetime, timedelta
 import time
-import requests
-from azure.storage.table import TableService, Entity
-from azure.storage.blob import BlockBlobService, BlobPermissions, PublicAccess
-from azure.storage.queue import QueueService
+from concurrent.futures import ThreadPoolExecutor
+from azure.common import AzureMissingResourceHttpError
+from azure.storage.blob import BlobPermissions
+from azure.storage.table import TableBatch
+from ..shared_code import clients, cognitive, frames, processed, profiling, scoring, series, tracing, tracking
 
 ACCOUNT_NAME = os.environ["STORAGE_ACCOUNT_NAME"]
-ACCOUNT_KEY = os.environ["STORAGE_ACCOUNT_KEY"]
-SUBSCRIPTION_KEY = os.environ["AI_API_KEY"]
 CONTAINER_NAME = os.environ["CONTAINER_NAME_RECORDING"]
 
 TABLE_NAME_TRACKING = os.environ["TABLE_NAME_TRACKING"]
 TABLE_NAME_API_FACE = os.environ["TABLE_NAME_API_FACE"]
 
-POSITIVE_EMOTIONS = ["happiness", "surprise"]
-NEGATIVE_EMOTIONS = ["anger", "fear", "sadness", "contempt", "disgust"]
+POSITIVE_EMOTIONS = scoring.POSITIVE_EMOTIONS
+NEGATIVE_EMOTIONS = scoring.NEGATIVE_EMOTIONS
 
-AI_API_REGION = os.environ["AI_API_REGION"]
+# Modo em lote: além da mensagem que disparou a function, até IMAGING_BATCH_SIZE mensagens são
+# retiradas da fila e processadas juntas, agrupadas por reunião (0 desativa)
+QUEUE_NAME = "images"
+IMAGING_BATCH_SIZE = int(os.environ.get("IMAGING_BATCH_SIZE", "16"))
+IMAGING_VISIBILITY_TIMEOUT = int(
+    os.environ.get("IMAGING_VISIBILITY_TIMEOUT", "300"))
+IMAGING_MAX_DEQUEUE_COUNT = 5
+FACE_API_CONCURRENCY = int(os.environ.get("FACE_API_CONCURRENCY", "8"))
 
+# Pré-processamento (shared_code/frames.py): a imagem é baixada e enviada como bytes, e imagens quase
+# iguais à última analisada da reunião reaproveitam a sua análise; "false" volta a enviar a URL com SAS
+FRAME_PREFILTER = os.environ.get("FRAME_PREFILTER", "true").lower() == "true"
 
-def main(msg: func.QueueMessage) -> None:
-    logging.info("Processing image analysis queue...")
+TABLE_BATCH_SIZE = tracking.TABLE_BATCH_SIZE
 
-    input_message = msg.get_body().decode('utf-8')
+# Imagens já analisadas com sucesso e gravadas no tracking
+processed_index = processed.ProcessedIndex(TABLE_NAME_API_FACE)
 
-    logging.info(input_message)
+# Hash e resultado da última imagem enviada à Face API de cada reunião
+last_frames = frames.LastFrames()
 
-    input_message = json.loads(input_message)
 
-    block_blob_service = BlockBlobService(
-        account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY)
+def update_emotion_count(emotional_count, positive_count, negative_count):
+    emotional_count["positive"] += positive_count
+    emotional_count["negative"] += negative_count
 
-    blob = input_message["blob"]
+    emotional_count_total = emotional_count["positive"] + \
+        emotional_count["negative"]
+
+    emotional_count["total"] = emotional_count_total
+
+    if emotional_count_total > 0:
+        emotional_count["positive_percentage"] = round(
+            100*emotional_count["positive"]/emotional_count_total, 3)
+        emotional_count["negative_percentage"] = round(
+            100*emotional_count["negative"]/emotional_count_total, 3)
+    else:
+        emotional_count["positive_percentage"] = 0
+        emotional_count["negative_percentage"] = 0
+
+    return emotional_count
+
+
+def merge_emotion_count(table_service, meetingCode, summary, positive_count, negative_count):
+    if summary is not None:
+        emotional_count = json.loads(summary["EmotionCount"])
+    else:
+        # Primeira imagem da reunião neste formato: aproveita os totais antigos, se houver,
+        # e garante que o registro principal exista para o getCode
+        emotional_count = {"positive": 0, "negative": 0}
+
+        records = table_service.query_entities(
+            TABLE_NAME_TRACKING, filter="PartitionKey eq 'tracking-analysis' and RowKey eq '"+meetingCode+"'",
+            select="EmotionCount")
+
+        if len(records.items) > 0 and "EmotionCount" in records.items[0]:
+            emotional_count = json.loads(records.items[0]["EmotionCount"])
+        elif len(records.items) == 0:
+            # Merge sem propriedades: não sobrescreve o que o queueRecording gravar ao mesmo tempo
+            table_service.insert_or_merge_entity(TABLE_NAME_TRACKING, {
+                "PartitionKey": tracking.TRACKING_PARTITION, "RowKey": meetingCode})
+
+    emotional_count = update_emotion_count(
+        emotional_count, positive_count, negative_count)
+
+    changes = {"EmotionCount": json.dumps(emotional_count)}
+
+    if summary is None:
+        # Reunião com todas as imagens gravadas também na série compacta desde a primeira
+        changes["SeriesVersion"] = series.VERSION
+
+    return changes
+
+
+def decode_queue_message(content):
+    # O host das Functions aceita mensagens em base64 ou em texto puro; as lidas diretamente da fila
+    # seguem a mesma regra
+    try:
+        return json.loads(base64.b64decode(content, validate=True).decode('utf-8'))
+    except (binascii.Error, ValueError):
+        return json.loads(content)
+
+
+def receive_batch(trace):
+    if IMAGING_BATCH_SIZE <= 0:
+        return []
+
+    queue_service = clients.queue_service
+    received = []
+
+    # O serviço de filas entrega no máximo 32 mensagens por chamada
+    while len(received) < IMAGING_BATCH_SIZE:
+        num_messages = min(32, IMAGING_BATCH_SIZE - len(received))
+        with trace.span("queue_receive"):
+            queue_messages = queue_service.get_messages(
+                QUEUE_NAME, num_messages=num_messages, visibility_timeout=IMAGING_VISIBILITY_TIMEOUT)
+
+        for queue_message in queue_messages:
+            if queue_message.dequeue_count > IMAGING_MAX_DEQUEUE_COUNT:
+                # Mesma regra de poison do host para as mensagens lidas diretamente
+                logging.warning("Moving message " +
+                                queue_message.id + " to poison queue.")
+                queue_service.put_message(
+                    QUEUE_NAME + "-poison", queue_message.content)
+                queue_service.delete_message(
+                    QUEUE_NAME, queue_message.id, queue_message.pop_receipt)
+                continue
+
+            try:
+                with trace.span("decode"):
+                    received.append(
+                        (queue_message, decode_queue_message(queue_message.content)))
+            except ValueError:
+                logging.error("Invalid message " + queue_message.id + ".")
+
+        if len(queue_messages) < num_messages:
+            break
+
+    logging.info("Messages pulled from queue: " + str(len(received)))
+
+    return received
+
+
+def is_processed(table_service, meetingCode, fileName, trace=None):
+    if processed_index.seen(meetingCode, fileName):
+        return True
+
+    with tracing.span(trace, "dedup_query", meetingCode):
+        api_record = processed_index.lookup(
+            table_service, meetingCode, fileName, select="ApiStatus")
+
+    if api_record is None or api_record.get("ApiStatus") != 200:
+        return False
+
+    processed_index.add(meetingCode, fileName)
+
+    return True
+
+
+def prepare_frame(input_message, trace=None):
+    # Download único da imagem, redução e hash; sem o blob a imagem segue pelo caminho da URL com SAS
     meetingCode = input_message["meeting-code"]
-    fileName = input_message["file-name"]
-    dateTime = input_message["date-time"]
 
-    # Example of input
-    # {"blob" : "AT81CB/image_files/AT81CB_9G9C.jpg", "meeting-code" : "AT81CB","file-name":  "AT81CB_9G9C.jpg","date-time": "13/06/2019 10:00"}
+    try:
+        with tracing.span(trace, "blob_download", meetingCode):
+            data = clients.blob_service.get_blob_to_bytes(
+                CONTAINER_NAME, input_message["blob"]).content
+    except AzureMissingResourceHttpError:
+        logging.warning("Blob not found: " + input_message["blob"])
+
+        return {"message": input_message, "data": None, "hash": None}
+
+    with tracing.span(trace, "prefilter", meetingCode):
+        data, frame_hash = frames.prepare(data)
+
+    return {"message": input_message, "data": data, "hash": frame_hash}
+
+
+def frame_order(frame):
+    return (tracking.to_timestamp(frame["message"]["date-time"]), frame["message"]["file-name"])
+
+
+def find_duplicates(prepared):
+    # Em ordem de horário, cada imagem é comparada com a última imagem analisada da reunião, que
+    # pode estar neste mesmo lote; as quase iguais recebem "reference" e não vão para a API
+    meetings = {}
+    for frame in prepared:
+        meetings.setdefault(frame["message"]["meeting-code"], []).append(frame)
+
+    for meetingCode, meeting_frames in meetings.items():
+        reference = last_frames.get(meetingCode)
+
+        for frame in sorted(meeting_frames, key=frame_order):
+            if reference is not None and frames.is_duplicate(frame["hash"], reference["hash"]):
+                frame["reference"] = reference
+            else:
+                frame["reference"] = None
+                reference = frame
 
-    table_service = TableService(
-        account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY)
+    return [frame for frame in prepared if frame["reference"] is None]
 
-    records = table_service.query_entities(TABLE_NAME_API_FACE, filter="PartitionKey eq '" + meetingCode + "' and RowKey eq '" +
-                                           fileName + "' and ApiStatus eq 200")
 
-    if len(records.items) == 0:
+def reuse_analysis(frame):
+    # Mesmas faces e mesmo status da imagem de referência; o registro no log da API indica a origem
+    input_message = frame["message"]
+    reference = frame["reference"]["result"]
 
-        logging.info("File not processed yet. Starting processing...")
+    api_record = dict(reference["api_record"],
+                      PartitionKey=input_message["meeting-code"],
+                      RowKey=input_message["file-name"],
+                      Time=input_message["date-time"],
+                      ApiTimeResponseSeconds=0,
+                      FrameHash="%016x" % frame["hash"],
+                      ReusedFrom=reference["message"]["file-name"],
+                      ReusedDistance=frames.distance(frame["hash"], frame["reference"]["hash"]))
 
+    logging.info("File " + input_message["file-name"] + " reuses the analysis of " +
+                 reference["message"]["file-name"] + " (distance " + str(api_record["ReusedDistance"]) + ").")
+
+    return {"message": input_message,
+            "status": reference["status"],
+            "faces": reference["faces"],
+            "api_record": api_record}
+
+
+def analyse_frames(input_messages, executor, trace=None):
+    if not FRAME_PREFILTER:
+        return list(executor.map(lambda input_message: analyse_frame(input_message, trace), input_messages))
+
+    prepared = list(executor.map(
+        lambda input_message: prepare_frame(input_message, trace), input_messages))
+
+    analysed = find_duplicates(prepared)
+
+    for frame, result in zip(analysed, executor.map(
+            lambda frame: analyse_frame(frame["message"], trace, frame["data"]), analysed)):
+        frame["result"] = result
+
+        if frame["hash"] is not None:
+            result["api_record"]["FrameHash"] = "%016x" % frame["hash"]
+
+    for frame in prepared:
+        if frame["reference"] is not None:
+            frame["result"] = reuse_analysis(frame)
+
+    # A última imagem analisada com sucesso de cada reunião vira a referência das próximas
+    for frame in sorted(analysed, key=frame_order):
+        if frame["hash"] is not None and frame["result"]["status"] == 200:
+            last_frames.set(frame["message"]["meeting-code"],
+                            {"hash": frame["hash"], "result": frame["result"]})
+
+    logging.info("Face API calls: " + str(len(analysed)) + " of " +
+                 str(len(prepared)) + " files.")
+
+    return [frame["result"] for frame in prepared]
+
+
+def analyse_frame(input_message, trace=None, data=None):
+    # data: bytes da imagem já baixada; sem eles a API recebe uma URL com SAS para baixar o blob
+    blob = input_message["blob"]
+    meetingCode = input_message["meeting-code"]
+    fileName = input_message["file-name"]
+
+    headers = {'Ocp-Apim-Subscription-Key': cognitive.AI_API_KEY}
+
+    if data is not None:
+        headers["Content-Type"] = "application/octet-stream"
+        body = {"data": data}
+    else:
         sas_minutes = 10
 
-        sas_url = block_blob_service.generate_blob_shared_access_signature(
-            CONTAINER_NAME,
-            blob,
-            BlobPermissions.READ,
-            datetime.utcnow() + timedelta(minutes=sas_minutes),
-        )
+        with tracing.span(trace, "sas", meetingCode):
+            sas_url = clients.blob_service.generate_blob_shared_access_signature(
+                CONTAINER_NAME,
+                blob,
+                BlobPermissions.READ,
+                datetime.utcnow() + timedelta(minutes=sas_minutes),
+            )
 
         logging.info(
             "Publicity of file using shared signature created for "+str(sas_minutes))
@@ -70,191 +288,393 @@ def main(msg: func.QueueMessage) -> None:
 
         logging.info("Public url generated: " + image_url)
 
-        face_api_url = "https://"+AI_API_REGION + \
-            ".api.cognitive.microsoft.com/face/v1.0/detect"
+        body = {"json": {"url": image_url}}
 
-        # Example of output
-        # perception = {"time": "08:00", "emotion":
-        # {"anger": 0.0, "contempt": 0.001, "disgust": 0.0, "fear": 0.0,
-        #    "happiness": 0.97, "neutral": 0.029, "sadness": 0.0, "surprise": 0.0}
+    # Example of output
+    # perception = {"time": "08:00", "emotion":
+    # {"anger": 0.0, "contempt": 0.001, "disgust": 0.0, "fear": 0.0,
+    #    "happiness": 0.97, "neutral": 0.029, "sadness": 0.0, "surprise": 0.0}
 
-        headers = {'Ocp-Apim-Subscription-Key': SUBSCRIPTION_KEY}
+    params = {
+        'returnFaceId': 'false',
+        'returnFaceLandmarks': 'false',
+        'returnFaceAttributes': 'emotion',
+    }
 
-        params = {
-            'returnFaceId': 'false',
-            'returnFaceLandmarks': 'false',
-            'returnFaceAttributes': 'emotion',
-        }
+    logging.info("Starting facial API analysis...")
+    logging.info("Processing file " + fileName + "...")
 
-        logging.info("Starting facial API analysis...")
-        logging.info("Processing file " + fileName + "...")
+    # Respeita o limite de chamadas do tier; respostas 429 são repetidas após o Retry-After
+    with tracing.span(trace, "ai_call", meetingCode):
+        start_time = time.perf_counter()
 
-        start_time = datetime.now()
+        response = cognitive.post("face", cognitive.URL_FACE_API, params=params,
+                                  headers=headers, **body)
 
-        response = requests.post(face_api_url, params=params,
-                                 headers=headers, json={"url": image_url})
+        api_seconds = time.perf_counter() - start_time
 
-        end_time = datetime.now()
-        api_time = end_time - start_time
+    logging.info("Face analysis successfully processed.")
 
-        logging.info("Face analysis successfully processed.")
+    api_response = {"statusCode": response.status_code,
+                    "reason": response.reason}
 
-        api_response = {"statusCode": response.status_code,
-                        "reason": response.reason}
+    # Time: horário da imagem, para que a reunião possa ser reconstruída só a partir do log
+    api_record = {"PartitionKey": meetingCode,
+                  "RowKey": fileName,
+                  "Time": input_message["date-time"],
+                  "ApiStatus": response.status_code,
+                  "ApiResponse": json.dumps(api_response),
+                  "ApiTimeResponseSeconds": round(api_seconds, 3)}
 
-        api_record = {"PartitionKey": meetingCode,
-                      "RowKey": fileName,
-                      "ApiStatus": response.status_code,
-                      "ApiResponse": json.dumps(api_response),
-                      "TextResponse": json.dumps(response.json()),
-                      "ApiTimeResponseSeconds": api_time.seconds}
+    # O corpo de uma resposta de erro não é uma lista de faces
+    if response.status_code == 200:
+        faces = response.json()
+        api_record["TextResponse"] = json.dumps(faces)
+    else:
+        faces = []
+        api_record["ErrorResponse"] = response.text
 
-        table_service.insert_or_replace_entity(
-            TABLE_NAME_API_FACE, api_record)
+    logging.info("Response: " + str(api_response))
+    logging.info("Response result: " + response.text)
 
-        logging.info("Response: " + str(api_response))
-        logging.info("Response result: " + str(response.json()))
+    return {"message": input_message,
+            "status": response.status_code,
+            "faces": faces,
+            "api_record": api_record}
 
-        faces = response.json()
-        qtde_person = len(faces)
 
-        logging.info("Records found " + str(qtde_person))
+def score_frames(frame_faces):
+    # frame_faces: lista de (nome do arquivo, faces); as faces de todas as imagens são pontuadas juntas
+    scores = scoring.score_frames([faces for _, faces in frame_faces])
 
-        if response.status_code == 200 and qtde_person > 0:
+    for (fileName, faces), score in zip(frame_faces, scores):
+        score["file_processed"] = [{"file-name": fileName, "emotion-analysis": face["faceAttributes"]["emotion"]}
+                                   for face in faces]
 
-            positive = 0
-            negative = 0
-            neutral = 0
+        logging.info("Score of " + fileName + ": " + str(score["value"]) +
+                     " (" + str(score["emotion"]) + ")")
 
-            positive_count = 0
-            negative_count = 0
+    return scores
 
-            file_processed = []
 
-            for face in faces:
-                file_processed.append(
-                    {"file-name": fileName, "emotion-analysis": face["faceAttributes"]["emotion"]})
+def commit_in_batches(table_service, table_name, entities):
+    # Uma transação por partição, com até TABLE_BATCH_SIZE entidades cada
+    partitions = {}
+    for entity in entities:
+        partitions.setdefault(entity["PartitionKey"], []).append(entity)
 
-                max_key = sorted(face["faceAttributes"]["emotion"], key=(
-                    lambda key: face["faceAttributes"]["emotion"][key]), reverse=True)
+    for partition in partitions.values():
+        for start in range(0, len(partition), TABLE_BATCH_SIZE):
+            batch = TableBatch()
+            for entity in partition[start:start + TABLE_BATCH_SIZE]:
+                batch.insert_or_replace_entity(entity)
 
-                logging.info("Max key " + str(max_key[0]))
+            table_service.commit_batch(table_name, batch)
 
-                if max_key[0] in POSITIVE_EMOTIONS:
-                    positive_count += 1
-                    positive += face["faceAttributes"]["emotion"][max_key[0]]
-                elif max_key[0] in NEGATIVE_EMOTIONS:
-                    negative_count += 1
-                    negative += face["faceAttributes"]["emotion"][max_key[0]]
-                else:
-                    neutral += face["faceAttributes"]["emotion"][max_key[0]]
 
-            logging.info("Positives count " + str(positive_count))
-            logging.info("Negatives count " + str(negative_count))
+def group_by_rollup(frame_records):
+    # Cada imagem entra nos agregados de 1, 5 e 15 minutos do seu horário
+    frames_by_row = {}
 
-            logging.info("Positives points " + str(positive))
-            logging.info("Negatives points " + str(negative))
-            logging.info("Neutral points " + str(neutral))
+    for frame_record in frame_records:
+        timestamp = tracking.frame_timestamp(frame_record["RowKey"])
 
-            total = positive + negative + neutral
+        for resolution in tracking.ROLLUP_RESOLUTIONS:
+            frames_by_row.setdefault(tracking.rollup_row_key(
+                resolution, tracking.rollup_bucket(timestamp, resolution)), []).append(frame_record)
 
-            if total > 0:
-                positive_norm = round(positive/total, 3)
-                negative_norm = round(negative/total, 3)
-                neutral_norm = round(neutral/total, 3)
-            else:
-                positive_norm = 0
-                negative_norm = 0
-                neutral_norm = 1
+    return frames_by_row
 
-            logging.info("Positives points normed " + str(positive_norm))
-            logging.info("Negatives points normed " + str(negative_norm))
-            logging.info("Neutral points normed " + str(neutral_norm))
 
-            values = {"positive": positive_norm,
-                      "neutral": neutral_norm, "negative": negative_norm}
+def group_by_series_chunk(frame_records):
+    frames_by_row = {}
 
-            logging.info("Value points: " + str(values))
+    for frame_record in frame_records:
+        frames_by_row.setdefault(tracking.series_row_key(
+            tracking.frame_timestamp(frame_record["RowKey"])), []).append(frame_record)
 
-            values_max_key = sorted(values, key=(
-                lambda key: values[key]), reverse=True)
+    return frames_by_row
 
-            logging.info("Value max key: " + values_max_key[0])
 
-            if values_max_key[0] == "negative":
-                value = - values[values_max_key[0]]
-            elif values_max_key[0] == "neutral":
-                value = 0
-            else:
-                value = values[values_max_key[0]]
+def series_points(frame_records):
+    return [{"timestamp": tracking.frame_timestamp(frame_record["RowKey"]),
+             "file_name": frame_record["FileName"],
+             "value": frame_record["Value"],
+             "persons": frame_record["Persons"],
+             "emotion": json.loads(frame_record["Emotion"])}
+            for frame_record in frame_records]
 
-            logging.info("Value: " + str(value))
 
-            final_report = {"time": dateTime, "value": value, "file-name": fileName,
-                            "persons": qtde_person, "emotion": values}
+def update_derived_rows(table_service, meetingCode, frame_records):
+    # Os agregados por intervalo e os blocos da série compacta tocados pelo lote são gravados juntos
+    frames_by_row = group_by_rollup(frame_records)
+    frames_by_row.update(group_by_series_chunk(frame_records))
 
-            records = table_service.query_entities(
-                TABLE_NAME_TRACKING, filter="PartitionKey eq 'tracking-analysis' and RowKey eq '"+meetingCode+"'")
-            texts_converted = []
+    def apply_frames(row_key, current):
+        if row_key.startswith(tracking.SERIES_ROW_PREFIX):
+            chunk = series.decode_series(
+                current["Series"]) if current is not None else None
 
-            new_record = True
+            return {"Series": series.encode_series(series.merge_points(chunk, series_points(frames_by_row[row_key])))}
 
-            if len(records.items) > 0:
-                record = records.items[0]
+        rollup = current
+        for frame_record in frames_by_row[row_key]:
+            rollup = tracking.add_to_rollup(rollup, frame_record["Value"], frame_record["Persons"],
+                                            json.loads(frame_record["Emotion"]), frame_record["FileName"])
 
-                if "EmotionTimeAnalysis" in records.items[0] and "EmotionCount" in records.items[0]:
-                    new_record = False
+        return rollup
 
-                if "EmotionTimeAnalysis" in records.items[0]:
-                    data_points = json.loads(record["EmotionTimeAnalysis"])
-                    data_points.append(final_report)
+    tracking.update_entities(table_service, TABLE_NAME_TRACKING, meetingCode,
+                             frames_by_row.keys(), apply_frames)
 
-                    file_processeds = json.loads(record["FacialAnalysis"])
-                    file_processeds.append(file_processed)
 
-                if "EmotionCount" in records.items[0]:
-                    emotional_count = json.loads(record["EmotionCount"])
+def frame_record(meetingCode, row_key, fileName, date_time, score):
+    return {"PartitionKey": meetingCode,
+            "RowKey": row_key,
+            "FileName": fileName,
+            "Time": date_time,
+            "Value": score["value"],
+            "Persons": score["persons"],
+            "Emotion": json.dumps(score["emotion"]),
+            "FacialAnalysis": series.encode_faces([item["emotion-analysis"] for item in score["file_processed"]])}
 
-                    emotional_count["positive"] += positive_count
-                    emotional_count["negative"] += negative_count
 
-                    emotional_count_value = emotional_count["positive"] + \
-                        emotional_count["negative"]
+def update_meeting(table_service, meetingCode, meeting_frames, trace=None):
+    # Todas as imagens da reunião no lote: registros por imagem em transações em lote e uma única
+    # atualização do resumo
+    frame_records = []
+    positive_count = 0
+    negative_count = 0
 
-                    logging.info("Emotional Count: " +
-                                 str(emotional_count_value))
+    for frame in meeting_frames:
+        input_message = frame["message"]
+        score = frame["score"]
 
-                    emotional_count["total"] = emotional_count_value
+        timestamp = tracking.to_timestamp(input_message["date-time"])
 
-                    emotional_count["positive_percentage"] = round(
-                        100*emotional_count["positive"]/emotional_count_value, 3)
-                    emotional_count["negative_percentage"] = round(
-                        100*emotional_count["negative"]/emotional_count_value, 3)
+        frame_records.append(frame_record(meetingCode, tracking.frame_row_key(timestamp, input_message["file-name"]),
+                                          input_message["file-name"], input_message["date-time"], score))
 
-            if new_record:
-                record = {"PartitionKey": "tracking-analysis",
-                          "RowKey": meetingCode}
+        positive_count += score["positive_count"]
+        negative_count += score["negative_count"]
 
-                data_points = [final_report]
-                file_processeds = [file_processed]
+    with tracing.span(trace, "frame_write", meetingCode):
+        commit_in_batches(table_service, TABLE_NAME_TRACKING, frame_records)
 
-                emotional_count_total = positive_count + negative_count
+    logging.info("Frames persisted for " + meetingCode +
+                 ": " + str(len(frame_records)))
 
-                if emotional_count_total > 0:
-                    emotional_count = {"positive": positive_count, "negative": negative_count, "total": emotional_count_total, "positive_percentage": round(
-                        100*positive_count/emotional_count_total, 3), "negative_percentage": round(100*negative_count/emotional_count_total, 3)}
-                else:
-                    emotional_count = {"positive": 0, "negative": 0, "total": 0,
-                                       "positive_percentage": 0, "negative_percentage": 0}
+    with tracing.span(trace, "rollup_write", meetingCode):
+        update_derived_rows(table_service, meetingCode, frame_records)
 
-            logging.info("Data points: " + str(data_points))
+    summary = tracking.update_entity(table_service, TABLE_NAME_TRACKING,
+                                     meetingCode, tracking.EMOTION_SUMMARY_ROW,
+                                     lambda summary: merge_emotion_count(
+                                         table_service, meetingCode, summary, positive_count, negative_count),
+                                     trace=trace)
 
-            record["FacialAnalysis"] = json.dumps(file_processeds)
-            record["EmotionTimeAnalysis"] = json.dumps(data_points)
-            record["EmotionCount"] = json.dumps(emotional_count)
+    logging.info("Emotional Count: " + summary["EmotionCount"])
 
-            logging.info(record)
 
-            table_service.insert_or_replace_entity(TABLE_NAME_TRACKING, record)
-    else:
-        logging.info("Item already processed.")
+def rescore_meeting(table_service, meetingCode):
+    # Pontua de novo as imagens de uma reunião a partir das respostas da Face API guardadas no log,
+    # sem chamar a API, e regrava os registros por imagem, os agregados e o resumo de emoções.
+    # Para reuniões encerradas: não concorre com imagens da mesma reunião ainda na fila.
+    api_records = list(table_service.query_entities(TABLE_NAME_API_FACE, filter="PartitionKey eq '" + meetingCode +
+                                                    "' and ApiStatus eq 200", select="RowKey,Time,TextResponse"))
+    faces_by_file = {api_record["RowKey"]: json.loads(api_record["TextResponse"])
+                     for api_record in api_records if "TextResponse" in api_record}
+
+    frame_rows = [frame_row for frame_row in table_service.query_entities(
+        TABLE_NAME_TRACKING, filter=tracking.frame_range_filter(meetingCode), select="RowKey,Time")
+        if tracking.frame_file_name(frame_row["RowKey"]) in faces_by_file]
+
+    # Imagens com faces que ainda não têm registro (o log guarda o horário desde que passou a
+    # registrar Time) são recriadas
+    recorded = set(tracking.frame_file_name(frame_row["RowKey"])
+                   for frame_row in frame_rows)
+
+    frame_rows += [{"RowKey": tracking.frame_row_key(tracking.to_timestamp(api_record["Time"]), api_record["RowKey"]),
+                    "Time": api_record["Time"]}
+                   for api_record in api_records
+                   if "Time" in api_record and api_record["RowKey"] not in recorded and
+                   len(faces_by_file.get(api_record["RowKey"], [])) > 0]
+
+    if len(frame_rows) == 0:
+        logging.info("No frames to rescore for " + meetingCode + ".")
+        return None
+
+    scores = score_frames([(tracking.frame_file_name(frame_row["RowKey"]),
+                            faces_by_file[tracking.frame_file_name(frame_row["RowKey"])])
+                           for frame_row in frame_rows])
+
+    frame_records = [frame_record(meetingCode, frame_row["RowKey"], tracking.frame_file_name(frame_row["RowKey"]),
+                                  frame_row["Time"], score)
+                     for frame_row, score in zip(frame_rows, scores)]
+
+    commit_in_batches(table_service, TABLE_NAME_TRACKING, frame_records)
+
+    # Agregados, série compacta e resumo recalculados do zero com as novas pontuações; a partir
+    # daqui a reunião passa a ser lida da série compacta
+    rollups = []
+    for row_key, records in group_by_rollup(frame_records).items():
+        rollup = None
+        for record in records:
+            rollup = tracking.add_to_rollup(
+                rollup, record["Value"], record["Persons"], json.loads(record["Emotion"]), record["FileName"])
+
+        rollup["PartitionKey"] = meetingCode
+        rollup["RowKey"] = row_key
+        rollups.append(rollup)
+
+    for row_key, records in group_by_series_chunk(frame_records).items():
+        rollups.append({"PartitionKey": meetingCode, "RowKey": row_key,
+                        "Series": series.encode_series(series.merge_points(None, series_points(records)))})
+
+    commit_in_batches(table_service, TABLE_NAME_TRACKING, rollups)
+
+    # As imagens anteriores aos registros por imagem só existem na série antiga do registro principal
+    # (EmotionTimeAnalysis), que continua sendo servida como está; os totais delas, guardados no
+    # mesmo registro, continuam somados ao resumo para que os totais e a série não divirjam
+    legacy_count = {"positive": 0, "negative": 0}
+
+    records = table_service.query_entities(
+        TABLE_NAME_TRACKING, filter="PartitionKey eq 'tracking-analysis' and RowKey eq '"+meetingCode+"'",
+        select="EmotionCount")
+
+    if len(records.items) > 0 and "EmotionCount" in records.items[0]:
+        legacy_count = json.loads(records.items[0]["EmotionCount"])
+
+    emotional_count = update_emotion_count(legacy_count,
+                                           sum(score["positive_count"]
+                                               for score in scores),
+                                           sum(score["negative_count"] for score in scores))
+
+    tracking.update_entity(table_service, TABLE_NAME_TRACKING, meetingCode, tracking.EMOTION_SUMMARY_ROW,
+                           lambda summary: {"EmotionCount": json.dumps(emotional_count),
+                                            "SeriesVersion": series.VERSION})
+
+    logging.info("Rescored " + str(len(frame_records)) + " frames of " + meetingCode +
+                 ". Emotional Count: " + json.dumps(emotional_count))
+
+    return emotional_count
+
+
+def process_batch(input_messages, trace=None):
+    # Example of input
+    # {"blob" : "AT81CB/image_files/AT81CB_9G9C.jpg", "meeting-code" : "AT81CB","file-name":  "AT81CB_9G9C.jpg","date-time": "13/06/2019 10:00"}
+
+    table_service = clients.table_service
+
+    pending = []
+    seen = set()
+
+    for input_message in input_messages:
+        key = (input_message["meeting-code"], input_message["file-name"])
+
+        if key in seen or is_processed(table_service, *key, trace=trace):
+            logging.info("Item already processed: " + key[1])
+        else:
+            seen.add(key)
+            pending.append(input_message)
+
+    if len(pending) == 0:
+        return []
+
+    logging.info("File not processed yet. Starting processing of " +
+                 str(len(pending)) + " files...")
+
+    with ThreadPoolExecutor(max_workers=FACE_API_CONCURRENCY) as executor:
+        results = analyse_frames(pending, executor, trace)
+
+    # Limite ainda excedido após as novas tentativas: essas mensagens voltam para a fila
+    failed = [result["message"] for result in results
+              if result["status"] in cognitive.RETRY_STATUS_CODES]
+
+    meetings = {}
+    scored = []
+
+    for result in results:
+        logging.info("Records found " + str(len(result["faces"])))
+
+        if result["status"] == 200 and len(result["faces"]) > 0:
+            scored.append(result)
+            meetings.setdefault(
+                result["message"]["meeting-code"], []).append(result)
+
+    with tracing.span(trace, "scoring"):
+        scores = score_frames([(result["message"]["file-name"], result["faces"])
+                               for result in scored])
+
+    for result, score in zip(scored, scores):
+        result["score"] = score
+
+    # O log com ApiStatus 200 marca a imagem como processada (is_processed), então o log das imagens
+    # com faces só é gravado depois do registro da reunião: se update_meeting falhar, as imagens dessa
+    # reunião e das seguintes voltam pela fila e são analisadas de novo
+    with tracing.span(trace, "api_log_write"):
+        commit_in_batches(table_service, TABLE_NAME_API_FACE,
+                          [result["api_record"] for result in results
+                           if result["status"] != 200 or len(result["faces"]) == 0])
+
+    for meetingCode, meeting_frames in meetings.items():
+        update_meeting(table_service, meetingCode, meeting_frames, trace)
+
+        with tracing.span(trace, "api_log_write", meetingCode):
+            commit_in_batches(table_service, TABLE_NAME_API_FACE,
+                              [frame["api_record"] for frame in meeting_frames])
+
+    for result in results:
+        if result["status"] == 200:
+            processed_index.add(
+                result["message"]["meeting-code"], result["message"]["file-name"])
+
+    return failed
+
+
+def process_message(msg, trace):
+    logging.info("Processing image analysis queue...")
+
+    with trace.span("decode"):
+        input_message = msg.get_body().decode('utf-8')
+
+        logging.info(input_message)
+
+        input_message = json.loads(input_message)
+
+    trace.meeting_code = input_message["meeting-code"]
+
+    pulled = receive_batch(trace)
+
+    failed = process_batch(
+        [input_message] + [message for _, message in pulled], trace)
+
+    # As mensagens retiradas da fila só são removidas depois de processadas; as que falharam
+    # reaparecem quando o visibility timeout expirar
+    for queue_message, message in pulled:
+        if message not in failed:
+            try:
+                with trace.span("queue_delete", message["meeting-code"]):
+                    clients.queue_service.delete_message(
+                        QUEUE_NAME, queue_message.id, queue_message.pop_receipt)
+            except AzureMissingResourceHttpError:
+                # O visibility timeout expirou durante o lote e outra instância pegou a mensagem;
+                # ela será descartada como já processada
+                logging.warning("Message " + queue_message.id +
+                                " was received again before being deleted.")
+
+    if input_message in failed:
+        raise Exception("Face API throttled, message returned to the queue.")
+
+
+@profiling.profile("queueImaging")
+@clients.track_connection_reuse
+def main(msg: func.QueueMessage) -> None:
+    # Tempos de cada etapa registrados em log estruturado e nos histogramas por reunião; as etapas
+    # das imagens do lote são atribuídas à reunião de cada imagem
+    trace = tracing.Trace("queueImaging", message_id=msg.id)
+
+    try:
+        process_message(msg, trace)
+    finally:
+        trace.finish()
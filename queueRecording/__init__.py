@@ -1,121 +1,466 @@
 import logging
 import azure.functions as func
-from azure.storage.blob.blockblobservice import BlockBlobService
-from azure.storage.table import TableService, Entity
-import nltk
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
 import time
-from datetime import datetime
 import os
+import re
 import json
-import requests
 import base64
 import traceback
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from azure.common import AzureMissingResourceHttpError
+from azure.storage.table import TableBatch
+from ..shared_code import audio, clients, cognitive, processed, profiling, tracing, tracking, wordcloud
 
-nltk.data.path.append(os.path.dirname(os.path.abspath(__file__)))
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-ACCOUNT_NAME = os.environ["STORAGE_ACCOUNT_NAME"]
-ACCOUNT_KEY = os.environ["STORAGE_ACCOUNT_KEY"]
-
-SPEECH2TEXT_API_KEY = os.environ["AI_API_KEY"]
 CONTAINER_NAME = os.environ["CONTAINER_NAME_RECORDING"]
 
 TABLE_NAME_TRACKING = os.environ["TABLE_NAME_TRACKING"]
 TABLE_NAME_API_T2S = os.environ["TABLE_NAME_API_T2S"]
 
-AI_API_REGION = os.environ["AI_API_REGION"]
+# Tamanho de cada leitura do blob de áudio
+BLOB_RANGE_BYTES = int(os.environ.get("BLOB_RANGE_BYTES", str(256 * 1024)))
 
+# O endpoint de áudio curto aceita até 60 segundos: gravações maiores são divididas em trechos de
+# até STT_SEGMENT_SECONDS, cortados no ponto mais silencioso dos últimos STT_SILENCE_SEARCH_SECONDS
+STT_SEGMENT_SECONDS = float(os.environ.get("STT_SEGMENT_SECONDS", "50"))
+STT_SILENCE_SEARCH_SECONDS = float(
+    os.environ.get("STT_SILENCE_SEARCH_SECONDS", "10"))
+STT_MAX_CONCURRENCY = int(os.environ.get("STT_MAX_CONCURRENCY", "4"))
 
-def processar_palavra_chave(lista_frase):
-    stopwords = nltk.corpus.stopwords.words("portuguese")
-    lista_palavras = []
+# Detecção de fala antes do envio (shared_code/audio.py): trechos sem fala não são enviados e o
+# silêncio do início e do fim dos demais é cortado
+STT_VAD = os.environ.get("STT_VAD", "true").lower() == "true"
 
-    for frase in lista_frase:
-        palavras = word_tokenize(frase)
-        for palavra in palavras:
-            if palavra.isalpha() and len(palavra) > 1:
-                lista_palavras.append(palavra.lower())
+# Arquivos cuja transcrição já foi gravada no log da API e contada no tracking
+processed_index = processed.ProcessedIndex(TABLE_NAME_API_T2S)
 
-    lista_palavras = [
-        palavra for palavra in lista_palavras if palavra not in stopwords]
-    fdist = nltk.FreqDist(lista_palavras)
-    json_data = json.dumps(fdist)
+# "regex" (padrão) não importa o NLTK; "nltk" usa o word_tokenize e o corpus de stopwords do NLTK,
+# importado somente nesse caso
+NLP_BACKEND = os.environ.get("NLP_BACKEND", "regex").lower()
 
-    print(json_data)
+# Sequências somente de letras que não fazem parte de um token maior ("guarda-chuva", "abc123");
+# apóstrofos e aspas separam palavras ("'legal'", "João's"). Aproxima o word_tokenize filtrado por
+# isalpha(), mas não separa as contrações do inglês ("cannot", "gonna", "don't" dá "don") e guarda a
+# palavra depois de uma elisão ("d'água" dá "água"), que o word_tokenize descarta inteira
+PALAVRA_RE = re.compile(r"(?<![\w-])[^\W\d_]{2,}(?![\w-])")
 
-    return json_data
+_word_tokenize = None
 
 
-def main(msg: func.QueueMessage) -> None:
+def carregar_stopwords():
+    # Lista do NLTK distribuída junto com a function, lida direto do arquivo
+    if NLP_BACKEND != "nltk":
+        try:
+            with open(os.path.join(BASE_DIR, "corpora", "stopwords", "portuguese"), encoding="utf-8") as arquivo:
+                return frozenset(linha.strip().lower() for linha in arquivo if linha.strip())
+        except OSError:
+            logging.warning("Stopwords file not found, loading from NLTK...")
 
-    logging.info("Processing audio analysis queue...")
+    import nltk
+    if BASE_DIR not in nltk.data.path:
+        nltk.data.path.append(BASE_DIR)
 
-    stopwords = nltk.corpus.stopwords.words("portuguese")
+    return frozenset(nltk.corpus.stopwords.words("portuguese"))
 
-    input_message = msg.get_body().decode('utf-8')
 
-    logging.info(input_message)
+def tokenizar(frase):
+    global _word_tokenize
 
-    input_message = json.loads(input_message)
+    if NLP_BACKEND != "nltk":
+        return PALAVRA_RE.findall(frase)
 
-    logging.info("Processing file " + input_message["blob"] + "...")
+    if _word_tokenize is None:
+        import nltk
+        if BASE_DIR not in nltk.data.path:
+            nltk.data.path.append(BASE_DIR)
+
+        _word_tokenize = nltk.tokenize.word_tokenize
+
+    return [palavra for palavra in _word_tokenize(frase) if palavra.isalpha() and len(palavra) > 1]
+
+
+STOPWORDS = carregar_stopwords()
+
+
+def contar_palavras(frase, stopwords):
+    contagem = Counter()
+
+    for palavra in tokenizar(frase):
+        palavra = palavra.lower()
+        if palavra not in stopwords:
+            contagem[palavra] += 1
+
+    return contagem
+
+
+def processar_palavra_chave(lista_frase, stopwords):
+    fdist = Counter()
+
+    for frase in lista_frase:
+        fdist.update(contar_palavras(frase, stopwords))
+
+    return fdist
+
+
+def serializar_freq_dist(fdist):
+    # Somente contagens positivas, das mais frequentes para as menos frequentes
+    return json.dumps(dict((+fdist).most_common()), separators=(",", ":"))
+
+
+def text_checksum(text):
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def merge_transcript(record, text_converted, stopwords, additional_stop_words, previous_text=None):
+    # O registro principal guarda só o índice {arquivo: [timestamp, crc32 do texto]}; cada transcrição
+    # fica no próprio registro "transcript-...". previous_text(timestamp, arquivo) lê a transcrição
+    # de um arquivo já contado, necessária apenas se o texto mudou.
+    index = {}
+    legacy_texts = {}
+    freq_dist = None
+
+    if record is not None:
+        if "TranscriptIndex" in record:
+            index = json.loads(record["TranscriptIndex"])
+        elif record.get("TextConverted"):
+            # Registros anteriores ao índice: as transcrições da lista (já gravadas em registros
+            # próprios por write_transcripts, sem horário) entram no índice com timestamp 0
+            legacy_texts = {item["file-name"]: item["text"]
+                            for item in json.loads(record["TextConverted"])}
+            index = {file_name: [0, text_checksum(text)]
+                     for file_name, text in legacy_texts.items()}
+        if "FreqDist" in record:
+            freq_dist = Counter(json.loads(record["FreqDist"]))
+
+    if freq_dist is None:
+        # Registros sem FreqDist: reconstrói uma única vez a partir das transcrições salvas
+        freq_dist = processar_palavra_chave(
+            set(legacy_texts.values()), stopwords)
+
+    file_name = text_converted["file-name"]
+    checksum = text_checksum(text_converted["text"])
+    entry = index.get(file_name)
+
+    # Apenas o texto novo é tokenizado; um arquivo reprocessado tem a contagem anterior removida antes
+    if entry is None:
+        index[file_name] = [text_converted["timestamp"], checksum]
+        freq_dist.update(contar_palavras(text_converted["text"], stopwords))
+    elif entry[1] != checksum:
+        if file_name in legacy_texts:
+            previous = legacy_texts[file_name]
+        else:
+            previous = previous_text(entry[0], file_name)
+
+        freq_dist.subtract(contar_palavras(previous, stopwords))
+        entry[1] = checksum
+        freq_dist.update(contar_palavras(text_converted["text"], stopwords))
+    elif len(legacy_texts) == 0:
+        logging.info("Text already counted for this file.")
+        return None
+
+    # O ranking da nuvem de palavras é materializado junto com o FreqDist, para que o getWordCloud
+    # não precise percorrer o vocabulário inteiro a cada requisição
+    ranking = wordcloud.rank_words(
+        freq_dist, additional_stop_words, wordcloud.WORD_CLOUD_MAX_WORDS)
+
+    # Somente as propriedades desta function são enviadas no merge
+    changes = {"TranscriptIndex": json.dumps(index, separators=(",", ":")),
+               "FreqDist": serializar_freq_dist(freq_dist),
+               "WordCloud": wordcloud.serialize_ranking(ranking)}
+
+    if len(legacy_texts) > 0:
+        # A lista antiga deixa de ser lida depois que o índice existe
+        changes["TextConverted"] = ""
+
+    return changes
+
+
+def write_transcripts(table_service, meeting_code, transcripts):
+    # transcripts: dicts com timestamp, file-name e text; gravações idempotentes, em lotes
+    rows = [{"PartitionKey": meeting_code,
+             "RowKey": tracking.transcript_row_key(item["timestamp"], item["file-name"]),
+             "FileName": item["file-name"],
+             "Text": item["text"]}
+            for item in transcripts]
+
+    for start in range(0, len(rows), tracking.TABLE_BATCH_SIZE):
+        batch = TableBatch()
+
+        for row in rows[start:start + tracking.TABLE_BATCH_SIZE]:
+            batch.insert_or_replace_entity(row)
+
+        table_service.commit_batch(TABLE_NAME_TRACKING, batch)
+
+
+def read_transcript(table_service, meeting_code, timestamp, file_name):
+    try:
+        return table_service.get_entity(TABLE_NAME_TRACKING, meeting_code,
+                                        tracking.transcript_row_key(timestamp, file_name), select="Text")["Text"]
+    except AzureMissingResourceHttpError:
+        logging.warning("Transcript of " + file_name + " not found.")
+        return ""
+
+
+def count_transcript(table_service, meeting_code, text_converted, additional_stop_words, trace):
+    # A contagem e o índice são atualizados juntos (merge condicionado ao ETag); a transcrição é
+    # gravada depois, de modo que uma nova entrega da mensagem após uma falha apenas a grava de novo
+    def apply_transcript(record):
+        if record is not None and "TranscriptIndex" not in record and record.get("TextConverted"):
+            write_transcripts(table_service, meeting_code,
+                              [dict(item, timestamp=0) for item in json.loads(record["TextConverted"])])
+
+        return merge_transcript(record, text_converted, STOPWORDS, additional_stop_words,
+                                lambda timestamp, file_name: read_transcript(table_service, meeting_code,
+                                                                             timestamp, file_name))
+
+    record = tracking.update_entity(table_service, TABLE_NAME_TRACKING,
+                                    tracking.TRACKING_PARTITION, meeting_code, apply_transcript,
+                                    select="TranscriptIndex,TextConverted,FreqDist", trace=trace)
+
+    # Um arquivo já indexado mantém o horário da primeira gravação
+    timestamp = json.loads(record["TranscriptIndex"])[
+        text_converted["file-name"]][0]
+
+    with trace.span("transcript_write"):
+        write_transcripts(table_service, meeting_code,
+                          [dict(text_converted, timestamp=timestamp)])
+
+
+def rebuild_transcripts(table_service, meeting_code):
+    # Refaz as transcrições, o índice, a contagem de palavras e a nuvem de uma reunião a partir das
+    # transcrições guardadas no log da API (TABLE_NAME_API_T2S), sem chamar a API de fala. Para
+    # reuniões encerradas: não concorre com áudios da mesma reunião ainda na fila.
+    api_records = table_service.query_entities(TABLE_NAME_API_T2S, filter="PartitionKey eq '" + meeting_code +
+                                               "' and RecognitionStatus eq 'Success'",
+                                               select="RowKey,Time,TextConverted,ApiResponse")
+
+    try:
+        record = table_service.get_entity(TABLE_NAME_TRACKING, tracking.TRACKING_PARTITION, meeting_code,
+                                          select="TranscriptIndex")
+        index = json.loads(record.get("TranscriptIndex", "{}"))
+    except AzureMissingResourceHttpError:
+        index = {}
+
+    transcripts = []
+
+    for api_record in api_records:
+        text = api_record.get("TextConverted")
+        if text is None:
+            text = json.loads(api_record["ApiResponse"]).get("DisplayText", "")
+
+        # Horário do log; nos registros anteriores a ele, o do índice (ou 0, como na migração da lista)
+        if "Time" in api_record:
+            timestamp = tracking.to_timestamp(api_record["Time"])
+        else:
+            timestamp = index.get(api_record["RowKey"], [0])[0]
+
+        transcripts.append({"file-name": api_record["RowKey"],
+                            "text": text, "timestamp": timestamp})
+
+    if len(transcripts) == 0:
+        logging.info("No transcripts to rebuild for " + meeting_code + ".")
+        return None
+
+    write_transcripts(table_service, meeting_code, transcripts)
 
-    table_service = TableService(
-        account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY)
-    records = table_service.query_entities(TABLE_NAME_API_T2S, filter="PartitionKey eq 'recording' and RowKey eq '" +
-                                           input_message["meeting-code"] + "' and RecognitionStatus eq 'Success'")
+    # Registros de transcrição que não correspondem mais a nenhum arquivo do log (horário mudou)
+    row_keys = set(tracking.transcript_row_key(item["timestamp"], item["file-name"])
+                   for item in transcripts)
+    stale = [row["RowKey"] for row in table_service.query_entities(
+        TABLE_NAME_TRACKING, filter=tracking.transcript_range_filter(meeting_code), select="RowKey")
+        if row["RowKey"] not in row_keys]
 
-    if len(records.items) == 0:
-        blob_service = BlockBlobService(
-            account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY)
-        blob_entry = blob_service.get_blob_to_bytes(
-            CONTAINER_NAME, input_message["blob"], timeout=60)
-        audio_bytes = blob_entry.content
+    for start in range(0, len(stale), tracking.TABLE_BATCH_SIZE):
+        batch = TableBatch()
 
-        url_token_api = "https://"+AI_API_REGION + \
-            ".api.cognitive.microsoft.com/sts/v1.0/issueToken"
-        api_key = SPEECH2TEXT_API_KEY
+        for row_key in stale[start:start + tracking.TABLE_BATCH_SIZE]:
+            batch.delete_entity(meeting_code, row_key)
 
-        headers = {"Content-Length": "0", "Ocp-Apim-Subscription-Key": api_key}
+        table_service.commit_batch(TABLE_NAME_TRACKING, batch)
 
-        start_time = datetime.now()
+    _, additional_stop_words = wordcloud.get_stopwords(table_service)
 
-        api_response = requests.post(url_token_api, headers=headers)
-        access_token = str(api_response.content.decode('utf-8'))
+    freq_dist = processar_palavra_chave(
+        [item["text"] for item in transcripts], STOPWORDS)
+    ranking = wordcloud.rank_words(
+        freq_dist, additional_stop_words, wordcloud.WORD_CLOUD_MAX_WORDS)
 
-        url_stt_api = "https://"+AI_API_REGION + \
-            ".stt.speech.microsoft.com/speech/recognition/conversation/cognitiveservices/v1?language=pt-BR"
+    changes = {"TranscriptIndex": json.dumps({item["file-name"]: [item["timestamp"], text_checksum(item["text"])]
+                                              for item in transcripts}, separators=(",", ":")),
+               "FreqDist": serializar_freq_dist(freq_dist),
+               "WordCloud": wordcloud.serialize_ranking(ranking),
+               "TextConverted": ""}
+
+    tracking.update_entity(table_service, TABLE_NAME_TRACKING, tracking.TRACKING_PARTITION, meeting_code,
+                           lambda record: changes)
+
+    logging.info("Rebuilt " + str(len(transcripts)) + " transcripts of " + meeting_code + ".")
+
+    return {"transcripts": len(transcripts), "words": sum((+freq_dist).values())}
+
+
+def recognize(data, sample_rate):
+    # O token fica em cache entre mensagens; se for recusado, é renovado e a chamada refeita uma vez
+    for attempt in range(2):
+        access_token = cognitive.get_speech_token()
 
         headers = {"Authorization": "Bearer {0}".format(access_token),
-                   "Content-Length": str(len(audio_bytes)),
                    "Content-type": "audio/wav",
                    "codec": "audio/pcm",
-                   "samplerate": "16000"}
+                   "samplerate": str(sample_rate)}
+
+        # Com um gerador como corpo, o requests envia com Transfer-Encoding: chunked
+        api_response = cognitive.post(
+            "speech", cognitive.URL_STT_API, headers=headers, params=None, data=data)
+
+        logging.info(api_response)
+
+        if api_response.status_code != 401:
+            break
+
+        cognitive.invalidate_speech_token(access_token)
+
+    if api_response.status_code in cognitive.RETRY_STATUS_CODES:
+        # Limite ainda excedido após as novas tentativas: a mensagem volta para a fila
+        return {"RecognitionStatus": "Throttled", "Message": "Speech API throttled (" + str(api_response.status_code) + ")."}
+
+    return json.loads(api_response.content.decode('utf-8'))
+
+
+def stream_wav(wav_header, reader):
+    # A cada nova tentativa o envio recomeça logo após o cabeçalho
+    reader.rewind(len(wav_header))
+
+    yield wav_header
+
+    for chunk in reader.iter_chunks():
+        yield chunk
+
+
+def stitch_segments(results):
+    # Une os trechos reconhecidos, na ordem do áudio, em um único resultado
+    texts = [result["DisplayText"] for result in results
+             if result.get("RecognitionStatus") == "Success" and result.get("DisplayText")]
+
+    res_json = {"Segments": results}
+
+    if len(texts) > 0:
+        res_json["RecognitionStatus"] = "Success"
+        res_json["DisplayText"] = " ".join(texts)
+    else:
+        res_json["RecognitionStatus"] = results[0].get(
+            "RecognitionStatus", "Request Fail")
+
+    for result in results:
+        if "Message" in result:
+            res_json["Message"] = result["Message"]
+
+    return res_json
+
+
+def speech_segments(segments, wav_format, usage):
+    # Descarta os trechos sem fala e corta o silêncio das pontas dos demais, somando em usage os
+    # bytes de áudio lidos e enviados
+    for segment in segments:
+        usage["AudioBytes"] += len(segment)
+
+        bounds = audio.speech_bounds(segment, wav_format)
+
+        if bounds is None:
+            usage["VadSegmentsSkipped"] += 1
+            continue
+
+        usage["AudioBytesSent"] += bounds[1] - bounds[0]
+
+        yield segment[bounds[0]:bounds[1]]
+
+
+def speech_to_text(reader, wav_format, wav_header, usage=None):
+    short = wav_format is None or reader.remaining <= audio.segment_bytes(
+        wav_format, STT_SEGMENT_SECONDS)
+
+    if wav_format is None or short and usage is None:
+        sample_rate = wav_format["sample_rate"] if wav_format is not None else 16000
+
+        return recognize(lambda: stream_wav(wav_header, reader), sample_rate)
+
+    if not short:
+        logging.info("Long recording, splitting at silence boundaries...")
+
+    # Uma gravação curta é um único trecho
+    segments = audio.split_at_silence(
+        reader.iter_chunks(), wav_format, STT_SEGMENT_SECONDS, STT_SILENCE_SEARCH_SECONDS)
+
+    if usage is not None:
+        segments = speech_segments(segments, wav_format, usage)
+
+    # Cada trecho é enviado assim que lido do blob; os resultados são recolhidos na ordem original
+    with ThreadPoolExecutor(max_workers=STT_MAX_CONCURRENCY) as executor:
+        futures = [executor.submit(recognize, audio.to_wav(segment, wav_format),
+                                   wav_format["sample_rate"])
+                   for segment in segments]
+        results = [future.result() for future in futures]
+
+    if len(results) == 0:
+        logging.info("No speech detected, speech to text skipped.")
+
+        return {"RecognitionStatus": "NoSpeech", "DisplayText": ""}
+
+    logging.info("Recognized " + str(len(results)) + " segments.")
+
+    return results[0] if short else stitch_segments(results)
+
+
+def transcribe(input_message, table_service, trace):
+    # O áudio é lido do blob por intervalos, sem carregar o arquivo inteiro na memória
+    reader = audio.BlobRangeReader(
+        clients.blob_service, CONTAINER_NAME, input_message["blob"], BLOB_RANGE_BYTES)
+
+    try:
+        wav_format, wav_header = audio.read_wav_header(reader)
+
+        # Falhas ao obter o token devolvem a mensagem para a fila
+        with trace.span("token_fetch"):
+            cognitive.get_speech_token()
 
         record = {}
-        api_response = None
         res_json = None
 
-        try:
-            api_response = requests.post(
-                url_stt_api, headers=headers, params=None, data=audio_bytes)
+        # Bytes de áudio lidos e enviados e trechos descartados pela detecção de fala
+        usage = {"AudioBytes": 0, "AudioBytesSent": 0,
+                 "VadSegmentsSkipped": 0} if STT_VAD and wav_format is not None else None
 
-            end_time = datetime.now()
-            api_time = end_time - start_time
+        # O tempo da API não inclui a obtenção do token; inclui as leituras do blob feitas
+        # durante o envio em streaming (também somadas em blob_download)
+        start_time = time.perf_counter()
 
-            logging.info(api_response)
+        try:
+            res_json = speech_to_text(
+                reader, wav_format, wav_header, usage)
 
-            res_json = json.loads(api_response.content.decode('utf-8'))
+            api_seconds = time.perf_counter() - start_time
+            trace.add("ai_call", api_seconds)
 
             record["RecognitionStatus"] = res_json["RecognitionStatus"]
             record["TextConverted"] = res_json["DisplayText"]
             record["ApiResponse"] = json.dumps(res_json)
-            record["ApiTimeResponseSeconds"] = api_time.seconds
+            record["ApiTimeResponseSeconds"] = round(api_seconds, 3)
+
+            if usage is not None:
+                record.update(usage)
+                record["VadBytesSaved"] = usage["AudioBytes"] - \
+                    usage["AudioBytesSent"]
+                record["VadSkipped"] = usage["AudioBytesSent"] == 0
 
             logging.info("Speech to text processed.")
 
         except Exception as error:
+            trace.add("ai_call", time.perf_counter() -
+                      start_time, failed=True)
+
             record["RecognitionStatus"] = "Request Fail"
             record["Exception"] = traceback.format_exc()
 
@@ -124,67 +469,89 @@ def main(msg: func.QueueMessage) -> None:
         finally:
             record["PartitionKey"] = input_message["meeting-code"]
             record["RowKey"] = input_message["file-name"]
-            table_service.insert_or_replace_entity(
-                TABLE_NAME_API_T2S, record)
+            record["Time"] = input_message["date-time"]
+
+            with trace.span("api_log_write"):
+                table_service.insert_or_replace_entity(
+                    TABLE_NAME_API_T2S, record)
 
             logging.info("Result persisted.")
+    finally:
+        trace.add("blob_download", reader.fetch_seconds)
 
-        logging.info("Result:" + str(res_json))
+    logging.info("Result:" + str(res_json))
 
-        if res_json is not None and "Message" in res_json:
-            raise Exception(res_json["Message"])
+    if res_json is not None and "Message" in res_json:
+        raise Exception(res_json["Message"])
 
-        if res_json is not None and res_json["RecognitionStatus"] == "Success":
-            logging.info("Decoded speech: "+str(res_json["DisplayText"]))
+    return res_json
 
-            records = table_service.query_entities(
-                TABLE_NAME_TRACKING, filter="PartitionKey eq 'tracking-analysis' and RowKey eq '"+input_message["meeting-code"]+"'")
-            texts_converted = []
 
-            if len(records.items) > 0:
-                record = records.items[0]
-                if "TextConverted" in records.items[0]:
-                    texts_converted = json.loads(record["TextConverted"])
-                    text_converted = {
-                        "file-name": input_message["file-name"], "text": res_json["DisplayText"]}
+def process_message(msg, trace):
 
-                    if text_converted not in texts_converted:
-                        texts_converted.append(text_converted)
+    logging.info("Processing audio analysis queue...")
 
-                    record["TextConverted"] = json.dumps(texts_converted)
-                else:
-                    text_converted = {
-                        "file-name": input_message["file-name"], "text": res_json["DisplayText"]}
-                    texts_converted.append(text_converted)
+    with trace.span("decode"):
+        input_message = msg.get_body().decode('utf-8')
 
-                    record["TextConverted"] = json.dumps(texts_converted)
-            else:
-                text_converted = {
-                    "file-name": input_message["file-name"], "text": res_json["DisplayText"]}
-                texts_converted.append(text_converted)
-                record = {"PartitionKey": "tracking-analysis",
-                          "RowKey": input_message["meeting-code"], "TextConverted": json.dumps(texts_converted)}
+        logging.info(input_message)
 
-            text_list = []
+        input_message = json.loads(input_message)
 
-            for text_converted in texts_converted:
-                text_list.append(text_converted["text"])
+    meeting_code = trace.meeting_code = input_message["meeting-code"]
+    file_name = input_message["file-name"]
 
-            logging.info("Text List: " + str(text_list))
+    if processed_index.seen(meeting_code, file_name):
+        logging.info("Item already processed.")
+        return
 
-            text_list = set(text_list)
-            freq_dist = processar_palavra_chave(text_list)
+    logging.info("Processing file " + input_message["blob"] + "...")
 
-            record["FreqDist"] = freq_dist
+    table_service = clients.table_service
 
-            table_service.insert_or_replace_entity(TABLE_NAME_TRACKING, record)
+    with trace.span("dedup_query"):
+        api_record = processed_index.lookup(table_service, meeting_code, file_name,
+                                            select="RecognitionStatus,TextConverted")
 
-            logging.info("Message processed successfully:" +
-                         str(res_json["DisplayText"]))
+    if api_record is not None and api_record.get("RecognitionStatus") == "Success":
+        # A transcrição já foi gravada: a fala não é reconhecida de novo, apenas a contagem no
+        # tracking é conferida (caso a execução anterior tenha falhado antes de gravá-la)
+        logging.info("Speech already recognized, skipping speech to text.")
 
-        else:
-            print("Descartado por falha no reconhecimento de voz.")
-            logging.info(
-                "Item discarded. Bad quality or audio file corrupted.")
+        res_json = {"RecognitionStatus": "Success",
+                    "DisplayText": api_record.get("TextConverted", "")}
     else:
-        logging.info("Item already processed.")
+        res_json = transcribe(input_message, table_service, trace)
+
+    if res_json is not None and res_json["RecognitionStatus"] == "Success":
+        logging.info("Decoded speech: "+str(res_json["DisplayText"]))
+
+        text_converted = {"file-name": file_name, "text": res_json["DisplayText"],
+                          "timestamp": tracking.to_timestamp(input_message["date-time"])}
+
+        _, additional_stop_words = wordcloud.get_stopwords(table_service)
+
+        count_transcript(table_service, meeting_code,
+                         text_converted, additional_stop_words, trace)
+
+        processed_index.add(meeting_code, file_name)
+
+        logging.info("Message processed successfully:" +
+                     str(res_json["DisplayText"]))
+
+    else:
+        print("Descartado por falha no reconhecimento de voz.")
+        logging.info(
+            "Item discarded. Bad quality or audio file corrupted.")
+
+
+@profiling.profile("queueRecording")
+@clients.track_connection_reuse
+def main(msg: func.QueueMessage) -> None:
+    # Tempos de cada etapa registrados em log estruturado e nos histogramas por reunião
+    trace = tracing.Trace("queueRecording", message_id=msg.id)
+
+    try:
+        process_message(msg, trace)
+    finally:
+        trace.finish()
@@ -0,0 +1,264 @@
+import io
+import os
+import struct
+import time
+import wave
+import numpy as np
+
+# Leitura do WAV direto do blob, por intervalos, divisão de gravações longas em trechos de silêncio e
+# detecção de fala (VAD) para não enviar silêncio ao reconhecimento
+
+# Janela usada para medir a energia do áudio ao procurar um ponto de corte e ao detectar fala
+FRAME_MILLISECONDS = 20
+
+# Uma janela tem fala quando a energia RMS passa de VAD_MIN_RMS (em amostras de 16 bits) e de
+# VAD_ENERGY_RATIO vezes o ruído de fundo, com taxa de cruzamentos por zero até VAD_MAX_ZCR (acima
+# disso é chiado, não voz). O ruído de fundo é a menor energia média em VAD_NOISE_WINDOW_MS.
+VAD_MIN_RMS = float(os.environ.get("VAD_MIN_RMS", "200"))
+VAD_MAX_ZCR = float(os.environ.get("VAD_MAX_ZCR", "0.35"))
+VAD_MIN_SPEECH_MS = int(os.environ.get("VAD_MIN_SPEECH_MS", "200"))
+VAD_PADDING_MS = int(os.environ.get("VAD_PADDING_MS", "300"))
+VAD_ENERGY_RATIO = 3
+VAD_NOISE_WINDOW_MS = 200
+
+
+class BlobRangeReader:
+    # Lê um blob em intervalos de range_bytes; o tamanho total é conhecido após a primeira leitura
+
+    def __init__(self, blob_service, container_name, blob_name, range_bytes, timeout=60):
+        self.blob_service = blob_service
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.range_bytes = range_bytes
+        self.timeout = timeout
+
+        self.size = None
+        self.position = 0
+        self.fetch_seconds = 0
+        self._next_range = 0
+        self._buffer = b""
+        self._etag = None
+
+    def _fetch(self):
+        if self.size is not None and self._next_range >= self.size:
+            return False
+
+        # O ETag da primeira leitura garante que todos os intervalos venham da mesma versão do blob
+        started = time.perf_counter()
+        blob = self.blob_service.get_blob_to_bytes(
+            self.container_name, self.blob_name,
+            start_range=self._next_range, end_range=self._next_range + self.range_bytes - 1,
+            if_match=self._etag, max_connections=1, timeout=self.timeout)
+        self.fetch_seconds += time.perf_counter() - started
+
+        if self.size is None:
+            content_range = blob.properties.content_range
+            if content_range:
+                self.size = int(content_range.split("/")[1])
+            else:
+                self.size = len(blob.content)
+            self._etag = blob.properties.etag
+
+        self._next_range += len(blob.content)
+        self._buffer += blob.content
+
+        return len(blob.content) > 0
+
+    def read(self, size):
+        while len(self._buffer) < size and self._fetch():
+            pass
+
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self.position += len(data)
+
+        return data
+
+    def rewind(self, position):
+        if position == self.position:
+            return
+
+        self.position = position
+        self._next_range = position
+        self._buffer = b""
+
+    @property
+    def remaining(self):
+        if self.size is None:
+            self._fetch()
+
+        return self.size - self.position
+
+    def iter_chunks(self):
+        if self._buffer:
+            data = self._buffer
+            self._buffer = b""
+            self.position += len(data)
+            yield data
+
+        while self._fetch():
+            data = self._buffer
+            self._buffer = b""
+            self.position += len(data)
+            yield data
+
+
+def read_wav_header(reader):
+    # Consome o cabeçalho RIFF até o início do chunk "data".
+    # Retorna (formato, bytes do cabeçalho) ou (None, bytes lidos) se não for um WAV PCM reconhecido.
+    header = reader.read(12)
+
+    if len(header) < 12 or header[0:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None, header
+
+    wav_format = None
+
+    while True:
+        chunk_header = reader.read(8)
+        header += chunk_header
+
+        if len(chunk_header) < 8:
+            return None, header
+
+        chunk_id = chunk_header[0:4]
+        chunk_size = struct.unpack("<I", chunk_header[4:8])[0]
+
+        if chunk_id == b"data":
+            if wav_format is None:
+                return None, header
+
+            return wav_format, header
+
+        # Chunks com tamanho ímpar têm um byte de preenchimento
+        chunk = reader.read(chunk_size + (chunk_size % 2))
+        header += chunk
+
+        if chunk_id == b"fmt ":
+            audio_format, channels, sample_rate, byte_rate, block_align, bits_per_sample = struct.unpack(
+                "<HHIIHH", chunk[0:16])
+
+            if audio_format == 1 and bits_per_sample == 16:
+                wav_format = {"channels": channels,
+                              "sample_rate": sample_rate,
+                              "byte_rate": byte_rate,
+                              "block_align": block_align}
+
+
+def segment_bytes(wav_format, seconds):
+    return int(seconds * wav_format["sample_rate"]) * wav_format["block_align"]
+
+
+def pcm_frames(pcm, wav_format):
+    # Janelas de FRAME_MILLISECONDS (uma por linha), com os canais misturados
+    # Uma leitura truncada pode terminar no meio de um bloco de amostras (até com tamanho ímpar),
+    # que é descartado
+    samples_per_frame = wav_format["sample_rate"] * FRAME_MILLISECONDS // 1000
+    block_align = wav_format["block_align"]
+    samples = np.frombuffer(pcm, dtype="<i2", count=(
+        len(pcm) - len(pcm) % block_align) // 2)
+    samples = samples.reshape(-1, wav_format["channels"]).mean(axis=1)
+
+    n_frames = len(samples) // samples_per_frame
+
+    return samples[:n_frames * samples_per_frame].reshape(n_frames, samples_per_frame)
+
+
+def frame_energy(pcm, wav_format):
+    # Energia RMS de cada janela de FRAME_MILLISECONDS
+    return np.sqrt(np.mean(pcm_frames(pcm, wav_format) ** 2, axis=1))
+
+
+def zero_crossing_rate(frames):
+    # Fração das amostras vizinhas com sinais diferentes, sem o nível DC da janela
+    centered = frames - frames.mean(axis=1, keepdims=True)
+
+    return np.mean(np.signbit(centered[:, 1:]) != np.signbit(centered[:, :-1]), axis=1)
+
+
+def speech_frames(pcm, wav_format):
+    frames = pcm_frames(pcm, wav_format)
+
+    if len(frames) == 0:
+        return np.zeros(0, dtype=bool)
+
+    energy = np.sqrt(np.mean(frames ** 2, axis=1))
+
+    window = max(1, min(len(energy), VAD_NOISE_WINDOW_MS // FRAME_MILLISECONDS))
+    noise_floor = np.convolve(energy, np.ones(window) / window, mode="valid").min()
+
+    # Sem nenhum trecho bem mais baixo que o resto (som contínuo, sem pausa) não há como estimar o
+    # ruído, e vale somente o limite absoluto
+    threshold = VAD_MIN_RMS
+    if VAD_ENERGY_RATIO * noise_floor < np.percentile(energy, 95):
+        threshold = max(threshold, VAD_ENERGY_RATIO * noise_floor)
+
+    return (energy > threshold) & (zero_crossing_rate(frames) <= VAD_MAX_ZCR)
+
+
+def speech_bounds(pcm, wav_format):
+    # Intervalo (em bytes, alinhado ao bloco de amostras) entre a primeira e a última janela com fala,
+    # com VAD_PADDING_MS de margem; None se não houver ao menos VAD_MIN_SPEECH_MS de fala
+    speech = speech_frames(pcm, wav_format)
+
+    if speech.sum() * FRAME_MILLISECONDS < VAD_MIN_SPEECH_MS:
+        return None
+
+    indexes = np.flatnonzero(speech)
+    frame_bytes = segment_bytes(wav_format, FRAME_MILLISECONDS / 1000)
+    padding = segment_bytes(wav_format, VAD_PADDING_MS / 1000)
+
+    start = max(0, int(indexes[0]) * frame_bytes - padding)
+    end = min(len(pcm), (int(indexes[-1]) + 1) * frame_bytes + padding)
+
+    return start, end - (end - start) % wav_format["block_align"]
+
+
+def quietest_offset(pcm, wav_format):
+    # Posição (alinhada ao bloco de amostras) do meio da janela mais silenciosa
+    energy = frame_energy(pcm, wav_format)
+
+    if len(energy) == 0:
+        return len(pcm)
+
+    frame_bytes = segment_bytes(wav_format, FRAME_MILLISECONDS / 1000)
+    offset = int(np.argmin(energy)) * frame_bytes + frame_bytes // 2
+
+    return offset - offset % wav_format["block_align"]
+
+
+def split_at_silence(chunks, wav_format, max_seconds, search_seconds):
+    # Gera trechos PCM de no máximo max_seconds, cortados no ponto mais silencioso dos
+    # últimos search_seconds de cada trecho, à medida que os chunks chegam
+    max_bytes = segment_bytes(wav_format, max_seconds)
+    search_bytes = min(segment_bytes(wav_format, search_seconds), max_bytes)
+
+    buffer = bytearray()
+
+    for chunk in chunks:
+        buffer += chunk
+
+        while len(buffer) >= max_bytes:
+            window_start = max_bytes - search_bytes
+            cut = window_start + \
+                quietest_offset(bytes(buffer[window_start:max_bytes]), wav_format)
+
+            if cut <= 0:
+                cut = max_bytes
+
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+
+    if len(buffer) > 0:
+        yield bytes(buffer)
+
+
+def to_wav(pcm, wav_format):
+    output = io.BytesIO()
+
+    with wave.open(output, "wb") as wav_file:
+        wav_file.setnchannels(wav_format["channels"])
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(wav_format["sample_rate"])
+        wav_file.writeframes(pcm)
+
+    return output.getvalue()
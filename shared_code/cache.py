@@ -0,0 +1,173 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+import azure.functions as func
+from azure.common import AzureMissingResourceHttpError
+
+# Cache em memória das respostas dos endpoints de leitura. Cada resposta fica associada à versão
+# (ETag) dos registros de onde veio: dentro do TTL é servida direto; depois disso, uma leitura
+# barata da versão decide se ainda vale ou se precisa ser recarregada.
+
+READ_CACHE_TTL_SECONDS = float(os.environ.get("READ_CACHE_TTL_SECONDS", "5"))
+READ_CACHE_MAX_ENTRIES = int(os.environ.get("READ_CACHE_MAX_ENTRIES", "256"))
+
+# Long-poll (parâmetro wait): tempo máximo que uma requisição pode ficar aguardando mudanças e
+# intervalo entre as consultas da versão, compartilhadas pelas requisições da mesma reunião
+LONG_POLL_MAX_SECONDS = float(os.environ.get("LONG_POLL_MAX_SECONDS", "25"))
+LONG_POLL_INTERVAL_SECONDS = float(
+    os.environ.get("LONG_POLL_INTERVAL_SECONDS", "1"))
+
+
+class ResponseCache:
+
+    def __init__(self, max_entries=READ_CACHE_MAX_ENTRIES, ttl=READ_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.versions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+            return entry
+
+    def _set(self, key, version, body):
+        with self.lock:
+            self.entries[key] = (version, body, time.monotonic())
+            self.entries.move_to_end(key)
+
+            # Descarta as entradas usadas há mais tempo
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_or_load(self, key, get_version, load, version=None):
+        # Retorna (versão, corpo); versão None indica que o registro não existe. Com a versão atual
+        # já conhecida, o TTL é ignorado e a versão não é lida de novo
+        entry = self._get(key)
+
+        if version is None:
+            if entry is not None and time.monotonic() - entry[2] < self.ttl:
+                return entry[0], entry[1]
+
+            version = get_version()
+
+        if version is None:
+            with self.lock:
+                self.entries.pop(key, None)
+
+            return None, None
+
+        if entry is not None and entry[0] == version:
+            self._set(key, version, entry[1])
+            return version, entry[1]
+
+        body = load()
+        self._set(key, version, body)
+
+        return version, body
+
+    def current_version(self, version_key, get_version):
+        # Versão lida no máximo uma vez por LONG_POLL_INTERVAL_SECONDS para cada reunião, por mais
+        # requisições que estejam aguardando
+        with self.lock:
+            checked = self.versions.get(version_key)
+
+        if checked is not None and time.monotonic() - checked[1] < LONG_POLL_INTERVAL_SECONDS:
+            return checked[0]
+
+        version = get_version()
+
+        with self.lock:
+            self.versions[version_key] = (version, time.monotonic())
+            self.versions.move_to_end(version_key)
+
+            while len(self.versions) > self.max_entries:
+                self.versions.popitem(last=False)
+
+        return version
+
+    def long_poll(self, key, version_key, get_version, load, version, body, wait_seconds, unchanged):
+        # Enquanto unchanged(versão, corpo) indicar que não há nada novo para o cliente, aguarda a
+        # versão mudar (somente a versão é consultada) e recarrega; devolve a última (versão, corpo)
+        deadline = time.monotonic() + wait_seconds
+
+        while unchanged(version, body):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            time.sleep(min(LONG_POLL_INTERVAL_SECONDS, remaining))
+
+            current = self.current_version(version_key, get_version)
+
+            if current is None:
+                # Registro removido durante a espera
+                break
+
+            if current != version:
+                version, body = self.get_or_load(
+                    key, get_version, load, current)
+
+        return version, body
+
+
+def entity_version(table_service, table_name, partition_key, row_key):
+    # Lê somente a chave do registro: o ETag vem junto nos metadados
+    try:
+        return table_service.get_entity(table_name, partition_key, row_key, select="RowKey")["etag"]
+    except AzureMissingResourceHttpError:
+        return ""
+
+
+def make_etag(*parts):
+    return '"' + hashlib.sha1("|".join(parts).encode('utf-8')).hexdigest() + '"'
+
+
+def is_not_modified(req, etag):
+    if_none_match = req.headers.get("If-None-Match")
+
+    if if_none_match is None:
+        return False
+
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+
+    # Comparação fraca: W/"x" equivale a "x"
+    return "*" in candidates or etag in [candidate[2:] if candidate.startswith("W/") else candidate
+                                         for candidate in candidates]
+
+
+def parse_wait(req):
+    # Segundos de long-poll pedidos (0 sem o parâmetro), limitados a LONG_POLL_MAX_SECONDS
+    wait = float(req.params.get('wait', 0))
+
+    if not wait >= 0:
+        raise ValueError("Invalid wait")
+
+    return min(wait, LONG_POLL_MAX_SECONDS)
+
+
+def response_etag(req, version):
+    # O ETag da resposta combina a versão dos dados com os parâmetros da requisição (menos o wait, que
+    # não muda o conteúdo)
+    params = sorted(key + "=" + value for key, value in req.params.items()
+                    if key != "wait")
+
+    return make_etag(version, *params)
+
+
+def http_response(req, version, body, headers):
+    etag = response_etag(req, version)
+
+    response_headers = dict(headers)
+    response_headers["ETag"] = etag
+
+    if is_not_modified(req, etag):
+        return func.HttpResponse(status_code=304, headers=response_headers)
+
+    return func.HttpResponse(body, headers=response_headers)
@@ -0,0 +1,78 @@
+import functools
+import logging
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from azure.storage.table import TableService
+from azure.storage.blob import BlockBlobService
+from azure.storage.queue import QueueService
+
+# Clientes compartilhados entre invocações: enquanto o worker estiver quente, as conexões TCP/TLS
+# com o Storage e com os Cognitive Services são reaproveitadas em vez de refeitas a cada mensagem.
+
+ACCOUNT_NAME = os.environ["STORAGE_ACCOUNT_NAME"]
+ACCOUNT_KEY = os.environ["STORAGE_ACCOUNT_KEY"]
+
+# Quantidade de hosts distintos mantidos no pool e de conexões abertas por host
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", "8"))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "32"))
+
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                          pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+session = create_session()
+
+table_service = TableService(
+    account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY, request_session=session)
+blob_service = BlockBlobService(
+    account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY, request_session=session)
+
+# Conta das filas que disparam as functions (mesma conexão do function.json)
+queue_service = QueueService(
+    connection_string=os.environ["STORAGE_ACCOUNT_PROCESSING"], request_session=session)
+
+
+def connection_stats():
+    # Totais acumulados dos pools do urllib3: requisições feitas e conexões novas abertas
+    total_requests = 0
+    total_connections = 0
+
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                total_requests += pool.num_requests
+                total_connections += pool.num_connections
+
+    return total_requests, total_connections
+
+
+def track_connection_reuse(function):
+    # Registra, por invocação, quantas requisições reaproveitaram uma conexão já aberta.
+    # Com invocações concorrentes no mesmo worker os números incluem as requisições das demais.
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        requests_before, connections_before = connection_stats()
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            requests_after, connections_after = connection_stats()
+
+            invocation_requests = max(requests_after - requests_before, 0)
+            new_connections = max(connections_after - connections_before, 0)
+
+            logging.info("Connection reuse: " + str(invocation_requests) + " requests, " +
+                         str(new_connections) + " new connections, " +
+                         str(max(invocation_requests - new_connections, 0)) + " reused")
+
+    return wrapper
@@ -0,0 +1,148 @@
+import logging
+import os
+import threading
+import time
+from . import clients
+
+# Acesso aos Cognitive Services compartilhado por queueImaging e queueRecording: cache do token do
+# serviço de fala e controle de vazão por serviço, respeitando o Retry-After das respostas 429
+
+AI_API_KEY = os.environ["AI_API_KEY"]
+AI_API_REGION = os.environ["AI_API_REGION"]
+
+# Os endpoints podem ser substituídos, por exemplo pelos stubs locais de tools/stubs.py
+URL_FACE_API = os.environ.get("URL_FACE_API", "https://"+AI_API_REGION +
+                              ".api.cognitive.microsoft.com/face/v1.0/detect")
+URL_TOKEN_API = os.environ.get("URL_TOKEN_API", "https://"+AI_API_REGION +
+                               ".api.cognitive.microsoft.com/sts/v1.0/issueToken")
+URL_STT_API = os.environ.get("URL_STT_API", "https://"+AI_API_REGION +
+                             ".stt.speech.microsoft.com/speech/recognition/conversation/cognitiveservices/v1?language=pt-BR")
+
+# Limites de chamadas por segundo de cada serviço, por instância. Ajustar ao tier contratado
+# (Face S0: 10 chamadas por segundo).
+FACE_API_RATE_PER_SECOND = float(
+    os.environ.get("FACE_API_RATE_PER_SECOND", "10"))
+FACE_API_BURST = float(os.environ.get(
+    "FACE_API_BURST", str(FACE_API_RATE_PER_SECOND)))
+SPEECH_API_RATE_PER_SECOND = float(
+    os.environ.get("SPEECH_API_RATE_PER_SECOND", "20"))
+SPEECH_API_BURST = float(os.environ.get(
+    "SPEECH_API_BURST", str(SPEECH_API_RATE_PER_SECOND)))
+
+API_MAX_ATTEMPTS = int(os.environ.get("AI_API_MAX_ATTEMPTS", "6"))
+API_BACKOFF_SECONDS = 1
+API_BACKOFF_MAX_SECONDS = 30
+
+# O token vale 10 minutos; é renovado um pouco antes para não expirar no meio de uma chamada
+TOKEN_REFRESH_SECONDS = 8 * 60
+
+RETRY_STATUS_CODES = (429, 503)
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = max(self.paused_until - now,
+                           (1 - self.tokens) / self.rate)
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Depois de um 429 nenhuma chamada ao serviço sai desta instância até o Retry-After passar
+        with self.lock:
+            self.paused_until = max(
+                self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+limiters = {
+    "face": TokenBucket(FACE_API_RATE_PER_SECOND, FACE_API_BURST),
+    "speech": TokenBucket(SPEECH_API_RATE_PER_SECOND, SPEECH_API_BURST)
+}
+
+
+def retry_after_seconds(response, attempt):
+    retry_after = response.headers.get("Retry-After")
+
+    if retry_after is not None:
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+
+    return min(API_BACKOFF_SECONDS * 2 ** attempt, API_BACKOFF_MAX_SECONDS)
+
+
+def post(service, url, data=None, **kwargs):
+    # data pode ser uma função que gera o corpo: um corpo em streaming só pode ser enviado uma vez,
+    # então é recriado a cada tentativa
+    limiter = limiters[service]
+
+    for attempt in range(API_MAX_ATTEMPTS):
+        limiter.acquire()
+
+        response = clients.session.post(
+            url, data=data() if callable(data) else data, **kwargs)
+
+        if response.status_code not in RETRY_STATUS_CODES:
+            return response
+
+        delay = retry_after_seconds(response, attempt)
+        limiter.pause(delay)
+
+        logging.warning("Throttled by " + service + " API (" + str(response.status_code) +
+                        "), retrying in " + str(delay) + " seconds...")
+
+    return response
+
+
+_token = None
+_token_refresh_at = 0
+_token_lock = threading.Lock()
+
+
+def get_speech_token():
+    global _token, _token_refresh_at
+
+    with _token_lock:
+        if _token is None or time.monotonic() >= _token_refresh_at:
+            headers = {"Content-Length": "0",
+                       "Ocp-Apim-Subscription-Key": AI_API_KEY}
+
+            response = clients.session.post(URL_TOKEN_API, headers=headers)
+            response.raise_for_status()
+
+            _token = str(response.content.decode('utf-8'))
+            _token_refresh_at = time.monotonic() + TOKEN_REFRESH_SECONDS
+
+            logging.info("Speech access token renewed.")
+
+        return _token
+
+
+def invalidate_speech_token(token):
+    global _token
+
+    with _token_lock:
+        if _token == token:
+            _token = None
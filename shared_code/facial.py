@@ -0,0 +1,236 @@
+import base64
+import binascii
+import json
+import os
+import numpy as np
+from azure.common import AzureMissingResourceHttpError
+from . import series, tracking
+
+# Leitura da série de emoções de uma reunião (um ponto por imagem ou agregados por intervalo), usada
+# pelo getFacialAnalysis e pelo getMeetings
+
+TABLE_NAME_TRACKING = os.environ["TABLE_NAME_TRACKING"]
+
+
+def encode_cursor(row_key):
+    return base64.urlsafe_b64encode(row_key.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    # O cursor é o RowKey do último frame entregue; qualquer outra coisa é rejeitada
+    try:
+        row_key = base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8')
+    except (binascii.Error, UnicodeError):
+        raise ValueError("Invalid cursor")
+
+    if not row_key.startswith(tracking.FRAME_ROW_PREFIX):
+        raise ValueError("Invalid cursor")
+
+    # Valida o timestamp contido no RowKey
+    tracking.frame_timestamp(row_key)
+
+    return row_key
+
+
+def load_series(table_service, code, after_row_key):
+    # Blocos da série compacta a partir do que contém o cursor; dentro dele, somente os pontos
+    # depois do cursor (mesma ordem dos RowKeys dos registros por imagem)
+    after_timestamp = None
+    if after_row_key is not None:
+        after_timestamp = tracking.frame_timestamp(after_row_key)
+
+    chunks = table_service.query_entities(
+        TABLE_NAME_TRACKING, filter=tracking.series_range_filter(code, after_timestamp),
+        select="Series")
+
+    frames = series.concat([series.decode_series(chunk["Series"])
+                            for chunk in chunks])
+
+    if after_timestamp is not None:
+        after = frames["timestamp"] > after_timestamp
+
+        for index in np.flatnonzero(frames["timestamp"] == after_timestamp).tolist():
+            after[index] = tracking.frame_row_key(
+                after_timestamp, frames["file_name"][index]) > after_row_key
+
+        frames = series.select(frames, after)
+
+    return frames
+
+
+def load_points(table_service, record, code, after_row_key, use_series=False, before_timestamp=None):
+    # before_timestamp: somente os pontos anteriores a ele
+    parts = []
+    next_row_key = after_row_key
+
+    after_timestamp = None
+    if after_row_key is not None:
+        after_timestamp = tracking.frame_timestamp(after_row_key)
+
+    # Reuniões anteriores à gravação por imagem ainda têm a série completa no registro principal
+    if "EmotionTimeAnalysis" in record:
+        facial_time_analysis = json.loads(record["EmotionTimeAnalysis"])
+
+        time_analysis = []
+
+        for item in facial_time_analysis:
+            timestamp = tracking.to_timestamp(item["time"])
+
+            if after_timestamp is not None and timestamp <= after_timestamp:
+                continue
+            if before_timestamp is not None and timestamp >= before_timestamp:
+                continue
+
+            entry = {}
+            entry["timestamp"] = timestamp
+            entry["file_name"] = ""
+            entry["value"] = item["value"]
+            entry["persons"] = item["persons"]
+            entry["emotion"] = item["emotion"]
+
+            time_analysis.append(entry)
+
+        if len(time_analysis) > 0:
+            parts.append(series.from_points(time_analysis))
+            next_row_key = tracking.frames_after(
+                max(entry["timestamp"] for entry in time_analysis))
+
+    if use_series and before_timestamp is not None:
+        # A série compacta só existe em reuniões com agregados de todas as imagens (gravadas depois
+        # deles ou migradas pelo rescore), então não há nada nela antes do primeiro agregado
+        frames = series.empty_series()
+    elif use_series:
+        frames = load_series(table_service, code, after_row_key)
+    else:
+        # Reuniões iniciadas antes da série compacta: um registro por imagem
+        frames = series.from_points([{"timestamp": tracking.frame_timestamp(frame["RowKey"]),
+                                      "file_name": tracking.frame_file_name(frame["RowKey"]),
+                                      "value": frame["Value"],
+                                      "persons": frame["Persons"],
+                                      "emotion": json.loads(frame["Emotion"])}
+                                     for frame in table_service.query_entities(
+                                         TABLE_NAME_TRACKING, filter=tracking.frame_range_filter(
+                                             code, after_row_key, before_timestamp),
+                                         select="RowKey,Value,Persons,Emotion")])
+
+    if len(frames["timestamp"]) > 0:
+        parts.append(frames)
+        next_row_key = tracking.frame_row_key(
+            int(frames["timestamp"][-1]), frames["file_name"][-1])
+
+    return series.concat(parts), next_row_key
+
+
+def load_faces(table_service, code, after_row_key, points):
+    # Emoções de cada face, dos registros por imagem (matriz compacta ou JSON dos registros
+    # anteriores), na ordem dos pontos; pontos sem registro por imagem ficam sem faces
+    faces_by_row = {frame["RowKey"]: [face["emotion-analysis"] for face in series.decode_faces(
+        frame["FacialAnalysis"], tracking.frame_file_name(frame["RowKey"]))]
+        for frame in table_service.query_entities(
+            TABLE_NAME_TRACKING, filter=tracking.frame_range_filter(code, after_row_key),
+            select="RowKey,FacialAnalysis")
+        if "FacialAnalysis" in frame}
+
+    return [faces_by_row.get(tracking.frame_row_key(timestamp, file_name), [])
+            for timestamp, file_name in zip(points["timestamp"].tolist(), points["file_name"])]
+
+
+def load_rollups(table_service, record, code, after_row_key, resolution, use_series=False):
+    # Com cursor, a série recomeça no intervalo que o contém, que pode ter recebido novas imagens
+    from_bucket = None
+    if after_row_key is not None:
+        from_bucket = tracking.rollup_bucket(
+            tracking.frame_timestamp(after_row_key), resolution)
+
+    rollups = table_service.query_entities(
+        TABLE_NAME_TRACKING, filter=tracking.rollup_range_filter(code, resolution, from_bucket),
+        select="RowKey,Frames,ValueSum,ValueMin,ValueMax,PersonsSum,EmotionSum")
+
+    time_analysis = [tracking.rollup_point(tracking.rollup_timestamp(rollup["RowKey"]), rollup)
+                     for rollup in rollups]
+
+    # Imagens anteriores aos agregados (reuniões gravadas antes deles, ou o começo de uma reunião em
+    # andamento quando eles passaram a existir, na série antiga do registro principal ou nos registros
+    # por imagem): os intervalos delas são calculados a partir dos pontos, até o primeiro agregado
+    first_bucket = time_analysis[0]["timestamp"] if len(
+        time_analysis) > 0 else None
+
+    points, _ = load_points(table_service, record, code,
+                            tracking.frames_after(from_bucket - 1) if from_bucket is not None else None,
+                            use_series, first_bucket)
+
+    buckets = {}
+    for timestamp, value, persons, emotion in zip(points["timestamp"].tolist(), points["value"].tolist(),
+                                                  points["persons"].tolist(), points["emotion"].tolist()):
+        bucket = tracking.rollup_bucket(timestamp, resolution)
+        buckets[bucket] = tracking.add_to_rollup(
+            buckets.get(bucket), value, persons, dict(zip(series.CATEGORIES, emotion)))
+
+    time_analysis = [tracking.rollup_point(bucket, buckets[bucket])
+                     for bucket in sorted(buckets)] + time_analysis
+
+    next_row_key = after_row_key
+    if len(time_analysis) > 0:
+        next_row_key = tracking.frames_after(time_analysis[-1]["timestamp"])
+
+    return time_analysis, next_row_key
+
+
+def uses_series(table_service, code):
+    # O resumo das reuniões gravadas na série compacta desde a primeira imagem tem SeriesVersion
+    try:
+        summary = table_service.get_entity(
+            TABLE_NAME_TRACKING, code, tracking.EMOTION_SUMMARY_ROW, select="SeriesVersion")
+    except AzureMissingResourceHttpError:
+        return False
+
+    return summary.get("SeriesVersion") is not None
+
+
+def load_facial_analysis(table_service, code, after_row_key, resolution=None, columns=False, record=None,
+                         faces=False):
+    # record: registro principal já lido (consulta em lote do getMeetings)
+    # faces: inclui as emoções de cada face em cada ponto (somente com um ponto por imagem)
+    if record is None:
+        record = table_service.get_entity(
+            TABLE_NAME_TRACKING, tracking.TRACKING_PARTITION, code)
+
+    use_series = uses_series(table_service, code)
+
+    if resolution is None:
+        points, next_row_key = load_points(
+            table_service, record, code, after_row_key, use_series)
+
+        time_analysis = series.to_columns(
+            points) if columns else series.to_points(points)
+
+        if faces:
+            frame_faces = load_faces(
+                table_service, code, after_row_key, points)
+
+            if columns:
+                time_analysis["faces"] = frame_faces
+            else:
+                for point, point_faces in zip(time_analysis, frame_faces):
+                    point["faces"] = point_faces
+    else:
+        time_analysis, next_row_key = load_rollups(
+            table_service, record, code, after_row_key, resolution, use_series)
+
+        if columns:
+            time_analysis = dict({key: [point[key] for point in time_analysis]
+                                  for key in ("timestamp", "frames", "value", "min", "max", "persons")},
+                                 emotion={category: [point["emotion"].get(category, 0) for point in time_analysis]
+                                          for category in series.CATEGORIES})
+
+    ret = {}
+    ret["message"] = "Code found at the database"
+    ret["status"] = True
+    if resolution is not None:
+        ret["resolution"] = resolution
+    ret["facialTimeAnalysis"] = time_analysis
+    ret["nextCursor"] = encode_cursor(
+        next_row_key) if next_row_key is not None else None
+
+    return json.dumps(ret)
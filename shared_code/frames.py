@@ -0,0 +1,94 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+# Pré-processamento das imagens antes da Face API. A imagem é baixada uma vez e enviada como bytes
+# (em vez de uma URL com SAS que a API teria de baixar de volta do Storage), reduzida quando é maior
+# que o necessário para a detecção. Um hash perceptual (dHash de 64 bits) compara a imagem com a
+# última analisada da reunião: numa sala parada as imagens seguidas são quase iguais e a análise da
+# anterior é reaproveitada.
+
+# Bits diferentes (de 64) até os quais a imagem é considerada igual à última analisada; -1 desativa
+FRAME_DUPLICATE_DISTANCE = int(
+    os.environ.get("FRAME_DUPLICATE_DISTANCE", "4"))
+
+# Lado maior, em pixels, acima do qual a imagem é reduzida antes do envio
+FRAME_MAX_SIDE = int(os.environ.get("FRAME_MAX_SIDE", "1920"))
+FRAME_JPEG_QUALITY = 90
+
+# Reuniões cuja última imagem analisada fica em memória
+FRAME_MAX_MEETINGS = 1024
+
+HASH_SIZE = 8
+
+# Imagens corrompidas ou em formato desconhecido seguem sem hash, como antes do pré-processamento
+IMAGE_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+
+
+def difference_hash(image):
+    # Cada bit indica se o pixel é mais claro que o vizinho da direita, numa miniatura 9x8 em cinza
+    pixels = np.asarray(image.convert("L").resize(
+        (HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+
+    return int.from_bytes(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes(), "big")
+
+
+def distance(first_hash, second_hash):
+    return bin(first_hash ^ second_hash).count("1")
+
+
+def prepare(data):
+    # Devolve os bytes a enviar à API e o hash da imagem (None se não puder ser lida)
+    try:
+        image = Image.open(io.BytesIO(data))
+
+        if max(image.size) <= FRAME_MAX_SIDE:
+            # Para o hash basta decodificar o JPEG numa escala reduzida (1/2 a 1/8)
+            image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+
+            return data, difference_hash(image)
+
+        image.draft("RGB", (FRAME_MAX_SIDE, FRAME_MAX_SIDE))
+        image = image.convert("RGB")
+        image.thumbnail((FRAME_MAX_SIDE, FRAME_MAX_SIDE), Image.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=FRAME_JPEG_QUALITY)
+
+        return output.getvalue(), difference_hash(image)
+    except IMAGE_ERRORS:
+        return data, None
+
+
+def is_duplicate(frame_hash, reference_hash):
+    return FRAME_DUPLICATE_DISTANCE >= 0 and frame_hash is not None and reference_hash is not None and \
+        distance(frame_hash, reference_hash) <= FRAME_DUPLICATE_DISTANCE
+
+
+class LastFrames:
+    # Última imagem analisada de cada reunião nesta instância, limitada às reuniões usadas mais
+    # recentemente
+
+    def __init__(self, max_meetings=FRAME_MAX_MEETINGS):
+        self.max_meetings = max_meetings
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, meeting_code):
+        with self.lock:
+            frame = self.frames.get(meeting_code)
+            if frame is not None:
+                self.frames.move_to_end(meeting_code)
+
+            return frame
+
+    def set(self, meeting_code, frame):
+        with self.lock:
+            self.frames[meeting_code] = frame
+            self.frames.move_to_end(meeting_code)
+
+            while len(self.frames) > self.max_meetings:
+                self.frames.popitem(last=False)
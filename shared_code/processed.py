@@ -0,0 +1,47 @@
+import os
+import threading
+from collections import OrderedDict
+from azure.common import AzureMissingResourceHttpError
+
+# Índice dos arquivos já processados pelas functions de fila. O log da API (PartitionKey = código da
+# reunião, RowKey = nome do arquivo) é consultado por leitura pontual; os pares confirmados ficam em
+# memória, de modo que uma mensagem entregue de novo à mesma instância é descartada sem nenhuma
+# chamada ao Storage ou à API.
+
+PROCESSED_CACHE_MAX_ENTRIES = int(
+    os.environ.get("PROCESSED_CACHE_MAX_ENTRIES", "10000"))
+
+
+class ProcessedIndex:
+
+    def __init__(self, table_name, max_entries=PROCESSED_CACHE_MAX_ENTRIES):
+        self.table_name = table_name
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def seen(self, meeting_code, file_name):
+        key = (meeting_code, file_name)
+
+        with self.lock:
+            if key not in self.entries:
+                return False
+
+            self.entries.move_to_end(key)
+            return True
+
+    def add(self, meeting_code, file_name):
+        with self.lock:
+            self.entries[(meeting_code, file_name)] = True
+            self.entries.move_to_end((meeting_code, file_name))
+
+            # Descarta os pares vistos há mais tempo
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def lookup(self, table_service, meeting_code, file_name, select=None):
+        # Registro do log da API do arquivo, ou None se ainda não foi processado
+        try:
+            return table_service.get_entity(self.table_name, meeting_code, file_name, select=select)
+        except AzureMissingResourceHttpError:
+            return None
@@ -0,0 +1,200 @@
+import cProfile
+import functools
+import json
+import logging
+import marshal
+import os
+import pstats
+import random
+import socket
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from . import clients
+
+# Perfil de CPU (cProfile) e de memória (tracemalloc) de uma amostra das invocações, ligado por
+# variável de ambiente. As estatísticas das invocações amostradas são somadas em memória e gravadas
+# em um blob por function e janela de PROFILE_WINDOW_SECONDS: um resumo JSON (funções com mais tempo
+# acumulado, linhas que mais alocaram e pico de memória) e o .prof do cProfile, que pode ser aberto
+# com pstats ou snakeviz. Desligado (padrão), o decorator devolve a própria função.
+
+# "cpu", "memory" ou "cpu,memory"; vazio desliga
+PROFILE_MODE = set(mode.strip() for mode in os.environ.get(
+    "PROFILE_MODE", "").lower().split(",") if mode.strip())
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0.05"))
+PROFILE_WINDOW_SECONDS = int(os.environ.get("PROFILE_WINDOW_SECONDS", "300"))
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", "30"))
+PROFILE_CONTAINER_NAME = os.environ.get(
+    "PROFILE_CONTAINER_NAME", os.environ.get("CONTAINER_NAME_RECORDING", ""))
+PROFILE_BLOB_PREFIX = "profiles/"
+
+# Frames guardados por alocação; mais frames custam mais memória e tempo ao tracemalloc
+TRACEMALLOC_FRAMES = 1
+
+INSTANCE = os.environ.get("WEBSITE_INSTANCE_ID", socket.gethostname())[
+    :12] + "-" + str(os.getpid())
+
+# O cProfile mede só a thread da invocação e o tracemalloc vale para o processo inteiro, então só uma
+# invocação por vez é perfilada; as amostras sorteadas enquanto outra está em andamento são puladas.
+# Alocações e tempo das threads auxiliares (lotes do queueImaging, trechos do queueRecording) entram
+# somente no tracemalloc.
+_active = threading.Lock()
+
+
+class Window:
+    # Estatísticas de uma function na janela atual
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.started = time.time()
+        self.invocations = 0
+        self.sampled = 0
+        self.cpu_seconds = 0
+        self.stats = None
+        self.allocations = {}
+        self.peak_bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, profiler, snapshot, peak_bytes, seconds):
+        with self.lock:
+            self.sampled += 1
+            self.cpu_seconds += seconds
+
+            if profiler is not None:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profiler)
+                else:
+                    self.stats.add(profiler)
+
+            if snapshot is not None:
+                for statistic in snapshot.statistics("lineno")[:PROFILE_TOP * 4]:
+                    frame = statistic.traceback[0]
+                    line = frame.filename + ":" + str(frame.lineno)
+
+                    allocation = self.allocations.setdefault(
+                        line, {"size_bytes": 0, "count": 0})
+                    allocation["size_bytes"] += statistic.size
+                    allocation["count"] += statistic.count
+
+                self.peak_bytes = max(self.peak_bytes, peak_bytes)
+
+    def summary(self):
+        summary = {"function": self.function_name,
+                   "instance": INSTANCE,
+                   "window_start": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                   "window_end": datetime.now(timezone.utc).isoformat(),
+                   "invocations": self.invocations,
+                   "sampled": self.sampled,
+                   "sampled_seconds": round(self.cpu_seconds, 3)}
+
+        if self.stats is not None:
+            top = sorted(self.stats.stats.items(),
+                         key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+
+            summary["cpu"] = {"top_cumulative": [{"function": "%s:%d(%s)" % key,
+                                                  "calls": calls,
+                                                  "total_seconds": round(total, 6),
+                                                  "cumulative_seconds": round(cumulative, 6)}
+                                                 for key, (_, calls, total, cumulative, _) in top]}
+
+        if len(self.allocations) > 0 or "memory" in PROFILE_MODE:
+            top = sorted(self.allocations.items(),
+                         key=lambda item: item[1]["size_bytes"], reverse=True)[:PROFILE_TOP]
+
+            summary["memory"] = {"peak_bytes": self.peak_bytes,
+                                 "top_allocations": [dict(allocation, line=line) for line, allocation in top]}
+
+        return summary
+
+
+_windows = {}
+_windows_lock = threading.Lock()
+
+
+def _window(function_name):
+    with _windows_lock:
+        window = _windows.get(function_name)
+        if window is None:
+            window = _windows[function_name] = Window(function_name)
+
+        window.invocations += 1
+
+        # Janela encerrada: uma nova passa a receber as estatísticas e a anterior é gravada
+        if time.time() - window.started >= PROFILE_WINDOW_SECONDS:
+            _windows[function_name] = Window(function_name)
+            _windows[function_name].invocations = 1
+
+            return _windows[function_name], window
+
+        return window, None
+
+
+def write_window(window):
+    if window.sampled == 0:
+        return
+
+    name = PROFILE_BLOB_PREFIX + window.function_name + "/" + \
+        datetime.fromtimestamp(window.started, timezone.utc).strftime(
+            "%Y%m%dT%H%M%SZ") + "-" + INSTANCE
+
+    try:
+        clients.blob_service.create_blob_from_bytes(PROFILE_CONTAINER_NAME, name + ".json",
+                                                    json.dumps(window.summary()).encode("utf-8"))
+
+        if window.stats is not None:
+            clients.blob_service.create_blob_from_bytes(PROFILE_CONTAINER_NAME, name + ".prof",
+                                                        marshal.dumps(window.stats.stats))
+
+        logging.info("Profile written to " + name + ".json")
+    except Exception as error:
+        # O perfil nunca interrompe a invocação
+        logging.warning("Could not write profile " + name + ": " + str(error))
+
+
+def profile(function_name):
+    def decorator(function):
+        if len(PROFILE_MODE) == 0:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            window, finished = _window(function_name)
+
+            if finished is not None:
+                write_window(finished)
+
+            if random.random() >= PROFILE_SAMPLE_RATE or not _active.acquire(blocking=False):
+                return function(*args, **kwargs)
+
+            profiler = cProfile.Profile() if "cpu" in PROFILE_MODE else None
+            tracing_memory = "memory" in PROFILE_MODE and not tracemalloc.is_tracing()
+            started = time.perf_counter()
+
+            try:
+                if tracing_memory:
+                    tracemalloc.start(TRACEMALLOC_FRAMES)
+                if profiler is not None:
+                    profiler.enable()
+
+                return function(*args, **kwargs)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+
+                snapshot = None
+                peak_bytes = 0
+                if tracing_memory:
+                    snapshot = tracemalloc.take_snapshot().filter_traces(
+                        [tracemalloc.Filter(False, tracemalloc.__file__)])
+                    peak_bytes = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+
+                _active.release()
+
+                window.add(profiler, snapshot, peak_bytes,
+                           time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,72 @@
+import numpy as np
+
+# Pontuação das emoções das faces detectadas. As faces de todas as imagens de um lote formam uma
+# única matriz (faces x emoções) e a emoção predominante, as somas por categoria e o valor de cada
+# imagem são calculados de uma vez.
+
+# Ordem das emoções na resposta da Face API; em caso de empate vale a primeira, como no sorted estável
+EMOTIONS = ["anger", "contempt", "disgust", "fear",
+            "happiness", "neutral", "sadness", "surprise"]
+
+POSITIVE_EMOTIONS = ["happiness", "surprise"]
+NEGATIVE_EMOTIONS = ["anger", "fear", "sadness", "contempt", "disgust"]
+
+POSITIVE_MASK = np.array([emotion in POSITIVE_EMOTIONS for emotion in EMOTIONS])
+NEGATIVE_MASK = np.array([emotion in NEGATIVE_EMOTIONS for emotion in EMOTIONS])
+
+# Colunas das categorias, na ordem usada para desempatar a categoria da imagem
+CATEGORIES = ["positive", "neutral", "negative"]
+
+
+def faces_matrix(faces):
+    return np.array([[face["faceAttributes"]["emotion"].get(emotion, 0) for emotion in EMOTIONS]
+                     for face in faces], dtype=float).reshape(len(faces), len(EMOTIONS))
+
+
+def score_frames(frames_faces):
+    # frames_faces: lista com as faces de cada imagem; devolve a pontuação de cada imagem
+    frame_count = len(frames_faces)
+    if frame_count == 0:
+        return []
+
+    persons = np.array([len(faces) for faces in frames_faces])
+    frame_index = np.repeat(np.arange(frame_count), persons)
+
+    matrix = faces_matrix([face for faces in frames_faces for face in faces])
+
+    top = matrix.argmax(axis=1)
+    top_score = matrix[np.arange(len(top)), top]
+
+    positive = POSITIVE_MASK[top]
+    negative = NEGATIVE_MASK[top]
+    neutral = ~(positive | negative)
+
+    # Soma, por imagem, da nota da emoção predominante de cada face, separada por categoria
+    sums = np.stack([np.bincount(frame_index, weights=np.where(mask, top_score, 0), minlength=frame_count)
+                     for mask in (positive, neutral, negative)], axis=1)
+
+    positive_count = np.bincount(frame_index[positive], minlength=frame_count)
+    negative_count = np.bincount(frame_index[negative], minlength=frame_count)
+
+    total = sums[:, 0] + sums[:, 2] + sums[:, 1]
+    has_faces = total > 0
+
+    # Imagens sem emoção pontuada são neutras
+    # O arredondamento usa o round do Python (o np.round pode diferir na última casa em valores
+    # terminados em 5), para que a nova pontuação de uma imagem seja idêntica à gravada
+    normalized = np.tile([0.0, 1.0, 0.0], (frame_count, 1))
+    if has_faces.any():
+        normalized[has_faces] = [[round(share, 3) for share in row]
+                                 for row in (sums[has_faces] / total[has_faces, None]).tolist()]
+
+    winner = normalized.argmax(axis=1)
+    value = np.select([winner == 0, winner == 2],
+                      [normalized[:, 0], -normalized[:, 2]], 0)
+
+    # Mesmos tipos da pontuação anterior: inteiros quando a imagem é neutra ou não tem emoção pontuada
+    return [{"value": float(value[frame]) if winner[frame] != 1 else 0,
+             "persons": int(persons[frame]),
+             "emotion": dict(zip(CATEGORIES, normalized[frame].tolist() if has_faces[frame] else [0, 1, 0])),
+             "positive_count": int(positive_count[frame]),
+             "negative_count": int(negative_count[frame])}
+            for frame in range(frame_count)]
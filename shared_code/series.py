@@ -0,0 +1,172 @@
+import base64
+import json
+import struct
+import zlib
+import numpy as np
+from . import scoring
+
+# Formato compacto da série de emoções de uma reunião: colunas paralelas em vez de uma lista JSON
+# com as mesmas chaves repetidas em cada ponto. Timestamps em int32 (diferença para o anterior),
+# valores e proporções em milésimos (os valores já são arredondados em 3 casas, então não há perda),
+# pessoas em uint16 e os nomes dos arquivos separados por quebra de linha, tudo comprimido com zlib e
+# gravado em base64. O prefixo "c<versão>:" identifica o formato; JSON continua legível.
+
+VERSION = 1
+PREFIX = "c%d:" % VERSION
+
+CATEGORIES = scoring.CATEGORIES
+
+# Pontos e primeiro timestamp
+_HEADER = struct.Struct("<Iq")
+
+
+def _thousandths(values, dtype):
+    return np.rint(np.asarray(values, dtype=float) * 1000).astype(dtype)
+
+
+def _check_version(text):
+    if not text.startswith(PREFIX):
+        raise ValueError("Unsupported series format: " + text[:8])
+
+
+def is_compact(text):
+    return text[:1] == "c"
+
+
+def empty_series():
+    return {"timestamp": np.zeros(0, dtype=np.int64),
+            "value": np.zeros(0),
+            "persons": np.zeros(0, dtype=np.int64),
+            "emotion": np.zeros((0, len(CATEGORIES))),
+            "file_name": []}
+
+
+def encode_series(series):
+    timestamps = np.asarray(series["timestamp"], dtype=np.int64)
+    count = len(timestamps)
+    first = int(timestamps[0]) if count else 0
+
+    payload = b"".join([np.diff(timestamps, prepend=first).astype("<i4").tobytes(),
+                        _thousandths(series["value"], "<i2").tobytes(),
+                        np.asarray(series["persons"]).astype("<u2").tobytes(),
+                        _thousandths(np.asarray(series["emotion"]).reshape(count, len(CATEGORIES)).T,
+                                     "<u2").tobytes(),
+                        "\n".join(series["file_name"]).encode("utf-8")])
+
+    return PREFIX + base64.b64encode(_HEADER.pack(count, first) + zlib.compress(payload)).decode("ascii")
+
+
+def decode_series(text):
+    # Devolve as colunas como arrays; nenhum objeto é criado por ponto, exceto os nomes dos arquivos
+    _check_version(text)
+
+    raw = base64.b64decode(text[len(PREFIX):])
+    count, first = _HEADER.unpack_from(raw)
+    payload = zlib.decompress(raw[_HEADER.size:])
+
+    offset = 0
+
+    def column(dtype, size):
+        nonlocal offset
+        values = np.frombuffer(payload, dtype=dtype, count=size, offset=offset)
+        offset += values.nbytes
+        return values
+
+    timestamps = first + np.cumsum(column("<i4", count), dtype=np.int64)
+    values = column("<i2", count) / 1000
+    persons = column("<u2", count).astype(np.int64)
+    emotion = (column("<u2", count * len(CATEGORIES)
+                      ).reshape(len(CATEGORIES), count) / 1000).T
+
+    names = payload[offset:].decode("utf-8")
+
+    return {"timestamp": timestamps,
+            "value": values,
+            "persons": persons,
+            "emotion": emotion,
+            "file_name": names.split("\n") if count else []}
+
+
+def from_points(points):
+    # points: dicts com timestamp, file_name, value, persons e emotion
+    return {"timestamp": np.array([point["timestamp"] for point in points], dtype=np.int64),
+            "value": np.array([point["value"] for point in points], dtype=float),
+            "persons": np.array([point["persons"] for point in points], dtype=np.int64),
+            "emotion": np.array([[point["emotion"].get(category, 0) for category in CATEGORIES] for point in points],
+                                dtype=float).reshape(len(points), len(CATEGORIES)),
+            "file_name": [point["file_name"] for point in points]}
+
+
+def merge_points(series, points):
+    # Acrescenta pontos à série, na ordem (timestamp, arquivo); um arquivo repetido substitui o anterior
+    merged = {}
+
+    if series is not None:
+        for index, key in enumerate(zip(series["timestamp"].tolist(), series["file_name"])):
+            merged[key] = {"timestamp": key[0], "file_name": key[1],
+                           "value": series["value"][index], "persons": series["persons"][index],
+                           "emotion": dict(zip(CATEGORIES, series["emotion"][index]))}
+
+    for point in points:
+        merged[(point["timestamp"], point["file_name"])] = point
+
+    return from_points([merged[key] for key in sorted(merged)])
+
+
+def concat(series_list):
+    if len(series_list) == 0:
+        return empty_series()
+
+    return {"timestamp": np.concatenate([series["timestamp"] for series in series_list]),
+            "value": np.concatenate([series["value"] for series in series_list]),
+            "persons": np.concatenate([series["persons"] for series in series_list]),
+            "emotion": np.concatenate([series["emotion"] for series in series_list]),
+            "file_name": [name for series in series_list for name in series["file_name"]]}
+
+
+def select(series, mask):
+    return {"timestamp": series["timestamp"][mask],
+            "value": series["value"][mask],
+            "persons": series["persons"][mask],
+            "emotion": series["emotion"][mask],
+            "file_name": [name for name, keep in zip(series["file_name"], mask.tolist()) if keep]}
+
+
+def to_columns(series):
+    # Série em colunas JSON, sem um dicionário por ponto
+    emotion = series["emotion"].T.tolist()
+
+    return {"timestamp": series["timestamp"].tolist(),
+            "value": series["value"].tolist(),
+            "persons": series["persons"].tolist(),
+            "emotion": {category: emotion[index] for index, category in enumerate(CATEGORIES)}}
+
+
+def to_points(series):
+    return [{"timestamp": timestamp, "value": value, "persons": persons,
+             "emotion": {"positive": positive, "neutral": neutral, "negative": negative}}
+            for timestamp, value, persons, (positive, neutral, negative)
+            in zip(series["timestamp"].tolist(), series["value"].tolist(), series["persons"].tolist(),
+                   series["emotion"].tolist())]
+
+
+def encode_faces(emotions):
+    # Proporções das 8 emoções de cada face, em milésimos; o nome do arquivo já está no registro
+    matrix = np.array([[emotion.get(name, 0) for name in scoring.EMOTIONS] for emotion in emotions],
+                      dtype=float).reshape(len(emotions), len(scoring.EMOTIONS))
+
+    return PREFIX + base64.b64encode(_thousandths(matrix, "<u2").tobytes()).decode("ascii")
+
+
+def decode_faces(text, file_name):
+    # Mesma estrutura do formato JSON anterior, que continua sendo aceito
+    if not is_compact(text):
+        return json.loads(text)
+
+    _check_version(text)
+
+    matrix = np.frombuffer(base64.b64decode(text[len(PREFIX):]), dtype="<u2").reshape(
+        -1, len(scoring.EMOTIONS)) / 1000
+
+    return [{"file-name": file_name, "emotion-analysis": dict(zip(scoring.EMOTIONS, row))}
+            for row in matrix.tolist()]
@@ -0,0 +1,205 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Tempo de cada etapa do processamento de uma mensagem (spans medidos com perf_counter). Cada span é
+# emitido como um registro de log estruturado (JSON) e somado a um histograma de latência por
+# function, reunião e etapa; o resumo dos histogramas de uma reunião é emitido a cada
+# TRACE_SUMMARY_EVERY invocações que a envolvem.
+
+TRACE_SPANS = os.environ.get("TRACE_SPANS", "true").lower() == "true"
+TRACE_SUMMARY_EVERY = int(os.environ.get("TRACE_SUMMARY_EVERY", "50"))
+TRACE_MAX_MEETINGS = int(os.environ.get("TRACE_MAX_MEETINGS", "256"))
+
+# Limites superiores dos intervalos do histograma, em milissegundos
+HISTOGRAM_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500,
+                        1000, 2000, 5000, 10000, 30000, 60000)
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0
+        self.max_ms = 0
+
+    def add(self, milliseconds):
+        self.counts[bisect.bisect_left(
+            HISTOGRAM_BUCKETS_MS, milliseconds)] += 1
+        self.count += 1
+        self.total_ms += milliseconds
+        self.max_ms = max(self.max_ms, milliseconds)
+
+    def percentile(self, percent):
+        # Limite superior do intervalo que contém o percentil, sem passar do maior valor visto
+        target = percent / 100 * self.count
+        accumulated = 0
+
+        for index, count in enumerate(self.counts):
+            accumulated += count
+            if accumulated >= target and count > 0:
+                return min(HISTOGRAM_BUCKETS_MS[index], round(self.max_ms, 3)) if index < len(HISTOGRAM_BUCKETS_MS) else round(self.max_ms, 3)
+
+        return round(self.max_ms, 3)
+
+    def summary(self):
+        return {"count": self.count,
+                "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0,
+                "p50_ms": self.percentile(50),
+                "p95_ms": self.percentile(95),
+                "p99_ms": self.percentile(99),
+                "max_ms": round(self.max_ms, 3),
+                "buckets": {("le_" + str(limit) if index < len(HISTOGRAM_BUCKETS_MS) else "inf"): count
+                            for index, (limit, count) in enumerate(zip(HISTOGRAM_BUCKETS_MS + (None,), self.counts)) if count}}
+
+
+# (function, reunião) -> {"traces": invocações, "stages": {etapa: Histogram}}, limitado às reuniões
+# usadas mais recentemente
+_meetings = OrderedDict()
+_meetings_lock = threading.Lock()
+
+
+def _record(function_name, spans):
+    summaries = []
+
+    with _meetings_lock:
+        touched = set()
+
+        for span in spans:
+            key = (function_name, span["meeting"])
+
+            meeting = _meetings.get(key)
+            if meeting is None:
+                meeting = _meetings[key] = {"traces": 0, "stages": {}}
+            _meetings.move_to_end(key)
+
+            meeting["stages"].setdefault(
+                span["stage"], Histogram()).add(span["ms"])
+            touched.add(key)
+
+        for key in touched:
+            meeting = _meetings[key]
+            meeting["traces"] += 1
+
+            if meeting["traces"] % TRACE_SUMMARY_EVERY == 0:
+                summaries.append({"event": "stage_histogram", "function": key[0], "meeting": key[1],
+                                  "traces": meeting["traces"],
+                                  "stages": {stage: histogram.summary() for stage, histogram in meeting["stages"].items()}})
+
+        while len(_meetings) > TRACE_MAX_MEETINGS:
+            _meetings.popitem(last=False)
+
+    for summary in summaries:
+        logging.info(json.dumps(summary, separators=(",", ":")))
+
+
+def histograms(function_name, meeting_code):
+    with _meetings_lock:
+        meeting = _meetings.get((function_name, meeting_code))
+        if meeting is None:
+            return {}
+
+        return {stage: histogram.summary() for stage, histogram in meeting["stages"].items()}
+
+
+class _Span:
+
+    def __init__(self, trace, stage, meeting):
+        self.trace = trace
+        self.stage = stage
+        self.meeting = meeting
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.trace.add(self.stage, time.perf_counter() - self.started,
+                       self.meeting, exc_type is not None)
+        return False
+
+
+class Trace:
+    # Spans de uma invocação; pode ser usado por várias threads ao mesmo tempo
+
+    def __init__(self, function_name, meeting_code=None, message_id=None):
+        self.function_name = function_name
+        self.meeting_code = meeting_code
+        self.message_id = message_id
+        self.spans = []
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def span(self, stage, meeting_code=None):
+        return _Span(self, stage, meeting_code)
+
+    def add(self, stage, seconds, meeting_code=None, failed=False):
+        span = {"stage": stage,
+                "meeting": meeting_code or self.meeting_code,
+                "ms": round(seconds * 1000, 3)}
+        if failed:
+            span["failed"] = True
+
+        with self.lock:
+            self.spans.append(span)
+
+        if TRACE_SPANS:
+            record = {"event": "span", "function": self.function_name}
+            if self.message_id is not None:
+                record["message_id"] = self.message_id
+            record.update(span)
+
+            logging.info(json.dumps(record, separators=(",", ":")))
+
+    def totals(self):
+        # Tempo somado por etapa; etapas executadas em paralelo podem somar mais que o total
+        totals = {}
+
+        with self.lock:
+            for span in self.spans:
+                totals[span["stage"]] = round(
+                    totals.get(span["stage"], 0) + span["ms"], 3)
+
+        return totals
+
+    def finish(self):
+        total_ms = round((time.perf_counter() - self.started) * 1000, 3)
+
+        # Spans emitidos antes de a reunião ser conhecida (decodificação da mensagem) ficam com a
+        # reunião da invocação
+        with self.lock:
+            spans = [dict(span, meeting=span["meeting"] or self.meeting_code)
+                     for span in self.spans]
+
+        record = {"event": "trace", "function": self.function_name,
+                  "meeting": self.meeting_code, "total_ms": total_ms, "stages": self.totals()}
+        if self.message_id is not None:
+            record["message_id"] = self.message_id
+
+        logging.info(json.dumps(record, separators=(",", ":")))
+
+        _record(self.function_name, spans)
+
+        return record
+
+
+class _NoSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+
+def span(trace, stage, meeting_code=None):
+    # Para funções em que o trace é opcional
+    if trace is None:
+        return _NoSpan()
+
+    return trace.span(stage, meeting_code)
@@ -0,0 +1,299 @@
+import base64
+import hashlib
+import json
+import logging
+import random
+import time
+from datetime import datetime
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+from azure.storage.table import TableBatch
+from . import tracing
+
+# Layout da tabela de tracking:
+# - PartitionKey "tracking-analysis", RowKey = código da reunião: registro principal (TranscriptIndex,
+#   FreqDist, WordCloud; TextConverted nos registros anteriores ao índice)
+# - PartitionKey = código da reunião, RowKey "transcript-<timestamp>-<arquivo>": transcrição de cada áudio
+# - PartitionKey = código da reunião, RowKey "frame-<timestamp>-<arquivo>": um registro por imagem processada
+# - PartitionKey = código da reunião, RowKey "emotion-summary": totais de EmotionCount
+# - PartitionKey = código da reunião, RowKey "rollup-<minutos>-<início do intervalo>": agregados das
+#   imagens de cada intervalo de 1, 5 e 15 minutos
+# - PartitionKey = código da reunião, RowKey "series-<início do bloco>": pontos de SERIES_CHUNK_SECONDS
+#   segundos da série no formato compacto (shared_code/series.py)
+
+TRACKING_PARTITION = "tracking-analysis"
+FRAME_ROW_PREFIX = "frame-"
+EMOTION_SUMMARY_ROW = "emotion-summary"
+ROLLUP_ROW_PREFIX = "rollup-"
+SERIES_ROW_PREFIX = "series-"
+TRANSCRIPT_ROW_PREFIX = "transcript-"
+
+# Duração de cada bloco da série compacta; blocos menores mantêm cada registro bem abaixo do limite
+# de 64 KB por propriedade mesmo com uma imagem por segundo
+SERIES_CHUNK_SECONDS = 900
+
+# Tamanhos dos intervalos agregados, em minutos
+ROLLUP_RESOLUTIONS = (1, 5, 15)
+
+# Limite de operações de uma transação em lote (entity group transaction) do Table Storage
+TABLE_BATCH_SIZE = 100
+
+UPDATE_MAX_ATTEMPTS = 8
+UPDATE_BACKOFF_SECONDS = 0.05
+
+
+def to_timestamp(date_time):
+    return round(time.mktime(datetime.strptime(
+        date_time, "%d/%m/%Y %H:%M").timetuple()))
+
+
+def frame_row_key(timestamp, file_name):
+    # Timestamp com zeros à esquerda para que a ordem do RowKey seja a ordem temporal
+    return FRAME_ROW_PREFIX + "%012d" % timestamp + "-" + file_name
+
+
+def frame_timestamp(row_key):
+    # O timestamp é calculado uma única vez, na gravação, e fica no próprio RowKey
+    return int(row_key[len(FRAME_ROW_PREFIX):len(FRAME_ROW_PREFIX) + 12])
+
+
+def frame_file_name(row_key):
+    return row_key[len(FRAME_ROW_PREFIX) + 13:]
+
+
+def frames_after(timestamp):
+    # Limite que fica depois de todos os RowKeys do timestamp informado ("." vem logo após "-")
+    return FRAME_ROW_PREFIX + "%012d" % timestamp + "."
+
+
+def frame_range_filter(meeting_code, after_row_key=None, before_timestamp=None):
+    # "." é o caractere seguinte a "-", então o intervalo cobre somente os RowKeys "frame-..."
+    if after_row_key is None:
+        lower_bound = "RowKey ge '" + FRAME_ROW_PREFIX + "'"
+    else:
+        lower_bound = "RowKey gt '" + after_row_key.replace("'", "''") + "'"
+
+    if before_timestamp is None:
+        upper_bound = FRAME_ROW_PREFIX[:-1] + "."
+    else:
+        upper_bound = FRAME_ROW_PREFIX + "%012d" % before_timestamp
+
+    return "PartitionKey eq '" + meeting_code + "' and " + lower_bound + \
+        " and RowKey lt '" + upper_bound + "'"
+
+
+def rollup_bucket(timestamp, resolution):
+    # Início do intervalo de "resolution" minutos que contém o timestamp
+    return timestamp - timestamp % (resolution * 60)
+
+
+def rollup_row_key(resolution, bucket):
+    return ROLLUP_ROW_PREFIX + "%02d-" % resolution + "%012d" % bucket
+
+
+def rollup_timestamp(row_key):
+    return int(row_key[-12:])
+
+
+def rollup_range_filter(meeting_code, resolution, from_bucket=None):
+    prefix = ROLLUP_ROW_PREFIX + "%02d-" % resolution
+
+    if from_bucket is None:
+        lower_bound = "RowKey ge '" + prefix + "'"
+    else:
+        lower_bound = "RowKey ge '" + \
+            rollup_row_key(resolution, from_bucket) + "'"
+
+    return "PartitionKey eq '" + meeting_code + "' and " + lower_bound + \
+        " and RowKey lt '" + prefix[:-1] + ".'"
+
+
+def rollup_frame_key(file_name):
+    # Identificador de 8 bytes de uma imagem já somada a um agregado
+    return hashlib.blake2b(file_name.encode("utf-8"), digest_size=8).digest()
+
+
+def rollup_frame_keys(rollup):
+    raw = base64.b64decode(rollup.get("FrameKeys", "")) if rollup is not None else b""
+
+    return set(raw[index:index + 8] for index in range(0, len(raw), 8))
+
+
+def add_to_rollup(rollup, value, persons, emotion, file_name=None):
+    # Soma um ponto (imagem) ao agregado; as médias são calculadas na leitura. Com file_name, o agregado
+    # guarda quais imagens já somou (FrameKeys), e uma imagem repetida, de uma mensagem entregue de
+    # novo depois de uma falha no meio do lote, não é somada outra vez
+    frame_keys = None
+    if file_name is not None:
+        frame_keys = rollup_frame_keys(rollup)
+        frame_key = rollup_frame_key(file_name)
+
+        if frame_key in frame_keys:
+            return {name: rollup[name] for name in ("Frames", "ValueSum", "ValueMin", "ValueMax",
+                                                    "PersonsSum", "EmotionSum", "FrameKeys")}
+
+        frame_keys.add(frame_key)
+
+    if rollup is None or "Frames" not in rollup:
+        frames = 0
+        value_sum = 0
+        value_min = value
+        value_max = value
+        persons_sum = 0
+        emotion_sum = {}
+    else:
+        frames = rollup["Frames"]
+        value_sum = rollup["ValueSum"]
+        value_min = min(rollup["ValueMin"], value)
+        value_max = max(rollup["ValueMax"], value)
+        persons_sum = rollup["PersonsSum"]
+        emotion_sum = json.loads(rollup["EmotionSum"])
+
+    for key, share in emotion.items():
+        emotion_sum[key] = round(emotion_sum.get(key, 0) + share, 3)
+
+    changes = {"Frames": frames + 1,
+               "ValueSum": round(value_sum + value, 3),
+               "ValueMin": value_min,
+               "ValueMax": value_max,
+               "PersonsSum": persons_sum + persons,
+               "EmotionSum": json.dumps(emotion_sum)}
+
+    if frame_keys is not None:
+        changes["FrameKeys"] = base64.b64encode(
+            b"".join(sorted(frame_keys))).decode("ascii")
+
+    return changes
+
+
+def rollup_point(bucket, rollup):
+    # Ponto da série agregada, no mesmo formato dos pontos por imagem
+    frames = rollup["Frames"]
+
+    return {"timestamp": bucket,
+            "frames": frames,
+            "value": round(rollup["ValueSum"] / frames, 3),
+            "min": rollup["ValueMin"],
+            "max": rollup["ValueMax"],
+            "persons": round(rollup["PersonsSum"] / frames, 3),
+            "emotion": {key: round(share / frames, 3) for key, share in json.loads(rollup["EmotionSum"]).items()}}
+
+
+def series_row_key(timestamp):
+    return SERIES_ROW_PREFIX + "%012d" % (timestamp - timestamp % SERIES_CHUNK_SECONDS)
+
+
+def series_range_filter(meeting_code, from_timestamp=None):
+    if from_timestamp is None:
+        lower_bound = "RowKey ge '" + SERIES_ROW_PREFIX + "'"
+    else:
+        lower_bound = "RowKey ge '" + series_row_key(from_timestamp) + "'"
+
+    return "PartitionKey eq '" + meeting_code + "' and " + lower_bound + \
+        " and RowKey lt '" + SERIES_ROW_PREFIX[:-1] + ".'"
+
+
+def transcript_row_key(timestamp, file_name):
+    return TRANSCRIPT_ROW_PREFIX + "%012d" % timestamp + "-" + file_name
+
+
+def transcript_range_filter(meeting_code, from_timestamp=None, to_timestamp=None):
+    # Transcrições dos áudios entre os dois timestamps, inclusive
+    lower_bound = TRANSCRIPT_ROW_PREFIX + \
+        ("%012d" % from_timestamp if from_timestamp is not None else "")
+    upper_bound = TRANSCRIPT_ROW_PREFIX + "%012d" % to_timestamp + "." if to_timestamp is not None else \
+        TRANSCRIPT_ROW_PREFIX[:-1] + "."
+
+    return "PartitionKey eq '" + meeting_code + "' and RowKey ge '" + lower_bound + \
+        "' and RowKey lt '" + upper_bound + "'"
+
+
+def update_entity(table_service, table_name, partition_key, row_key, apply_changes, select=None, trace=None):
+    # Leitura seguida de merge condicionado ao ETag lido. Se outro writer alterou o registro no meio
+    # do caminho (412) ou o criou antes (409), a leitura e as alterações são refeitas.
+    # apply_changes recebe o registro atual (ou None) e devolve somente as propriedades a gravar,
+    # ou None quando não há nada a alterar.
+    meeting_code = row_key if partition_key == TRACKING_PARTITION else partition_key
+
+    for attempt in range(UPDATE_MAX_ATTEMPTS):
+        try:
+            with tracing.span(trace, "tracking_read", meeting_code):
+                current = table_service.get_entity(
+                    table_name, partition_key, row_key, select=select)
+        except AzureMissingResourceHttpError:
+            current = None
+
+        with tracing.span(trace, "json_merge", meeting_code):
+            changes = apply_changes(current)
+
+        if changes is None:
+            return current
+
+        entity = dict(changes)
+        entity["PartitionKey"] = partition_key
+        entity["RowKey"] = row_key
+
+        try:
+            with tracing.span(trace, "tracking_write", meeting_code):
+                if current is None:
+                    entity["etag"] = table_service.insert_entity(
+                        table_name, entity)
+                else:
+                    entity["etag"] = table_service.merge_entity(
+                        table_name, entity, if_match=current["etag"])
+
+            return entity
+        except AzureHttpError as error:
+            if error.status_code not in (404, 409, 412):
+                raise
+
+        logging.info("Concurrent update on " + partition_key + "/" + row_key +
+                     ", retrying (attempt " + str(attempt + 1) + ")...")
+
+        time.sleep(random.uniform(0, UPDATE_BACKOFF_SECONDS * 2 ** attempt))
+
+    raise Exception("Could not update " + partition_key + "/" + row_key +
+                    " after " + str(UPDATE_MAX_ATTEMPTS) + " attempts.")
+
+
+def update_entities(table_service, table_name, partition_key, row_keys, apply_changes):
+    # Como update_entity, para vários registros de uma partição: as leituras são seguidas de uma
+    # transação em lote com cada escrita condicionada ao ETag lido (ou à inexistência do registro).
+    # Um conflito em qualquer registro desfaz a transação inteira, que é lida e refeita.
+    row_keys = sorted(row_keys)
+
+    for start in range(0, len(row_keys), TABLE_BATCH_SIZE):
+        chunk = row_keys[start:start + TABLE_BATCH_SIZE]
+
+        for attempt in range(UPDATE_MAX_ATTEMPTS):
+            batch = TableBatch()
+
+            for row_key in chunk:
+                try:
+                    current = table_service.get_entity(
+                        table_name, partition_key, row_key)
+                except AzureMissingResourceHttpError:
+                    current = None
+
+                entity = dict(apply_changes(row_key, current))
+                entity["PartitionKey"] = partition_key
+                entity["RowKey"] = row_key
+
+                if current is None:
+                    batch.insert_entity(entity)
+                else:
+                    batch.merge_entity(entity, if_match=current["etag"])
+
+            try:
+                table_service.commit_batch(table_name, batch)
+                break
+            except AzureHttpError as error:
+                if error.status_code not in (404, 409, 412):
+                    raise
+
+            logging.info("Concurrent update on " + partition_key + " (" + str(len(chunk)) +
+                         " rows), retrying (attempt " + str(attempt + 1) + ")...")
+
+            time.sleep(random.uniform(0, UPDATE_BACKOFF_SECONDS * 2 ** attempt))
+        else:
+            raise Exception("Could not update " + str(len(chunk)) + " rows of " + partition_key +
+                            " after " + str(UPDATE_MAX_ATTEMPTS) + " attempts.")
@@ -0,0 +1,135 @@
+import heapq
+import json
+import logging
+import os
+import re
+import threading
+import time
+from azure.common import AzureMissingResourceHttpError
+
+# Nuvem de palavras: o ranking é calculado pelo queueRecording sempre que o FreqDist é gravado, e a
+# lista de stopwords da tabela de parâmetros fica em memória, relida a cada STOPWORDS_REFRESH_SECONDS
+
+TABLE_NAME_PARAMETERS = os.environ["TABLE_NAME_PARAMETERS"]
+TABLE_NAME_TRACKING = os.environ["TABLE_NAME_TRACKING"]
+
+# Palavras guardadas no ranking pré-calculado de cada reunião
+WORD_CLOUD_MAX_WORDS = int(os.environ.get("WORD_CLOUD_MAX_WORDS", "500"))
+STOPWORDS_REFRESH_SECONDS = float(
+    os.environ.get("STOPWORDS_REFRESH_SECONDS", "300"))
+
+# Quantidade de palavras devolvidas quando o parâmetro top não é informado; vazio (padrão) devolve
+# todas, como antes do parâmetro existir
+WORD_CLOUD_TOP = int(os.environ["WORD_CLOUD_TOP"]) if os.environ.get(
+    "WORD_CLOUD_TOP") else None
+
+# Somente palavras ditas mais de uma vez e com mais de dois caracteres entram na nuvem
+MIN_WEIGHT = 2
+MIN_LENGTH = 3
+
+
+def parse_stopwords(value):
+    # Formato documentado: {"stopwords": ["cara", "muita", ...]}; aceita também uma lista separada por vírgulas
+    try:
+        words = json.loads(value)
+        if isinstance(words, dict):
+            words = words.get("stopwords", [])
+    except ValueError:
+        words = re.split(r"[,;\s]+", value)
+
+    return frozenset(word.strip().lower() for word in words if word.strip())
+
+
+_stopwords = frozenset()
+_stopwords_version = None
+_stopwords_refresh_at = 0
+_stopwords_lock = threading.Lock()
+
+
+def get_stopwords(table_service):
+    # Retorna (ETag do parâmetro, conjunto de stopwords)
+    global _stopwords, _stopwords_version, _stopwords_refresh_at
+
+    with _stopwords_lock:
+        if _stopwords_version is None or time.monotonic() >= _stopwords_refresh_at:
+            try:
+                entity = table_service.get_entity(
+                    TABLE_NAME_PARAMETERS, "stopwords", "general")
+
+                _stopwords = parse_stopwords(entity["Value"])
+                _stopwords_version = entity["etag"]
+            except AzureMissingResourceHttpError:
+                _stopwords = frozenset()
+                _stopwords_version = ""
+
+            _stopwords_refresh_at = time.monotonic() + STOPWORDS_REFRESH_SECONDS
+
+            logging.info("Stopwords parameter loaded: " +
+                         str(len(_stopwords)) + " words.")
+
+        return _stopwords_version, _stopwords
+
+
+def rank_words(freq_dist, stopwords, limit):
+    # Heap limitado a "limit" palavras: não ordena o vocabulário inteiro; sem limite, todas as palavras
+    candidates = ((word, weight) for word, weight in freq_dist.items()
+                  if weight >= MIN_WEIGHT and len(word) >= MIN_LENGTH and word not in stopwords)
+
+    if limit is None:
+        return sorted(candidates, key=lambda item: item[1], reverse=True)
+
+    return heapq.nlargest(limit, candidates, key=lambda item: item[1])
+
+
+def serialize_ranking(ranking):
+    return json.dumps([[word, weight] for word, weight in ranking], separators=(",", ":"))
+
+
+def top_words(record, stopwords, top):
+    # Usa o ranking pré-calculado; reuniões gravadas antes dele, ou pedidos que ele não cobre,
+    # são calculados a partir do FreqDist. top None devolve todas as palavras
+    if "WordCloud" in record and (top is None or top <= WORD_CLOUD_MAX_WORDS):
+        ranking = json.loads(record["WordCloud"])
+
+        words = []
+        for word, weight in ranking:
+            if word not in stopwords:
+                words.append((word, weight))
+                if len(words) == top:
+                    return words
+
+        # O ranking foi truncado em WORD_CLOUD_MAX_WORDS e stopwords novas (ou top None) pedem
+        # palavras além dele
+        if len(ranking) < WORD_CLOUD_MAX_WORDS:
+            return words
+
+    return rank_words(json.loads(record.get("FreqDist", "{}")), stopwords, top)
+
+
+def parse_top(req):
+    top = int(req.params['top']) if 'top' in req.params else WORD_CLOUD_TOP
+
+    if top is not None and top <= 0:
+        raise ValueError("Invalid top")
+
+    return top
+
+
+def load_word_cloud(table_service, code, top, record=None):
+    _, additional_stop_words = get_stopwords(table_service)
+
+    # record: registro principal já lido (consulta em lote do getMeetings)
+    if record is None:
+        record = table_service.get_entity(
+            TABLE_NAME_TRACKING, "tracking-analysis", code, select="FreqDist,WordCloud")
+
+    words = []
+    for word, weight in top_words(record, additional_stop_words, top):
+        words.append({"name": word, "weight": weight})
+
+    ret = {}
+    ret["message"] = "Code found at the database"
+    ret["status"] = True
+    ret["words"] = words
+
+    return json.dumps(ret)
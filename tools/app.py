@@ -0,0 +1,37 @@
+import importlib
+import os
+import sys
+import types
+
+# Carrega as functions fora do runtime do Azure Functions, que importa a raiz do projeto como o pacote
+# "__app__". As configurações obrigatórias recebem valores fictícios quando não estão definidas.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SETTINGS = {
+    "STORAGE_ACCOUNT_NAME": "devstoreaccount1",
+    "STORAGE_ACCOUNT_KEY": "a2V5",
+    "STORAGE_ACCOUNT_PROCESSING": "UseDevelopmentStorage=true",
+    "AI_API_KEY": "key",
+    "AI_API_REGION": "brazilsouth",
+    "CONTAINER_NAME_RECORDING": "recordings",
+    "TABLE_NAME_TRACKING": "tracking",
+    "TABLE_NAME_API_FACE": "apiface",
+    "TABLE_NAME_API_T2S": "apit2s",
+    "TABLE_NAME_PARAMETERS": "parameters"
+}
+
+
+def bootstrap():
+    for name, value in DEFAULT_SETTINGS.items():
+        os.environ.setdefault(name, value)
+
+    if "__app__" not in sys.modules:
+        app = types.ModuleType("__app__")
+        app.__path__ = [ROOT]
+        sys.modules["__app__"] = app
+
+
+def load(name):
+    bootstrap()
+    return importlib.import_module("__app__." + name)
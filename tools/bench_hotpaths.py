@@ -0,0 +1,351 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from . import app, fakes, stubs
+
+# Microbenchmarks dos trechos executados a cada mensagem/requisição, com dados sintéticos. Cada caso
+# é medido separadamente e comparado com um baseline salvo; uma piora acima da tolerância encerra
+# com código 1.
+#
+#   python -m tools.bench_hotpaths --save      # grava o baseline desta máquina
+#   python -m tools.bench_hotpaths             # compara com o baseline
+#
+# O baseline não vai para o repositório: só é comparável com medições da mesma máquina. Os tempos são
+# guardados relativos a uma carga fixa de calibração apenas para compensar variações de frequência da
+# CPU entre as execuções, e uma piora menor que --noise-floor-ms nunca é regressão, porque nos casos
+# de fração de milissegundo a variação entre execuções passa da tolerância.
+
+BASELINE_FILE = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "bench_baseline.json")
+
+SYLLABLES = ["ba", "ca", "da", "de", "di", "do", "fa", "ga", "la", "le", "li", "ma", "me", "mi",
+             "na", "ne", "pa", "pe", "ra", "re", "ri", "sa", "se", "ta", "te", "ti", "to", "va",
+             "ção", "ções", "dade", "mente", "ar", "er", "ir", "ão", "ém", "ês"]
+
+
+def calibrate():
+    # Carga fixa em Python puro, usada como unidade de tempo da máquina
+    started = time.perf_counter()
+
+    total = Counter()
+    for i in range(200000):
+        total[i % 97] += i
+
+    return time.perf_counter() - started
+
+
+def synthetic_faces(rng, faces_per_frame):
+    emotions = stubs.EMOTIONS
+    faces = []
+
+    for _ in range(faces_per_frame):
+        scores = [rng.random() ** 3 for _ in emotions]
+        total = sum(scores)
+        faces.append({"faceAttributes": {"emotion": {emotion: round(score / total, 3)
+                                                     for emotion, score in zip(emotions, scores)}}})
+
+    return faces
+
+
+def synthetic_vocabulary(rng, size, stopwords):
+    # Palavras frequentes reais, stopwords e uma cauda longa de palavras inventadas
+    vocabulary = list(stubs.WORDS) + sorted(stopwords)
+
+    while len(vocabulary) < size:
+        vocabulary.append("".join(rng.choice(SYLLABLES)
+                                  for _ in range(rng.randint(2, 4))))
+
+    return vocabulary
+
+
+def synthetic_transcripts(rng, vocabulary, clips, words_per_clip):
+    # Distribuição de Zipf: poucas palavras muito frequentes, muitas raras
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    transcripts = []
+
+    for _ in range(clips):
+        words = rng.choices(vocabulary, weights, k=words_per_clip)
+        transcripts.append(" ".join(words).capitalize() + ".")
+
+    return transcripts
+
+
+def prepare(args):
+    rng = random.Random(args.seed)
+
+    clients = app.load("shared_code.clients")
+    table_service, _, _ = fakes.install(clients)
+
+    queue_imaging = app.load("queueImaging")
+    queue_recording = app.load("queueRecording")
+    facial_analysis = app.load("shared_code.facial")
+    tracking = app.load("shared_code.tracking")
+    wordcloud = app.load("shared_code.wordcloud")
+
+    series = app.load("shared_code.series")
+
+    table_name = os.environ["TABLE_NAME_TRACKING"]
+    start = datetime(2019, 6, 13, 10, 0)
+
+    frames = [synthetic_faces(rng, rng.randint(0, 2 * args.faces))
+              for _ in range(args.frames)]
+    scored = queue_imaging.score_frames([("frame_%d.jpg" % index, faces)
+                                         for index, faces in enumerate(frames)])
+    date_times = [(start + timedelta(seconds=20 * index)).strftime("%d/%m/%Y %H:%M")
+                  for index in range(args.frames)]
+
+    # Reunião gravada em linhas de frame e reunião antiga com a série inteira no registro principal
+    table_service.insert_entity(table_name, {"PartitionKey": tracking.TRACKING_PARTITION,
+                                             "RowKey": "BENCH"})
+    for index, result in enumerate(scored):
+        table_service.insert_entity(table_name, {"PartitionKey": "BENCH",
+                                                 "RowKey": tracking.frame_row_key(tracking.to_timestamp(date_times[index]),
+                                                                                  "frame_%d.jpg" % index),
+                                                 "Time": date_times[index], "Value": result["value"],
+                                                 "Persons": result["persons"],
+                                                 "Emotion": json.dumps(result["emotion"]),
+                                                 "FacialAnalysis": series.encode_faces([item["emotion-analysis"]
+                                                                                        for item in result["file_processed"]])})
+
+    # A mesma série no formato compacto, em blocos
+    points = [{"timestamp": tracking.to_timestamp(date_times[index]), "file_name": "frame_%d.jpg" % index,
+               "value": result["value"], "persons": result["persons"], "emotion": result["emotion"]}
+              for index, result in enumerate(scored)]
+    chunks = {}
+    for point in points:
+        chunks.setdefault(tracking.series_row_key(
+            point["timestamp"]), []).append(point)
+
+    table_service.insert_entity(table_name, {"PartitionKey": tracking.TRACKING_PARTITION,
+                                             "RowKey": "SERIES"})
+    table_service.insert_entity(table_name, {"PartitionKey": "SERIES", "RowKey": tracking.EMOTION_SUMMARY_ROW,
+                                             "SeriesVersion": series.VERSION})
+    for row_key, chunk in chunks.items():
+        table_service.insert_entity(table_name, {"PartitionKey": "SERIES", "RowKey": row_key,
+                                                 "Series": series.encode_series(series.merge_points(None, chunk))})
+
+    table_service.insert_entity(table_name, {"PartitionKey": tracking.TRACKING_PARTITION, "RowKey": "LEGACY",
+                                             "EmotionTimeAnalysis": json.dumps([{"time": date_times[index],
+                                                                                 "value": result["value"],
+                                                                                 "persons": result["persons"],
+                                                                                 "emotion": result["emotion"]}
+                                                                                for index, result in enumerate(scored)])})
+
+    stopwords = queue_recording.STOPWORDS
+    vocabulary = synthetic_vocabulary(rng, args.vocabulary, stopwords)
+    transcripts = synthetic_transcripts(
+        rng, vocabulary, args.clips, args.words)
+    additional_stop_words = frozenset(rng.sample(vocabulary, 50))
+
+    freq_dist = queue_recording.processar_palavra_chave(
+        transcripts, stopwords)
+    record = {"TranscriptIndex": json.dumps({"clip_%d.wav" % index: [index * 60, queue_recording.text_checksum(text)]
+                                             for index, text in enumerate(transcripts[:-1])}),
+              "FreqDist": queue_recording.serializar_freq_dist(queue_recording.processar_palavra_chave(transcripts[:-1], stopwords))}
+    cloud_record = {"FreqDist": queue_recording.serializar_freq_dist(freq_dist),
+                    "WordCloud": wordcloud.serialize_ranking(wordcloud.rank_words(freq_dist, frozenset(),
+                                                                                  wordcloud.WORD_CLOUD_MAX_WORDS))}
+    legacy_cloud_record = {"FreqDist": cloud_record["FreqDist"]}
+    new_clip = {"file-name": "clip_%d.wav" % (len(transcripts) - 1), "text": transcripts[-1],
+                "timestamp": (len(transcripts) - 1) * 60}
+
+    # As imagens são pontuadas em lotes do tamanho dos lidos da fila pelo queueImaging
+    batch_size = queue_imaging.IMAGING_BATCH_SIZE + 1
+
+    # Cada caso é uma função sem argumentos que executa uma unidade do trecho medido
+    return {
+        "emotion_scoring": lambda: [queue_imaging.score_frames([("frame.jpg", faces) for faces in frames[start:start + batch_size]])
+                                    for start in range(0, len(frames), batch_size)],
+        "emotion_count_update": lambda: [queue_imaging.update_emotion_count(
+            {"positive": 0, "negative": 0}, result["positive_count"], result["negative_count"]) for result in scored],
+        "frame_rows_serialize": lambda: [(json.dumps(result["emotion"]),
+                                          series.encode_faces([item["emotion-analysis"] for item in result["file_processed"]]))
+                                         for result in scored],
+        "facial_analysis_frames": lambda: facial_analysis.load_facial_analysis(table_service, "BENCH", None),
+        "facial_analysis_series": lambda: facial_analysis.load_facial_analysis(table_service, "SERIES", None),
+        "facial_analysis_columns": lambda: facial_analysis.load_facial_analysis(table_service, "SERIES", None,
+                                                                               columns=True),
+        "facial_analysis_faces": lambda: facial_analysis.load_facial_analysis(table_service, "BENCH", None,
+                                                                             faces=True),
+        "facial_analysis_legacy": lambda: facial_analysis.load_facial_analysis(table_service, "LEGACY", None),
+        "word_frequency_build": lambda: queue_recording.processar_palavra_chave(transcripts, stopwords),
+        "word_frequency_merge": lambda: queue_recording.merge_transcript(dict(record), new_clip, stopwords,
+                                                                         additional_stop_words),
+        "word_cloud_top": lambda: wordcloud.top_words(cloud_record, additional_stop_words, 100),
+        "word_cloud_legacy": lambda: wordcloud.top_words(legacy_cloud_record, additional_stop_words, 100)
+    }
+
+
+def measure(case, repeat, min_seconds):
+    # Repete o caso até somar min_seconds em cada rodada; devolve o menor tempo por execução, em
+    # segundos (o mínimo é o menos afetado por ruído de outros processos)
+    case()
+
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            case()
+        elapsed = time.perf_counter() - started
+
+        if elapsed >= min_seconds:
+            break
+        loops *= 2
+
+    timings = [elapsed / loops]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            case()
+        timings.append((time.perf_counter() - started) / loops)
+
+    return min(timings)
+
+
+def measure_relative(case, repeat, min_seconds):
+    # O caso é dividido pelo tempo de calibração medido logo antes dele, o que também compensa
+    # variações de frequência da CPU ao longo da execução
+    calibration = min(calibrate() for _ in range(3))
+    seconds = measure(case, repeat, min_seconds)
+
+    return seconds, seconds / calibration
+
+
+def slowdown(name, seconds, relative, baseline):
+    # Piora relativa e a mesma piora em segundos desta execução (o baseline convertido pela
+    # calibração medida agora)
+    reference = baseline["cases"][name]
+
+    return relative[name] / reference - 1, seconds[name] * (1 - reference / relative[name])
+
+
+def is_regression(change, extra_seconds, tolerance, noise_floor):
+    return change > tolerance and extra_seconds > noise_floor
+
+
+def compare(seconds, relative, baseline, tolerance, noise_floor):
+    print("%-26s %12s %12s %9s %10s" %
+          ("case", "baseline", "current", "change", "extra (ms)"))
+
+    regressions = []
+
+    for name, current in relative.items():
+        if name not in baseline["cases"]:
+            print("%-26s %12s %12.3f %9s" % (name, "-", current, "new"))
+            continue
+
+        change, extra_seconds = slowdown(name, seconds, relative, baseline)
+        regression = is_regression(
+            change, extra_seconds, tolerance, noise_floor)
+
+        print("%-26s %12.3f %12.3f %+8.1f%% %10.3f%s" % (name, baseline["cases"][name], current, change * 100,
+                                                         extra_seconds * 1000, "  REGRESSION" if regression else ""))
+
+        if regression:
+            regressions.append(name)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Microbenchmarks of the per-message hot paths")
+    parser.add_argument("--faces", type=int, default=3,
+                        help="average faces per frame")
+    parser.add_argument("--frames", type=int, default=500,
+                        help="frames per meeting")
+    parser.add_argument("--clips", type=int, default=60,
+                        help="transcripts per meeting")
+    parser.add_argument("--words", type=int, default=120,
+                        help="words per transcript")
+    parser.add_argument("--vocabulary", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-seconds", type=float, default=0.2,
+                        help="minimum duration of each round")
+    parser.add_argument("--cases", help="comma separated subset of cases")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown before failing (0.25 = 25%%)")
+    parser.add_argument("--noise-floor-ms", type=float, default=1.0,
+                        help="slowdowns smaller than this, in milliseconds per run, never fail")
+    parser.add_argument("--confirm", type=int, default=2,
+                        help="new measurements of a case over the tolerance")
+    args = parser.parse_args()
+
+    parameters = {"faces": args.faces, "frames": args.frames, "clips": args.clips,
+                  "words": args.words, "vocabulary": args.vocabulary}
+
+    cases = prepare(args)
+    if args.cases:
+        cases = {name: cases[name] for name in args.cases.split(",")}
+
+    seconds = {}
+    relative = {}
+
+    print("%-26s %12s %12s" % ("case", "time (ms)", "relative"))
+
+    for name, case in cases.items():
+        seconds[name], relative[name] = measure_relative(
+            case, args.repeat, args.min_seconds)
+
+        print("%-26s %12.3f %12.3f" %
+              (name, seconds[name] * 1000, relative[name]))
+
+    print()
+
+    if args.save:
+        with open(args.baseline, "w") as output:
+            json.dump({"parameters": parameters,
+                       "cases": {name: round(value, 5) for name, value in relative.items()}},
+                      output, indent=2, sort_keys=True)
+
+        print("Baseline saved to " + args.baseline)
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at " + args.baseline +
+              ", run with --save on this machine to create one.")
+        return
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    if baseline.get("parameters") != parameters:
+        print("Warning: baseline recorded with " +
+              json.dumps(baseline.get("parameters")) + ".")
+
+    # Um caso acima da tolerância é medido de novo antes de ser considerado regressão, para não
+    # falhar por uma interferência momentânea na máquina
+    noise_floor = args.noise_floor_ms / 1000
+
+    for _ in range(args.confirm):
+        suspects = [name for name in relative if name in baseline["cases"] and
+                    is_regression(*slowdown(name, seconds, relative, baseline), args.tolerance, noise_floor)]
+
+        for name in suspects:
+            case_seconds, case_relative = measure_relative(
+                cases[name], args.repeat, args.min_seconds)
+
+            if case_relative < relative[name]:
+                seconds[name], relative[name] = case_seconds, case_relative
+
+    regressions = compare(seconds, relative, baseline,
+                          args.tolerance, noise_floor)
+
+    if regressions:
+        print()
+        print("Slower than the baseline by more than %.0f%%: %s" %
+              (args.tolerance * 100, ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
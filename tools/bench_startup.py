@@ -0,0 +1,83 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Mede o custo de cold start do queueRecording: cada execução é um interpretador novo, como uma
+# instância nova do plano de consumo. Compara o backend "regex" com o "nltk" (NLP_BACKEND).
+#
+#   python -m tools.bench_startup --runs 5
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE_TEXT = ("Bom dia a todos, obrigado por participarem da reunião de hoje. A ideia é apresentar o "
+               "projeto de inovação que a gente vem desenvolvendo com o pessoal da região, mostrar os "
+               "resultados do último trimestre e conversar sobre os próximos passos. Se alguém tiver "
+               "alguma dúvida durante a apresentação, pode perguntar a qualquer momento, tá bom? "
+               "Então vamos lá: o guarda-chuva de projetos cresceu 30% e a equipe dobrou de tamanho.")
+
+# Executado em cada processo filho: importa a function e processa duas transcrições
+CHILD = """
+import json, sys, time
+try:
+    start = time.perf_counter()
+    from tools import app
+    queue_recording = app.load("queueRecording")
+    imported = time.perf_counter()
+    text = {"file-name": "sample.wav", "timestamp": 0, "text": sys.argv[1]}
+    queue_recording.merge_transcript(None, text, queue_recording.STOPWORDS, frozenset())
+    first = time.perf_counter()
+    queue_recording.merge_transcript(None, text, queue_recording.STOPWORDS, frozenset())
+    second = time.perf_counter()
+    print(json.dumps({"import": imported - start, "first_message": first - imported,
+                      "next_message": second - first}))
+except Exception as error:
+    lines = [line.strip() for line in str(error).splitlines() if line.strip(" *")]
+    print(json.dumps({"error": type(error).__name__ + ": " + (lines[0] if lines else "")}))
+"""
+
+
+def run_once(backend):
+    env = dict(os.environ, NLP_BACKEND=backend)
+
+    result = subprocess.run([sys.executable, "-c", CHILD, SAMPLE_TEXT], cwd=ROOT, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    run = json.loads(result.stdout.strip().splitlines()[-1])
+
+    if "error" in run:
+        raise RuntimeError(run["error"])
+
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cold start benchmark of queueRecording")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--backends", default="regex,nltk")
+    args = parser.parse_args()
+
+    print("%-8s %12s %16s %16s" %
+          ("backend", "import (ms)", "1st message (ms)", "next message (ms)"))
+
+    for backend in args.backends.split(","):
+        try:
+            runs = [run_once(backend) for _ in range(args.runs)]
+        except RuntimeError as error:
+            print("%-8s failed: %s" % (backend, error))
+            continue
+
+        medians = [statistics.median(run[metric] for run in runs) * 1000
+                   for metric in ("import", "first_message", "next_message")]
+
+        print("%-8s %12.1f %16.1f %16.1f" % tuple([backend] + medians))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+import base64
+import copy
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from azure.common import AzureConflictHttpError, AzureHttpError, AzureMissingResourceHttpError
+from azure.storage.table import Entity
+from azure.storage.table.models import AzureBatchOperationError
+
+# Implementações em memória da parte do TableService, BlockBlobService e QueueService usada pelas
+# functions. Cada chamada conta como uma transação de storage, por operação, em "transactions".
+
+_FILTER_TOKEN = re.compile(r"\s*(?:(?P<string>'(?:[^']|'')*')|(?P<datetime>datetime'[^']*')|"
+                           r"(?P<operator>\(|\)|\b(?:eq|ne|gt|ge|lt|le|and|or|not)\b)|"
+                           r"(?P<number>-?\d+(?:\.\d+)?L?)|(?P<boolean>\b(?:true|false)\b)|"
+                           r"(?P<name>[A-Za-z_][A-Za-z0-9_]*))")
+
+_OPERATORS = {"eq": "==", "ne": "!=", "gt": ">", "ge": ">=", "lt": "<", "le": "<=",
+              "and": "and", "or": "or", "not": "not", "(": "(", ")": ")"}
+
+
+def compile_filter(query_filter):
+    # Traduz o subconjunto de OData usado pelas functions para uma expressão Python
+    if not query_filter:
+        return lambda entity: True
+
+    expression = []
+    position = 0
+
+    while position < len(query_filter):
+        match = _FILTER_TOKEN.match(query_filter, position)
+
+        if match is None or match.end() == position:
+            if query_filter[position:].strip() == "":
+                break
+            raise ValueError("Invalid filter: " + query_filter[position:])
+
+        position = match.end()
+
+        if match.group("string"):
+            expression.append(
+                repr(match.group("string")[1:-1].replace("''", "'")))
+        elif match.group("datetime"):
+            expression.append("_datetime(%r)" % match.group("datetime")[9:-1])
+        elif match.group("operator"):
+            expression.append(_OPERATORS[match.group("operator")])
+        elif match.group("number"):
+            expression.append(match.group("number").rstrip("L"))
+        elif match.group("boolean"):
+            expression.append(match.group("boolean").capitalize())
+        else:
+            expression.append("_get(entity, %r)" % match.group("name"))
+
+    code = compile(" ".join(expression), "<filter>", "eval")
+    scope = {"_get": lambda entity, name: entity.get(name),
+             "_datetime": lambda value: datetime.strptime(value.rstrip("Z")[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)}
+
+    def predicate(entity):
+        try:
+            return eval(code, scope, {"entity": entity})
+        except TypeError:
+            # Comparação com propriedade ausente ou de outro tipo: o serviço não retorna a entidade
+            return False
+
+    return predicate
+
+
+class QueryResult(list):
+
+    next_marker = None
+
+    @property
+    def items(self):
+        return self
+
+
+def _decode_batch_entity(body):
+    properties = json.loads(body)
+    entity = {}
+
+    for name, value in properties.items():
+        if name.endswith("@odata.type"):
+            continue
+
+        edm_type = properties.get(name + "@odata.type")
+        if edm_type == "Edm.Int64":
+            value = int(value)
+        elif edm_type == "Edm.Binary":
+            value = base64.b64decode(value)
+        elif edm_type == "Edm.DateTime":
+            value = datetime.strptime(value.rstrip("Z")[:19], "%Y-%m-%dT%H:%M:%S").replace(
+                tzinfo=timezone.utc)
+
+        entity[name] = value
+
+    return entity
+
+
+class FakeTableService:
+
+    def __init__(self):
+        self.tables = {}
+        self.transactions = Counter()
+        self.lock = threading.RLock()
+        self._etags = itertools.count(1)
+
+    def _table(self, table_name):
+        return self.tables.setdefault(table_name, {})
+
+    def _store(self, table, key, properties):
+        properties = {name: value for name, value in properties.items()
+                      if name not in ("etag", "Timestamp")}
+        properties["etag"] = 'W/"%d"' % next(self._etags)
+        properties["Timestamp"] = datetime.now(timezone.utc)
+
+        table[key] = properties
+
+        return properties["etag"]
+
+    def _check(self, table, key, if_match):
+        if key not in table:
+            raise AzureMissingResourceHttpError("Not Found", 404)
+
+        if if_match not in (None, "*") and table[key]["etag"] != if_match:
+            raise AzureHttpError("Precondition Failed", 412)
+
+    def _entity(self, properties, select):
+        entity = Entity()
+
+        for name, value in properties.items():
+            if select is None or name in select or name == "etag":
+                entity[name] = copy.deepcopy(value)
+
+        return entity
+
+    def query_entities(self, table_name, filter=None, select=None, num_results=None, marker=None,
+                       accept=None, property_resolver=None, timeout=None):
+        predicate = compile_filter(filter)
+        selected = set(name.strip() for name in select.split(
+            ",")) if select else None
+
+        with self.lock:
+            self.transactions["table.query_entities"] += 1
+
+            entities = [self._entity(properties, selected)
+                        for _, properties in sorted(self._table(table_name).items()) if predicate(properties)]
+
+        return QueryResult(entities[:num_results] if num_results else entities)
+
+    def get_entity(self, table_name, partition_key, row_key, select=None, accept=None,
+                   property_resolver=None, timeout=None):
+        selected = set(name.strip() for name in select.split(
+            ",")) if select else None
+
+        with self.lock:
+            self.transactions["table.get_entity"] += 1
+
+            properties = self._table(table_name).get(
+                (partition_key, row_key))
+            if properties is None:
+                raise AzureMissingResourceHttpError("Not Found", 404)
+
+            return self._entity(properties, selected)
+
+    def _insert(self, table, entity):
+        key = (entity["PartitionKey"], entity["RowKey"])
+        if key in table:
+            raise AzureConflictHttpError("Conflict", 409)
+
+        return self._store(table, key, dict(entity))
+
+    def _update(self, table, entity, if_match):
+        key = (entity["PartitionKey"], entity["RowKey"])
+        self._check(table, key, if_match)
+
+        return self._store(table, key, dict(entity))
+
+    def _merge(self, table, entity, if_match):
+        key = (entity["PartitionKey"], entity["RowKey"])
+        self._check(table, key, if_match)
+
+        properties = dict(table[key])
+        properties.update(entity)
+
+        return self._store(table, key, properties)
+
+    def _insert_or_replace(self, table, entity):
+        return self._store(table, (entity["PartitionKey"], entity["RowKey"]), dict(entity))
+
+    def _insert_or_merge(self, table, entity):
+        key = (entity["PartitionKey"], entity["RowKey"])
+
+        properties = dict(table.get(key, {}))
+        properties.update(entity)
+
+        return self._store(table, key, properties)
+
+    def insert_entity(self, table_name, entity, timeout=None):
+        with self.lock:
+            self.transactions["table.insert_entity"] += 1
+            return self._insert(self._table(table_name), entity)
+
+    def update_entity(self, table_name, entity, if_match="*", timeout=None):
+        with self.lock:
+            self.transactions["table.update_entity"] += 1
+            return self._update(self._table(table_name), entity, if_match)
+
+    def merge_entity(self, table_name, entity, if_match="*", timeout=None):
+        with self.lock:
+            self.transactions["table.merge_entity"] += 1
+            return self._merge(self._table(table_name), entity, if_match)
+
+    def insert_or_replace_entity(self, table_name, entity, timeout=None):
+        with self.lock:
+            self.transactions["table.insert_or_replace_entity"] += 1
+            return self._insert_or_replace(self._table(table_name), entity)
+
+    def insert_or_merge_entity(self, table_name, entity, timeout=None):
+        with self.lock:
+            self.transactions["table.insert_or_merge_entity"] += 1
+            return self._insert_or_merge(self._table(table_name), entity)
+
+    def delete_entity(self, table_name, partition_key, row_key, if_match="*", timeout=None):
+        with self.lock:
+            self.transactions["table.delete_entity"] += 1
+
+            table = self._table(table_name)
+            self._check(table, (partition_key, row_key), if_match)
+            del table[(partition_key, row_key)]
+
+    def commit_batch(self, table_name, batch, timeout=None):
+        # Transação atômica: se uma operação falhar, nenhuma é aplicada
+        with self.lock:
+            self.transactions["table.commit_batch"] += 1
+
+            table = self._table(table_name)
+            backup = dict(table)
+            etags = []
+
+            try:
+                for row_key, request in batch._requests:
+                    key = (batch._partition_key, row_key)
+                    if_match = request.headers.get("If-Match")
+
+                    if request.method == "DELETE":
+                        self._check(table, key, if_match)
+                        del table[key]
+                        etags.append(None)
+                        continue
+
+                    entity = _decode_batch_entity(request.body)
+
+                    if request.method == "POST":
+                        etags.append(self._insert(table, entity))
+                    elif request.method == "PUT":
+                        etags.append(self._update(table, entity, if_match) if if_match
+                                     else self._insert_or_replace(table, entity))
+                    elif request.method == "MERGE":
+                        etags.append(self._merge(table, entity, if_match) if if_match
+                                     else self._insert_or_merge(table, entity))
+            except AzureHttpError as error:
+                table.clear()
+                table.update(backup)
+
+                raise AzureBatchOperationError(str(error), error.status_code)
+
+            return etags
+
+
+class FakeBlob:
+
+    def __init__(self, content, properties):
+        self.content = content
+        self.properties = properties
+
+
+class FakeBlobProperties:
+
+    def __init__(self, etag, content_length, content_range=None):
+        self.etag = etag
+        self.content_length = content_length
+        self.content_range = content_range
+
+
+class FakeBlobService:
+
+    def __init__(self):
+        self.blobs = {}
+        self.transactions = Counter()
+        self.lock = threading.Lock()
+        self._etags = itertools.count(1)
+
+    def create_blob_from_bytes(self, container_name, blob_name, blob, **kwargs):
+        with self.lock:
+            self.transactions["blob.create_blob_from_bytes"] += 1
+            self.blobs[(container_name, blob_name)] = (
+                bytes(blob), '"0x%X"' % next(self._etags))
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range=None, end_range=None,
+                          if_match=None, **kwargs):
+        with self.lock:
+            self.transactions["blob.get_blob_to_bytes"] += 1
+
+            if (container_name, blob_name) not in self.blobs:
+                raise AzureMissingResourceHttpError("Not Found", 404)
+
+            data, etag = self.blobs[(container_name, blob_name)]
+
+        if if_match is not None and if_match != etag:
+            raise AzureHttpError("Precondition Failed", 412)
+
+        if start_range is None:
+            return FakeBlob(data, FakeBlobProperties(etag, len(data)))
+
+        end = len(data) - 1 if end_range is None else min(end_range, len(data) - 1)
+        content = data[start_range:end + 1]
+
+        return FakeBlob(content, FakeBlobProperties(etag, len(content),
+                                                    "bytes %d-%d/%d" % (start_range, end, len(data))))
+
+    def generate_blob_shared_access_signature(self, container_name, blob_name, permission=None,
+                                              expiry=None, **kwargs):
+        # Gerado localmente pelo SDK, sem transação
+        return "sv=2017-04-17&sr=b&sig=fake"
+
+
+class FakeQueueMessage:
+
+    def __init__(self, message_id, content):
+        self.id = message_id
+        self.content = content
+        self.dequeue_count = 0
+        self.pop_receipt = None
+        self.visible_at = 0
+
+
+class FakeQueueService:
+
+    def __init__(self):
+        self.queues = {}
+        self.transactions = Counter()
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def put_message(self, queue_name, content, visibility_timeout=None, time_to_live=None, timeout=None):
+        with self.lock:
+            self.transactions["queue.put_message"] += 1
+
+            message = FakeQueueMessage(str(next(self._ids)), content)
+            self.queues.setdefault(queue_name, []).append(message)
+
+            return message
+
+    def _receive(self, queue_name, num_messages, visibility_timeout):
+        now = time.monotonic()
+        messages = []
+
+        for message in self.queues.get(queue_name, []):
+            if len(messages) >= num_messages:
+                break
+
+            if message.visible_at <= now:
+                message.visible_at = now + visibility_timeout
+                message.dequeue_count += 1
+                message.pop_receipt = str(next(self._ids))
+                messages.append(message)
+
+        return messages
+
+    def _delete(self, queue_name, message_id, pop_receipt):
+        messages = self.queues.get(queue_name, [])
+
+        for message in messages:
+            if message.id == message_id and message.pop_receipt == pop_receipt:
+                messages.remove(message)
+                return
+
+        raise AzureMissingResourceHttpError("Not Found", 404)
+
+    def get_messages(self, queue_name, num_messages=None, visibility_timeout=None, timeout=None):
+        with self.lock:
+            self.transactions["queue.get_messages"] += 1
+            return self._receive(queue_name, num_messages or 1, visibility_timeout or 30)
+
+    def delete_message(self, queue_name, message_id, pop_receipt, timeout=None):
+        with self.lock:
+            self.transactions["queue.delete_message"] += 1
+            self._delete(queue_name, message_id, pop_receipt)
+
+    def pending(self, queue_name):
+        # Mensagens ainda na fila, visíveis ou não (não conta como transação)
+        with self.lock:
+            return len(self.queues.get(queue_name, []))
+
+    # Operações do gatilho de fila do host, contadas à parte das transações feitas pelas functions
+
+    def receive_trigger(self, queue_name):
+        # O host renova a visibilidade enquanto a function executa: a mensagem fica oculta até
+        # ser concluída ou devolvida
+        with self.lock:
+            self.transactions["host.queue.get_messages"] += 1
+
+            messages = self._receive(queue_name, 1, float("inf"))
+
+            return messages[0] if messages else None
+
+    def complete_trigger(self, queue_name, message):
+        with self.lock:
+            self.transactions["host.queue.delete_message"] += 1
+            self._delete(queue_name, message.id, message.pop_receipt)
+
+    def abandon_trigger(self, queue_name, message, visibility_timeout):
+        with self.lock:
+            self.transactions["host.queue.update_message"] += 1
+            message.visible_at = time.monotonic() + visibility_timeout
+
+
+def install(clients):
+    # Substitui os clientes compartilhados do módulo shared_code.clients pelos fakes
+    clients.table_service = FakeTableService()
+    clients.blob_service = FakeBlobService()
+    clients.queue_service = FakeQueueService()
+
+    return clients.table_service, clients.blob_service, clients.queue_service
+
+
+def transactions(*services):
+    total = Counter()
+
+    for service in services:
+        total.update(service.transactions)
+
+    # Counter.update mantém contagens zeradas; "+" as remove
+    return +total
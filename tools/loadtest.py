@@ -0,0 +1,317 @@
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+from PIL import Image
+from . import app, fakes, stubs
+
+# Teste de carga de ponta a ponta sem Azure: storage em memória (tools/fakes.py) e Cognitive
+# Services nos stubs locais (tools/stubs.py). N reuniões com M imagens e K áudios passam pelas
+# functions de fila, como o host faria, e depois os três endpoints HTTP são consultados.
+#
+#   python -m tools.loadtest --meetings 5 --frames 60 --clips 6 --latency 0.2 --throttle-rate 0.05
+
+IMAGES_QUEUE = "images"
+VOICES_QUEUE = "voices"
+
+# Mesmo limite do host.json (maxDequeueCount)
+MAX_DEQUEUE_COUNT = 5
+
+
+def percentile(values, percent):
+    # Nearest-rank
+    if not values:
+        return 0
+
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+class Recorder:
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds, failed=False):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if failed:
+                self.errors[name] += 1
+
+    def summary(self, name, units, wall_seconds):
+        latencies = self.latencies.get(name, [])
+
+        return {"calls": len(latencies),
+                "errors": self.errors[name],
+                "units": units,
+                "throughput": units / wall_seconds if wall_seconds > 0 else 0,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000}
+
+
+def make_wav(audio, seconds, rng, rate=16000):
+    # Tom com pausas de 300 ms a cada poucos segundos, para o corte em silêncio ter onde atuar
+    t = np.arange(int(seconds * rate)) / rate
+    pcm = (6000 * np.sin(2 * np.pi * rng.uniform(180, 400) * t)).astype("<i2")
+
+    position = rng.uniform(2, 6)
+    while position < seconds:
+        pcm[int(position * rate):int((position + 0.3) * rate)] = 0
+        position += rng.uniform(2, 6)
+
+    return audio.to_wav(pcm.tobytes(), {"channels": 1, "sample_rate": rate, "byte_rate": 2 * rate, "block_align": 2})
+
+
+def make_jpeg(scene, rng, size=(640, 360)):
+    # Mesma cena em blocos de cor com um pouco de ruído, como uma câmera parada
+    blocks = np.random.RandomState(scene).randint(0, 256, (9, 16, 3))
+    pixels = np.kron(blocks, np.ones((size[1] // 9, size[0] // 16, 1)))
+    pixels = np.clip(pixels + np.random.RandomState(rng.randrange(2 ** 32)).normal(0, 3, pixels.shape), 0, 255)
+
+    output = io.BytesIO()
+    Image.fromarray(pixels.astype(np.uint8)).save(output, "JPEG")
+
+    return output.getvalue()
+
+
+def meeting_code(index):
+    return "LOAD%02d" % index
+
+
+def enqueue(args, table_service, blob_service, queue_service, audio):
+    rng = random.Random(args.seed)
+    container = os.environ["CONTAINER_NAME_RECORDING"]
+    start = datetime(2019, 6, 13, 10, 0)
+
+    table_service.insert_or_replace_entity(os.environ["TABLE_NAME_PARAMETERS"],
+                                           {"PartitionKey": "stopwords", "RowKey": "general",
+                                            "Value": json.dumps({"stopwords": ["gente", "pessoal"]})})
+
+    messages = []
+
+    for meeting in range(args.meetings):
+        code = meeting_code(meeting)
+
+        scene = rng.randrange(2 ** 32)
+
+        for frame in range(args.frames):
+            if rng.random() < args.scene_changes:
+                scene = rng.randrange(2 ** 32)
+
+            file_name = code + "_%d.jpg" % frame
+            blob_service.create_blob_from_bytes(container, code + "/" + file_name,
+                                                make_jpeg(scene, rng))
+            messages.append((IMAGES_QUEUE, {"blob": code + "/" + file_name, "meeting-code": code,
+                                            "file-name": file_name,
+                                            "date-time": (start + timedelta(seconds=20 * frame)).strftime("%d/%m/%Y %H:%M")}))
+
+        for clip in range(args.clips):
+            file_name = code + "_%d.wav" % clip
+            blob_service.create_blob_from_bytes(container, code + "/" + file_name,
+                                                make_wav(audio, args.clip_seconds, rng))
+            messages.append((VOICES_QUEUE, {"blob": code + "/" + file_name, "meeting-code": code,
+                                            "file-name": file_name,
+                                            "date-time": (start + timedelta(seconds=args.clip_seconds * clip)).strftime("%d/%m/%Y %H:%M")}))
+
+    # Imagens e áudios das reuniões chegam intercalados, como durante reuniões simultâneas
+    rng.shuffle(messages)
+
+    for queue_name, message in messages:
+        queue_service.put_message(queue_name, json.dumps(message))
+
+    return Counter(queue_name for queue_name, _ in messages)
+
+
+def consume(queue_service, queue_name, function, workers, recorder, retry_seconds):
+    # Imita o gatilho de fila do host: cada worker retira uma mensagem, chama a function e remove a
+    # mensagem se não houve exceção; as que falharam voltam após retry_seconds
+    import azure.functions as func
+
+    def worker():
+        while True:
+            message = queue_service.receive_trigger(queue_name)
+
+            if message is None:
+                if queue_service.pending(queue_name) == 0:
+                    return
+                time.sleep(0.05)
+                continue
+
+            if message.dequeue_count > MAX_DEQUEUE_COUNT:
+                logging.warning("Message " + message.id +
+                                " discarded after " + str(MAX_DEQUEUE_COUNT) + " attempts.")
+                queue_service.complete_trigger(queue_name, message)
+                continue
+
+            started = time.perf_counter()
+            try:
+                function(func.QueueMessage(id=message.id, body=message.content.encode("utf-8"),
+                                           pop_receipt=message.pop_receipt))
+            except Exception as error:
+                logging.warning("Invocation failed: " + str(error))
+                recorder.add(queue_name, time.perf_counter() - started, True)
+
+                queue_service.abandon_trigger(queue_name, message, retry_seconds)
+                continue
+
+            recorder.add(queue_name, time.perf_counter() - started)
+            queue_service.complete_trigger(queue_name, message)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    return threads
+
+
+def read(functions, args, recorder):
+    import azure.functions as func
+
+    def call(name, code):
+        request = func.HttpRequest("GET", "http://localhost/api/" + name,
+                                   params={"code": code}, body=b"")
+
+        started = time.perf_counter()
+        response = functions[name].main(request)
+        recorder.add(name, time.perf_counter() - started,
+                     response.status_code >= 400)
+
+    calls = [(name, meeting_code(meeting)) for meeting in range(args.meetings)
+             for name in functions for _ in range(args.reads)]
+    random.Random(args.seed).shuffle(calls)
+
+    with ThreadPoolExecutor(max_workers=args.read_workers) as executor:
+        list(executor.map(lambda item: call(*item), calls))
+
+    return Counter(name for name, _ in calls)
+
+
+def print_report(title, rows, transactions):
+    print()
+    print(title)
+    print("%-18s %7s %7s %9s %10s %10s %10s" %
+          ("function", "calls", "errors", "units/s", "p50 (ms)", "p95 (ms)", "p99 (ms)"))
+
+    for name, row in rows.items():
+        print("%-18s %7d %7d %9.1f %10.1f %10.1f %10.1f" % (name, row["calls"], row["errors"], row["throughput"],
+                                                          row["p50_ms"], row["p95_ms"], row["p99_ms"]))
+
+    # As operações do gatilho de fila ("host.") são listadas, mas não entram no total das functions
+    print("storage transactions: %d" % sum(count for operation, count in transactions.items()
+                                           if not operation.startswith("host.")))
+    for operation, count in sorted(transactions.items()):
+        print("  %-34s %8d" % (operation, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="End-to-end load test with local fakes")
+    parser.add_argument("--meetings", type=int, default=3)
+    parser.add_argument("--frames", type=int, default=40,
+                        help="images per meeting")
+    parser.add_argument("--scene-changes", type=float, default=0.3,
+                        help="fraction of images that differ from the previous one")
+    parser.add_argument("--clips", type=int, default=4,
+                        help="audio clips per meeting")
+    parser.add_argument("--clip-seconds", type=float, default=20)
+    parser.add_argument("--reads", type=int, default=20,
+                        help="requests per meeting to each HTTP endpoint")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="concurrent invocations per queue")
+    parser.add_argument("--read-workers", type=int, default=8)
+    parser.add_argument("--retry-seconds", type=float, default=2,
+                        help="visibility timeout of failed messages")
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="mean Cognitive Services latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--log-level", default="ERROR")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    config = stubs.StubConfig(args.latency, args.jitter, args.throttle_rate, args.retry_after,
+                              seed=args.seed)
+    server = stubs.StubServer(config).start()
+
+    # Os endpoints são lidos ao importar as functions
+    os.environ.update(server.settings())
+
+    clients = app.load("shared_code.clients")
+    audio = app.load("shared_code.audio")
+    table_service, blob_service, queue_service = fakes.install(clients)
+
+    queue_imaging = app.load("queueImaging")
+    queue_recording = app.load("queueRecording")
+    readers = {name: app.load(name)
+               for name in ("getCode", "getFacialAnalysis", "getWordCloud")}
+
+    messages = enqueue(args, table_service, blob_service,
+                       queue_service, audio)
+    setup_transactions = fakes.transactions(
+        table_service, blob_service, queue_service)
+
+    recorder = Recorder()
+
+    started = time.perf_counter()
+    threads = consume(queue_service, IMAGES_QUEUE, queue_imaging.main, args.workers, recorder, args.retry_seconds) + \
+        consume(queue_service, VOICES_QUEUE, queue_recording.main,
+                args.workers, recorder, args.retry_seconds)
+    for thread in threads:
+        thread.join()
+    ingest_seconds = time.perf_counter() - started
+
+    ingest_transactions = fakes.transactions(
+        table_service, blob_service, queue_service) - setup_transactions
+
+    started = time.perf_counter()
+    reads = read(readers, args, recorder)
+    read_seconds = time.perf_counter() - started
+
+    read_transactions = fakes.transactions(
+        table_service, blob_service, queue_service) - setup_transactions - ingest_transactions
+
+    results = {
+        "ingest": {"seconds": ingest_seconds,
+                   "functions": {"queueImaging": recorder.summary(IMAGES_QUEUE, messages[IMAGES_QUEUE], ingest_seconds),
+                                 "queueRecording": recorder.summary(VOICES_QUEUE, messages[VOICES_QUEUE], ingest_seconds)},
+                   "transactions": dict(ingest_transactions)},
+        "read": {"seconds": read_seconds,
+                 "functions": {name: recorder.summary(name, reads[name], read_seconds) for name in readers},
+                 "transactions": dict(read_transactions)},
+        "cognitive": {"requests": dict(config.requests), "throttled": dict(config.throttled)}
+    }
+
+    print("%d meetings, %d images and %d clips of %.0f s" % (args.meetings, messages[IMAGES_QUEUE],
+                                                             messages[VOICES_QUEUE], args.clip_seconds))
+    print_report("Ingest (%.1f s, units = messages)" % ingest_seconds,
+                 results["ingest"]["functions"], ingest_transactions)
+    print_report("Read (%.1f s, units = requests)" % read_seconds,
+                 results["read"]["functions"], read_transactions)
+    print()
+    print("cognitive services requests: " + json.dumps(results["cognitive"]))
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
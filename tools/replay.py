@@ -0,0 +1,193 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from . import app
+
+# Reconstrói os registros de tracking de muitas reuniões a partir dos logs das APIs, sem chamar a Face
+# API nem a de fala: as respostas da Face API (TABLE_NAME_API_FACE) são pontuadas de novo e as
+# transcrições (TABLE_NAME_API_T2S) recontadas, com o mesmo código das functions de fila. Para usar
+# depois de uma mudança nas regras de pontuação, nas stopwords ou no formato do tracking.
+#
+# As reuniões são distribuídas entre processos; cada reunião concluída é registrada no arquivo de
+# checkpoint (uma linha JSON por reunião), e uma nova execução com o mesmo arquivo pula as já feitas.
+# Usa o Storage configurado nas variáveis de ambiente (as mesmas das functions).
+#
+#   python -m tools.replay --all --workers 8 --checkpoint replay.jsonl
+#   python -m tools.replay AT81CB 6IVACO --only speech
+
+PARTS = ("faces", "speech")
+
+# Processos novos, sem herdar as conexões HTTP abertas pelo processo principal ao listar as reuniões
+MP_CONTEXT = "spawn"
+
+REQUIRED_SETTINGS = ("STORAGE_ACCOUNT_NAME", "STORAGE_ACCOUNT_KEY", "TABLE_NAME_TRACKING",
+                     "TABLE_NAME_API_FACE", "TABLE_NAME_API_T2S", "TABLE_NAME_PARAMETERS")
+
+
+def list_meetings(table_service):
+    # Toda reunião tem registro principal: o queueImaging o cria junto com o resumo de emoções, então
+    # basta a partição "tracking-analysis" (um RowKey por reunião), sem percorrer os registros por imagem
+    tracking = app.load("shared_code.tracking")
+
+    return sorted(record["RowKey"] for record in table_service.query_entities(
+        os.environ["TABLE_NAME_TRACKING"], filter="PartitionKey eq '" + tracking.TRACKING_PARTITION + "'",
+        select="RowKey"))
+
+
+def replay_meeting(meeting_code, parts):
+    # Executado nos processos do pool: cada processo carrega as functions e os clientes uma única vez
+    clients = app.load("shared_code.clients")
+    result = {"code": meeting_code}
+    started = time.perf_counter()
+
+    try:
+        if "faces" in parts:
+            result["faces"] = app.load("queueImaging").rescore_meeting(
+                clients.table_service, meeting_code)
+
+        if "speech" in parts:
+            result["speech"] = app.load("queueRecording").rebuild_transcripts(
+                clients.table_service, meeting_code)
+
+        result["status"] = "ok"
+    except Exception:
+        result["status"] = "error"
+        result["error"] = traceback.format_exc()
+
+    result["seconds"] = round(time.perf_counter() - started, 3)
+
+    return result
+
+
+def read_checkpoint(path):
+    # Reuniões já concluídas; as que falharam são tentadas de novo
+    done = set()
+
+    if path is None or not os.path.exists(path):
+        return done
+
+    with open(path, encoding="utf-8") as checkpoint:
+        for line in checkpoint:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Linha incompleta de uma execução interrompida no meio da escrita
+                continue
+
+            if entry.get("status") == "ok":
+                done.add(entry["code"])
+
+    return done
+
+
+def replay(meeting_codes, parts, workers, checkpoint_path=None):
+    done = read_checkpoint(checkpoint_path)
+    pending = [code for code in meeting_codes if code not in done]
+
+    print("%d meetings, %d already done, %d to replay" %
+          (len(meeting_codes), len(meeting_codes) - len(pending), len(pending)))
+
+    checkpoint = open(checkpoint_path, "a+", encoding="utf-8") if checkpoint_path else None
+
+    # Depois de uma linha incompleta, a próxima começa numa linha nova
+    if checkpoint is not None and checkpoint.tell() > 0:
+        checkpoint.seek(checkpoint.tell() - 1)
+        if checkpoint.read(1) != "\n":
+            checkpoint.write("\n")
+    counts = {"ok": 0, "error": 0}
+    started = time.perf_counter()
+
+    def record(result):
+        counts[result["status"]] += 1
+
+        if result["status"] == "ok":
+            print("%s: %s" % (result["code"], json.dumps({part: result.get(part) for part in parts})))
+        else:
+            print("%s: error\n%s" % (result["code"], result["error"]))
+
+        if checkpoint is not None:
+            checkpoint.write(json.dumps(result) + "\n")
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+
+    try:
+        if workers <= 0:
+            for code in pending:
+                record(replay_meeting(code, parts))
+        else:
+            # No máximo duas reuniões por processo em andamento, para não acumular milhares de futures
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(MP_CONTEXT)) as executor:
+                codes = iter(pending)
+                running = set()
+
+                while True:
+                    for code in codes:
+                        running.add(executor.submit(replay_meeting, code, parts))
+                        if len(running) >= workers * 2:
+                            break
+
+                    if len(running) == 0:
+                        break
+
+                    finished, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        record(future.result())
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+    elapsed = time.perf_counter() - started
+    print("replayed %d meetings (%d errors) in %.1f s (%.2f meetings/s)" %
+          (counts["ok"], counts["error"], elapsed, counts["ok"] / elapsed if elapsed > 0 else 0))
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild tracking rows from the stored API logs")
+    parser.add_argument("meetings", nargs="*", help="meeting codes")
+    parser.add_argument("--all", action="store_true",
+                        help="every meeting of the tracking table")
+    parser.add_argument("--file", help="file with one meeting code per line")
+    parser.add_argument("--only", choices=PARTS,
+                        help="rebuild only the facial analysis or only the transcripts")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="processes (0 runs in this process)")
+    parser.add_argument("--checkpoint",
+                        help="JSON lines file of finished meetings, to resume an interrupted run")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    missing = [name for name in REQUIRED_SETTINGS if name not in os.environ]
+    if missing:
+        parser.error("missing settings: " + ", ".join(missing))
+
+    meeting_codes = list(args.meetings)
+
+    if args.file:
+        with open(args.file, encoding="utf-8") as codes_file:
+            meeting_codes += [line.strip() for line in codes_file if line.strip()]
+
+    if args.all:
+        meeting_codes += list_meetings(app.load("shared_code.clients").table_service)
+
+    if len(meeting_codes) == 0:
+        parser.error("give meeting codes, --file or --all")
+
+    counts = replay(sorted(set(meeting_codes)),
+                    (args.only,) if args.only else PARTS, args.workers, args.checkpoint)
+
+    if counts["error"] > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import argparse
+import json
+import logging
+import os
+from . import app
+
+# Pontua de novo reuniões já processadas a partir das respostas da Face API guardadas no log
+# (TABLE_NAME_API_FACE), depois de uma mudança nas regras de pontuação, sem chamar a Face API.
+# Usa o Storage configurado nas variáveis de ambiente (as mesmas das functions).
+#
+#   python -m tools.rescore AT81CB 6IVACO
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rescore meetings from the stored Face API responses")
+    parser.add_argument("meetings", nargs="+", help="meeting codes")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    missing = [name for name in ("STORAGE_ACCOUNT_NAME", "STORAGE_ACCOUNT_KEY", "TABLE_NAME_TRACKING", "TABLE_NAME_API_FACE")
+               if name not in os.environ]
+    if missing:
+        parser.error("missing settings: " + ", ".join(missing))
+
+    clients = app.load("shared_code.clients")
+    queue_imaging = app.load("queueImaging")
+
+    for meeting_code in args.meetings:
+        emotional_count = queue_imaging.rescore_meeting(
+            clients.table_service, meeting_code)
+
+        print(meeting_code + ": " + (json.dumps(emotional_count)
+                                     if emotional_count is not None else "no frames"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import json
+import random
+import socketserver
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Servidor HTTP local que imita os endpoints de Cognitive Services usados pelas functions: Face
+# "detect", STS "issueToken" e o reconhecimento de fala de áudio curto. Latência e taxa de 429
+# configuráveis, para testes de carga sem uma assinatura do Azure.
+#
+#   python -m tools.stubs --port 8081 --latency 0.3 --throttle-rate 0.05
+
+EMOTIONS = ["anger", "contempt", "disgust", "fear",
+            "happiness", "neutral", "sadness", "surprise"]
+
+WORDS = ["reunião", "projeto", "inovação", "equipe", "cliente", "resultado", "proposta", "prazo",
+         "tecnologia", "pessoal", "gente", "negócio", "realidade", "semana", "apresentação",
+         "dados", "produto", "mercado", "ideia", "empresa", "processo", "desenvolvimento"]
+
+
+class StubConfig:
+
+    def __init__(self, latency=0.2, jitter=0.1, throttle_rate=0.0, retry_after=1, max_faces=3, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.max_faces = max_faces
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.throttled = Counter()
+
+    def draw(self):
+        # Sorteia latência e 429 de uma requisição
+        with self.lock:
+            delay = max(0, self.random.gauss(self.latency, self.jitter))
+            throttled = self.random.random() < self.throttle_rate
+
+            return delay, throttled
+
+    def faces(self):
+        with self.lock:
+            faces = []
+
+            for _ in range(self.random.randint(0, self.max_faces)):
+                scores = [self.random.random() ** 3 for _ in EMOTIONS]
+                total = sum(scores)
+
+                faces.append({"faceId": str(uuid.uuid4()),
+                              "faceRectangle": {"top": 10, "left": 10, "width": 80, "height": 80},
+                              "faceAttributes": {"emotion": {emotion: round(score / total, 3)
+                                                             for emotion, score in zip(EMOTIONS, scores)}}})
+
+            return faces
+
+    def sentence(self, seconds):
+        with self.lock:
+            return " ".join(self.random.choice(WORDS) for _ in range(max(1, int(seconds * 2)))).capitalize() + "."
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        # O queueRecording envia o áudio em streaming (Transfer-Encoding: chunked)
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    return bytes(body)
+
+                body += self.rfile.read(size)
+                self.rfile.readline()
+
+        return self.rfile.read(int(self.headers.get("Content-Length", "0")))
+
+    def reply(self, status, body, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        config = self.server.config
+        body = self.read_body()
+
+        if "/face/" in self.path:
+            service = "face"
+        elif "/issueToken" in self.path:
+            service = "token"
+        elif "/speech/" in self.path:
+            service = "speech"
+        else:
+            self.reply(404, {"error": {"code": "NotFound"}})
+            return
+
+        with config.lock:
+            config.requests[service] += 1
+
+        delay, throttled = config.draw()
+        time.sleep(delay)
+
+        if throttled and service != "token":
+            with config.lock:
+                config.throttled[service] += 1
+
+            self.reply(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                       headers={"Retry-After": str(config.retry_after)})
+        elif service == "face":
+            self.reply(200, config.faces())
+        elif service == "token":
+            self.reply(200, uuid.uuid4().hex.encode("ascii"), "text/plain")
+        else:
+            # PCM 16 bits mono a 16 kHz: 32000 bytes por segundo
+            seconds = len(body) / 32000
+            self.reply(200, {"RecognitionStatus": "Success", "DisplayText": config.sentence(seconds),
+                             "Offset": 0, "Duration": int(seconds * 10 ** 7)})
+
+
+class StubServer(socketserver.ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, config, host="127.0.0.1", port=0):
+        HTTPServer.__init__(self, (host, port), StubHandler)
+        self.config = config
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+    def settings(self):
+        # Variáveis de ambiente que apontam shared_code.cognitive para este servidor
+        return {"URL_FACE_API": self.url + "/face/v1.0/detect",
+                "URL_TOKEN_API": self.url + "/sts/v1.0/issueToken",
+                "URL_STT_API": self.url + "/speech/recognition/conversation/cognitiveservices/v1?language=pt-BR"}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local Cognitive Services stubs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="mean latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1,
+                        help="latency standard deviation in seconds")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of Face/STT calls answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    server = StubServer(StubConfig(args.latency, args.jitter, args.throttle_rate, args.retry_after,
+                                   seed=args.seed), args.host, args.port)
+
+    for name, value in server.settings().items():
+        print(name + "=" + value)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()